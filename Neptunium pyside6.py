@@ -1,57 +1,162 @@
 import os
 import sys
-import psutil
-import platform
-import fitz  # PyMuPDF
-from llama_cpp import Llama
+import threading
+import multiprocessing
+from transcript import Transcript
+from engine import Engine
+from speculative import get_mode, mode_choices, OFF
+from catalog import summary
+from prefill import DEBOUNCE_MS
+from vision import ImageAttachment, IMAGE_TYPES, has_vision
 from PySide6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
                              QHBoxLayout, QTextEdit, QLineEdit, QPushButton, 
-                             QFileDialog, QComboBox, QLabel, QFrame, QScrollArea)
-from PySide6.QtCore import Qt, QThread, Signal, Slot, QSize
+                             QFileDialog, QComboBox, QLabel, QFrame, QScrollArea, QCheckBox,
+                             QAbstractScrollArea)
+from PySide6.QtCore import Qt, QThread, QTimer, Signal, Slot, QSize
 from PySide6.QtGui import QFont, QIcon, QColor, QPalette
 
-# --- Worker Thread for LLM ---
-class LlamaWorker(QThread):
-    response_received = Signal(str)
-    finished_generating = Signal()
+# --- Virtualized Chat Log ---
+class TranscriptView(QAbstractScrollArea):
+    """Only keeps bubbles for the visible rows (+ overscan); they are recycled from a pool"""
+    BUBBLE_WIDTH = 500
+    SPACING = 6
+    COLORS = {"user": "#2b5ff1", "assistant": "#333333", "file": "#1a3a5a"}
 
-    def __init__(self, llm, messages):
+    def __init__(self, overscan=3):
         super().__init__()
-        self.llm = llm
-        self.messages = messages
+        self.overscan = overscan
+        self.store = Transcript(self.measure)
+        self.active = {}  # row index -> QLabel
+        self.pool = []
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.verticalScrollBar().setSingleStep(20)
+        self.verticalScrollBar().valueChanged.connect(self.relayout)
 
-    def run(self):
-        try:
-            stream = self.llm.create_chat_completion(messages=self.messages, stream=True)
-            for chunk in stream:
-                if "content" in chunk["choices"][0]["delta"]:
-                    token = chunk["choices"][0]["delta"]["content"]
-                    self.response_received.emit(token)
-        except Exception as e:
-            self.response_received.emit(f"\n[Error]: {e}")
-        self.finished_generating.emit()
+        # Hidden bubble used to measure rows with the real font, padding and wrapping
+        self.probe = self._new_bubble()
+        self._style(self.probe, "assistant")
+        self.probe.hide()
+        # Laying out a whole reply per frame adds up: re-measure about twice per wrapped line
+        self.store.remeasure_chars = max(self.BUBBLE_WIDTH // self.probe.fontMetrics().averageCharWidth() // 2, 1)
+
+    def measure(self, role, text):
+        self.probe.setText(text)
+        return self.probe.heightForWidth(self.BUBBLE_WIDTH) + self.SPACING
+
+    # --- Public API (row indices are stable for the whole session) ---
+    def add(self, role, text):
+        index = self.store.add(role, text)
+        self.refresh()
+        return index
+
+    def set_text(self, index, text):
+        self.store.set_text(index, text)
+        if index in self.active:
+            self.active[index].setText(text)
+        self.refresh()
+
+    def append(self, index, tail):
+        self.store.append(index, tail)
+        if index in self.active:
+            self.active[index].setText(self.store.texts[index])
+        self.refresh()
+
+    def scroll_to_end(self):
+        self.verticalScrollBar().setValue(self.verticalScrollBar().maximum())
+
+    # --- Windowing ---
+    def refresh(self):
+        bar = self.verticalScrollBar()
+        bar.setPageStep(self.viewport().height())
+        bar.setRange(0, max(self.store.total_height - self.viewport().height(), 0))
+        self.relayout()
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.refresh()
+
+    @Slot()
+    def relayout(self):
+        top = self.verticalScrollBar().value()
+        width = self.viewport().width()
+        first, last = self.store.visible_range(top, self.viewport().height(), self.overscan)
+
+        for index in [i for i in self.active if not first <= i < last]:
+            bubble = self.active.pop(index)
+            bubble.hide()
+            self.pool.append(bubble)
+
+        for index in range(first, last):
+            bubble = self.active.get(index)
+            if bubble is None:
+                bubble = self.pool.pop() if self.pool else self._new_bubble()
+                self._style(bubble, self.store.role(index))
+                bubble.setText(self.store.texts[index])
+                bubble.show()
+                self.active[index] = bubble
+
+            role = self.store.role(index)
+            x = width - self.BUBBLE_WIDTH - 10 if role != "assistant" else 10
+            height = self.store.heights[index] - self.SPACING
+            bubble.setGeometry(x, self.store.offsets[index] - top, self.BUBBLE_WIDTH, height)
+
+    def _new_bubble(self):
+        bubble = QLabel(self.viewport())
+        bubble.setWordWrap(True)
+        bubble.setTextFormat(Qt.PlainText)
+        bubble.setAlignment(Qt.AlignLeft | Qt.AlignTop)
+        bubble.role = None
+        return bubble
+
+    def _style(self, bubble, role):
+        if bubble.role == role: return
+        bubble.role = role
+        bubble.setStyleSheet(f"""
+            background-color: {self.COLORS[role]};
+            color: white;
+            border-radius: 15px;
+            padding: 12px;
+            margin: 5px;
+        """)
 
 # --- Main UI ---
 class NeptuniumApp(QMainWindow):
+    status_changed = Signal(str)
+    document_ready = Signal(object, object)
+    document_indexed = Signal(object)
+    memory_changed = Signal(str)
+    generation_finished = Signal(object, int)
+    speculative_ready = Signal(object, str)
+
     def __init__(self):
         super().__init__()
         self.setWindowTitle("Neptunium AI - PySide6 Edition")
         self.resize(1000, 800)
         self.setAcceptDrops(True)
         
-        # LLM Logic State
-        self.llm = None
-        self.history = []
-        self.pending_context = ""
-        self.specs = self.get_specs()
-        
+        # Models, caches, attachments and generation: the same engine as the Tk build
+        self.engine = Engine(on_memory=lambda level, text: self.memory_changed.emit(text))
+        self.prefill_timer = QTimer(self)
+        self.prefill_timer.setSingleShot(True)
+        self.prefill_timer.timeout.connect(self.start_prefill)
+        self.stream = None
+        self.stream_timer = QTimer(self)
+        self.stream_timer.timeout.connect(self.update_ai_stream)
+
         self.setup_ui()
-        self.refresh_models()
+        self.status_changed.connect(self.status_label.setText)
+        self.memory_changed.connect(self.memory_label.setText)
+        self.document_ready.connect(self.attach_document)
+        self.document_indexed.connect(self.on_document_indexed)
+        self.generation_finished.connect(self.on_generation_finished)
+        self.speculative_ready.connect(self.show_speculative)
         self.apply_styles()
+        # Runs once the event loop is up (after show()); the model loads in the background
+        QTimer.singleShot(0, self.on_startup)
 
-    def get_specs(self):
-        ram_gb = round(psutil.virtual_memory().total / (1024**3))
-        return {"ram": ram_gb, "cores": os.cpu_count() or 4}
+    def on_startup(self):
+        self.engine.started()
+        self.refresh_models()
 
     def setup_ui(self):
         central_widget = QWidget()
@@ -70,8 +175,28 @@ class NeptuniumApp(QMainWindow):
         self.model_box = QComboBox()
         self.model_box.currentTextChanged.connect(self.load_selected_model)
         sidebar_layout.addWidget(self.model_box)
+        self.model_info = QLabel("")
+        self.model_info.setWordWrap(True)
+        self.model_info.setStyleSheet("color: gray; font-size: 11px;")
+        sidebar_layout.addWidget(self.model_info)
+
+        sidebar_layout.addWidget(QLabel("<b>SPECULATIVE DECODING</b>"))
+        self.spec_box = QComboBox()
+        self.spec_box.addItem(OFF)
+        self.spec_box.textActivated.connect(self.set_speculative)
+        sidebar_layout.addWidget(self.spec_box)
+
+        # Opt-in: repeated questions are answered from disk (replies become deterministic)
+        self.cache_box = QCheckBox("Reuse answers")
+        self.cache_box.setChecked(self.engine.response_cache.enabled)
+        self.cache_box.toggled.connect(self.engine.response_cache.set_enabled)
+        sidebar_layout.addWidget(self.cache_box)
         
         sidebar_layout.addStretch()
+        self.memory_label = QLabel("")
+        self.memory_label.setWordWrap(True)
+        self.memory_label.setStyleSheet("color: orange; font-size: 11px;")
+        sidebar_layout.addWidget(self.memory_label)
         self.status_label = QLabel("System Ready")
         sidebar_layout.addWidget(self.status_label)
         
@@ -81,16 +206,10 @@ class NeptuniumApp(QMainWindow):
         right_container = QWidget()
         right_layout = QVBoxLayout(right_container)
         
-        self.scroll_area = QScrollArea()
-        self.scroll_area.setWidgetResizable(True)
-        self.scroll_area.setObjectName("chatScroll")
+        self.chat_view = TranscriptView()
+        self.chat_view.setObjectName("chatScroll")
         
-        self.chat_widget = QWidget()
-        self.chat_layout = QVBoxLayout(self.chat_widget)
-        self.chat_layout.addStretch()
-        self.scroll_area.setWidget(self.chat_widget)
-        
-        right_layout.addWidget(self.scroll_area)
+        right_layout.addWidget(self.chat_view)
 
         # --- Input Bar (Gemini Style) ---
         input_frame = QFrame()
@@ -100,16 +219,24 @@ class NeptuniumApp(QMainWindow):
         self.attach_btn = QPushButton("+")
         self.attach_btn.setFixedSize(40, 40)
         self.attach_btn.clicked.connect(self.handle_upload)
+
+        # Shown while a document is attached; every question is about it until detached
+        self.detach_btn = QPushButton("✕")
+        self.detach_btn.setFixedSize(40, 40)
+        self.detach_btn.clicked.connect(self.detach_document)
+        self.detach_btn.hide()
         
         self.input_field = QLineEdit()
         self.input_field.setPlaceholderText("Ask Neptunium anything...")
         self.input_field.returnPressed.connect(self.send_message)
+        self.input_field.textEdited.connect(self.schedule_prefill)
         
         self.send_btn = QPushButton("Send")
-        self.send_btn.clicked.connect(self.send_message)
+        self.send_btn.clicked.connect(self.on_send_clicked)
         self.send_btn.setEnabled(False)
 
         input_hbox.addWidget(self.attach_btn)
+        input_hbox.addWidget(self.detach_btn)
         input_hbox.addWidget(self.input_field)
         input_hbox.addWidget(self.send_btn)
         
@@ -117,92 +244,189 @@ class NeptuniumApp(QMainWindow):
         main_layout.addWidget(right_container)
 
     def refresh_models(self):
-        models = [f for f in os.listdir(".") if f.endswith(".gguf")]
+        # Only GGUF headers are read (and cached), so details show before anything loads
+        entries = self.engine.catalog.scan()
+        self.model_box.blockSignals(True)
         self.model_box.clear()
-        if models:
-            self.model_box.addItems(models)
+        if entries:
+            for entry in entries:
+                self.model_box.addItem(entry["path"])
+                self.model_box.setItemData(self.model_box.count() - 1, summary(entry), Qt.ToolTipRole)
+            paths = [e["path"] for e in entries]
+            last = self.engine.last_model
+            first = last if last in paths else paths[0]
+            self.model_box.setCurrentText(first)
+            self.model_box.blockSignals(False)
+            self.load_selected_model(first)
         else:
+            self.model_box.blockSignals(False)
             self.model_box.addItem("No models found")
 
     def load_selected_model(self, model_name):
         if not model_name or not model_name.endswith(".gguf"): return
+        entry = self.engine.catalog.entry(model_name)
+        self.model_info.setText(summary(entry) if entry else "")
+        fits, need = self.engine.check_fit(model_name)
+        if not fits:
+            # Refused before loading: it would only swap the machine to a halt
+            self.status_label.setText(f"Too large: needs {need / 1024**3:.1f} GB RAM")
+            if self.engine.model_name:
+                self.model_box.blockSignals(True)  # no second load_selected_model
+                self.model_box.setCurrentText(self.engine.model_name)
+                self.model_box.blockSignals(False)
+            return
+        self.cancel_prefill()
         self.status_label.setText("Loading model...")
         self.send_btn.setEnabled(False)
-        
-        # Using a simple thread to load weights without freezing UI
-        threading.Thread(target=self._init_llm, args=(model_name,), daemon=True).start()
+        # Loads on a thread without freezing the UI
+        self.engine.load(model_name, self.on_model_ready, lambda e: self.status_changed.emit(f"Error: {e}"))
 
-    def _init_llm(self, path):
-        try:
-            self.llm = Llama(model_path=path, n_ctx=4096, verbose=False)
-            self.status_label.setText("● Online")
-            self.send_btn.setEnabled(True)
-        except Exception as e:
-            self.status_label.setText(f"Error: {e}")
+    def on_model_ready(self, path, load_s):
+        # Loader thread
+        self.status_changed.emit(f"● Online | loaded in {load_s:.1f}s")
+        self.speculative_ready.emit(mode_choices(path), get_mode(path))
+
+    def set_speculative(self, mode):
+        path = self.engine.set_speculative(mode)
+        if path:
+            self.load_selected_model(path)
+
+    @Slot(object, str)
+    def show_speculative(self, modes, mode):
+        self.spec_box.clear()
+        self.spec_box.addItems(modes)
+        self.spec_box.setCurrentText(mode)
+        self.send_btn.setEnabled(True)  # sent once the model is loaded
 
     def handle_upload(self):
-        path, _ = QFileDialog.getOpenFileName(self, "Upload File", "", "Text/PDF (*.txt *.pdf)")
+        path, _ = QFileDialog.getOpenFileName(self, "Upload File", "", f"Documents and images (*.txt *.pdf {IMAGE_TYPES})")
         if not path: return
         
+        # A new attachment replaces (and cancels) the previous one
+        cancel = self.detach_document()
+        self.detach_btn.setToolTip(f"Detach {os.path.basename(path)}")
+        self.detach_btn.show()
+
+        threading.Thread(target=self._ingest_document, args=(path, cancel), daemon=True).start()
+        self.add_chat_bubble(f"📎 Attached: {os.path.basename(path)}", is_user=True, is_file=True)
+
+    def _ingest_document(self, path, cancel):
         filename = os.path.basename(path)
-        if path.endswith(".pdf"):
-            doc = fitz.open(path)
-            content = "\n".join([page.get_text() for page in doc])
-        else:
-            with open(path, "r", encoding="utf-8") as f:
-                content = f.read()
-        
-        self.pending_context = f"\n[File: {filename}]\n{content[:5000]}\n"
-        self.add_chat_bubble(f"📎 Attached: {filename}", is_user=True, is_file=True)
+
+        def progress(stage, i, n):
+            if stage == "page":
+                self.status_changed.emit(f"Reading {filename}: page {i}/{n}")
+            else:
+                self.status_changed.emit(f"Indexing {filename}: {i}/{n}")
+
+        try:
+            doc = self.engine.ingest(path, cancel, lambda doc: self.document_ready.emit(doc, cancel), progress)
+        except Exception as e:
+            self.status_changed.emit(f"Error loading file: {e}")
+            return
+        if not doc: return
+        if isinstance(doc, ImageAttachment):
+            if not has_vision(self.engine.llm):
+                self.status_changed.emit(f"🖼 {filename}: needs a vision model")
+            return
+        self.status_changed.emit(f"📎 {doc.name}: {len(doc.chunks)} sections")
+        self.document_indexed.emit(cancel)
+
+    def detach_document(self):
+        # Stops extraction, indexing and prefill for the current attachment
+        self.cancel_prefill()
+        self.detach_btn.hide()
+        return self.engine.detach()
+
+    @Slot(object, object)
+    def attach_document(self, doc, cancel):
+        # The whole file is indexed; each question only pulls in the relevant chunks
+        if self.engine.attach(doc, cancel):
+            self.schedule_prefill()
+
+    @Slot(object)
+    def on_document_indexed(self, cancel):
+        # Embedding search may pick other excerpts than the keyword search did
+        if not cancel.is_set():
+            self.schedule_prefill()
+
+    # --- Background prefill ---
+    def schedule_prefill(self, *args):
+        """On attach and typing pauses: evaluate the document part of the next prompt early"""
+        if self.engine.can_prefill():
+            self.prefill_timer.start(DEBOUNCE_MS)
+
+    def start_prefill(self):
+        self.engine.start_prefill(self.input_field.text().strip())
+
+    def cancel_prefill(self):
+        self.prefill_timer.stop()
+        self.engine.cancel_prefill()
 
     def add_chat_bubble(self, text, is_user=True, is_file=False):
-        bubble = QLabel(text)
-        bubble.setWordWrap(True)
-        bubble.setFixedWidth(500)
-        
-        bg = "#2b5ff1" if is_user else "#333333"
-        if is_file: bg = "#1a3a5a"
-        
-        bubble.setStyleSheet(f"""
-            background-color: {bg};
-            color: white;
-            border-radius: 15px;
-            padding: 12px;
-            margin: 5px;
-        """)
-        
-        alignment = Qt.AlignRight if is_user else Qt.AlignLeft
-        self.chat_layout.addWidget(bubble, alignment=alignment)
-        self.scroll_area.verticalScrollBar().setValue(self.scroll_area.verticalScrollBar().maximum())
-        return bubble
+        role = "file" if is_file else "user" if is_user else "assistant"
+        index = self.chat_view.add(role, text)
+        self.chat_view.scroll_to_end()
+        return index
 
     def send_message(self):
         query = self.input_field.text().strip()
-        if not query or not self.llm: return
+        if not query or not self.engine.llm: return
         
         self.add_chat_bubble(query, is_user=True)
         self.input_field.clear()
         
-        full_prompt = f"{self.pending_context}\nUser: {query}" if self.pending_context else query
-        self.history.append({"role": "user", "content": full_prompt})
-        self.pending_context = ""
-        
         # Setup AI response bubble
         self.ai_bubble = self.add_chat_bubble("...", is_user=False)
         self.current_ai_text = ""
         
-        # Start Worker Thread
-        self.worker = LlamaWorker(self.llm, self.history)
-        self.worker.response_received.connect(self.update_ai_stream)
-        self.worker.finished_generating.connect(lambda: self.send_btn.setEnabled(True))
-        self.send_btn.setEnabled(False)
-        self.worker.start()
+        # Queued on the inference worker; a new question preempts the running reply.
+        # Tokens go into the stream buffer, which the UI timer picks up once per frame
+        self.cancel_prefill()
+        bubble = self.ai_bubble
+        self.stream = self.engine.ask(query, on_done=lambda stream: self.generation_finished.emit(stream, bubble))
+        self.send_btn.setText("Stop")
+        self.stream_timer.start(self.stream.interval_ms)
+
+    def on_send_clicked(self):
+        if self.stream and not self.stream.closed and not self.input_field.text().strip():
+            self.engine.stop()
+        else:
+            self.send_message()
+
+    @Slot()
+    def update_ai_stream(self):
+        # One relayout per frame, however many tokens arrived since the last one
+        tail, _ = self.stream.drain()
+        live = self.stream.metrics.live()
+        if live:
+            self.status_label.setText(live)
+        if not tail: return
+        self.stream.metrics.frame(self.stream.lag)
+        if self.current_ai_text:
+            self.chat_view.append(self.ai_bubble, tail)
+        else:
+            self.chat_view.set_text(self.ai_bubble, tail)  # replaces the "..." placeholder
+        self.current_ai_text += tail
 
-    @Slot(str)
-    def update_ai_stream(self, token):
-        self.current_ai_text += token
-        self.ai_bubble.setText(self.current_ai_text)
-        self.ai_bubble.adjustSize()
+    @Slot(object, int)
+    def on_generation_finished(self, stream, bubble):
+        # May be a reply that was preempted: it only finalizes its own bubble
+        current = stream is self.stream
+        if current:
+            self.stream_timer.stop()
+            self.update_ai_stream()
+        text = stream.text
+        if stream.error:
+            text += f"\n[Error]: {stream.error}"
+        elif stream.stopped:
+            text += " [timed out]" if stream.stopped == "timeout" else " [stopped]"
+        self.chat_view.set_text(bubble, text.strip())
+        self.engine.finished(stream)
+        if current:
+            self.send_btn.setText("Send")
+            if not stream.error:
+                self.status_label.setText(stream.metrics.summary())
 
     def apply_styles(self):
         self.setStyleSheet("""
@@ -237,7 +461,7 @@ class NeptuniumApp(QMainWindow):
         """)
 
 if __name__ == "__main__":
-    import threading
+    multiprocessing.freeze_support()  # PDF extraction workers in PyInstaller builds
     app = QApplication(sys.argv)
     window = NeptuniumApp()
     window.show()
@@ -1,50 +1,158 @@
 import os
 import threading
-import psutil
-import platform
+import multiprocessing
 import customtkinter as ctk
 from tkinter import filedialog
-from llama_cpp import Llama
-import fitz  # PyMuPDF
-
-class HardwareEngine:
-    @staticmethod
-    def get_specs():
-        ram_gb = round(psutil.virtual_memory().total / (1024**3))
-        cores = os.cpu_count() or 4
-        is_mac = platform.system() == "Darwin"
-        
-        # Heuristic for local LLM settings
-        ctx_limit = 4096 if ram_gb > 8 else 2048
-        offload = -1 if ram_gb > 12 else 0 # -1 uses all GPU layers if available
-        
-        return {
-            "ram": ram_gb,
-            "cores": max(cores - 2, 1),
-            "ctx": ctx_limit,
-            "offload": offload,
-            "desc": f"{platform.system()} | {ram_gb}GB RAM"
-        }
+from transcript import Transcript
+from engine import Engine
+from speculative import get_mode, mode_choices, OFF
+from catalog import summary
+from prefill import DEBOUNCE_MS
+from vision import ImageAttachment, IMAGE_TYPES, has_vision
+
+def bubble_height(newlines, chars):
+    lines = newlines + (chars // 60) + 1
+    return min(max(lines * 22, 45), 600)
 
 class ChatMessage(ctk.CTkFrame):
-    def __init__(self, master, role, text, **kwargs):
+    def __init__(self, master, role="assistant", text="", **kwargs):
         super().__init__(master, fg_color="transparent", **kwargs)
-        is_user = role == "user"
-        bg_color = "#2b5ff1" if is_user else "#333333"
-        
         self.textbox = ctk.CTkTextbox(
-            self, width=500, fg_color=bg_color, text_color="white",
+            self, width=500, text_color="white",
             font=("Segoe UI", 13), corner_radius=15, wrap="word", padx=10, pady=10
         )
+        self.role = None
+        self.show(role, text)
+
+    def show(self, role, text):
+        # Bubbles are recycled by TranscriptView, so the role can change between uses
+        if role != self.role:
+            is_user = role == "user"
+            self.textbox.configure(fg_color="#2b5ff1" if is_user else "#333333")
+            self.textbox.pack_forget()
+            self.textbox.pack(side="right" if is_user else "left", padx=10, pady=5)
+            self.role = role
+        self.set_text(text)
+
+    def update_height(self):
+        text = self.textbox.get("0.0", "end")
+        self.newlines = text.count("\n")
+        self.chars = len(text)
+        self._apply_height()
+
+    def _apply_height(self):
+        self.textbox.configure(height=bubble_height(self.newlines, self.chars))
+
+    def set_text(self, text):
+        self.textbox.configure(state="normal")
+        self.textbox.delete("0.0", "end")
         self.textbox.insert("0.0", text)
         self.textbox.configure(state="disabled")
-        self.textbox.pack(side="right" if is_user else "left", padx=10, pady=5)
         self.update_height()
 
-    def update_height(self):
-        text = self.textbox.get("0.0", "end")
-        lines = text.count("\n") + (len(text) // 60) + 1
-        self.textbox.configure(height=min(max(lines * 22, 45), 600))
+    def append_text(self, tail):
+        # Only the new tail is inserted and counted - no rescan of the whole reply
+        self.textbox.configure(state="normal")
+        self.textbox.insert("end-1c", tail)
+        self.textbox.configure(state="disabled")
+        self.newlines += tail.count("\n")
+        self.chars += len(tail)
+        self._apply_height()
+
+class TranscriptView(ctk.CTkFrame):
+    """Chat log that only materializes bubbles for visible rows (+ overscan), recycled from a pool"""
+    ROW_PAD = 20  # textbox pady above and below
+
+    def __init__(self, master, overscan=3, **kwargs):
+        super().__init__(master, fg_color="transparent", **kwargs)
+        self.overscan = overscan
+        self.scale = ctk.ScalingTracker.get_widget_scaling(self)
+        self.store = Transcript(self.measure)
+        self.active = {}  # row index -> (bubble, canvas item)
+        self.pool = []
+
+        bg = self._apply_appearance_mode(ctk.ThemeManager.theme["CTk"]["fg_color"])
+        self.canvas = ctk.CTkCanvas(self, highlightthickness=0, bg=bg, yscrollincrement=20)
+        self.scrollbar = ctk.CTkScrollbar(self, command=self.yview)
+        self.canvas.configure(yscrollcommand=self.scrollbar.set)
+        self.scrollbar.pack(side="right", fill="y")
+        self.canvas.pack(side="left", fill="both", expand=True)
+
+        self.canvas.bind("<Configure>", lambda e: self.refresh())
+        self._bind_wheel(self.canvas)
+
+    def measure(self, role, text):
+        # Same estimate ChatMessage uses (the textbox counts a trailing newline)
+        return round((bubble_height(text.count("\n") + 1, len(text) + 1) + self.ROW_PAD) * self.scale)
+
+    # --- Public API (row indices are stable for the whole session) ---
+    def add(self, role, text):
+        index = self.store.add(role, text)
+        self.refresh()
+        return index
+
+    def set_text(self, index, text):
+        self.store.set_text(index, text)
+        if index in self.active:
+            self.active[index][0].set_text(text)
+        self.refresh()
+
+    def append(self, index, tail):
+        self.store.append(index, tail)
+        if index in self.active:
+            self.active[index][0].append_text(tail)
+        self.refresh()
+
+    def scroll_to_end(self):
+        self.canvas.yview_moveto(1.0)
+        self.refresh()
+
+    # --- Scrolling ---
+    def yview(self, *args):
+        self.canvas.yview(*args)
+        self.refresh()
+
+    def _bind_wheel(self, widget):
+        widget.bind("<MouseWheel>", self._on_wheel)
+        widget.bind("<Button-4>", self._on_wheel)
+        widget.bind("<Button-5>", self._on_wheel)
+
+    def _on_wheel(self, event):
+        up = event.num == 4 or getattr(event, "delta", 0) > 0
+        self.yview("scroll", -3 if up else 3, "units")
+        return "break"
+
+    # --- Windowing ---
+    def refresh(self):
+        width = self.canvas.winfo_width()
+        self.canvas.configure(scrollregion=(0, 0, width, self.store.total_height))
+        first, last = self.store.visible_range(
+            self.canvas.canvasy(0), self.canvas.winfo_height(), self.overscan
+        )
+
+        for index in [i for i in self.active if not first <= i < last]:
+            bubble, item = self.active.pop(index)
+            self.canvas.delete(item)
+            self.pool.append(bubble)
+
+        for index in range(first, last):
+            if index in self.active:
+                item = self.active[index][1]
+                self.canvas.coords(item, 0, self.store.offsets[index])
+                self.canvas.itemconfigure(item, width=width)
+                continue
+            bubble = self.pool.pop() if self.pool else self._new_bubble()
+            bubble.show(self.store.role(index), self.store.texts[index])
+            item = self.canvas.create_window(
+                0, self.store.offsets[index], window=bubble, anchor="nw", width=width
+            )
+            self.active[index] = (bubble, item)
+
+    def _new_bubble(self):
+        bubble = ChatMessage(self.canvas)
+        self._bind_wheel(bubble)
+        self._bind_wheel(bubble.textbox._textbox)
+        return bubble
 
 class NeptuniumAI(ctk.CTk):
     def __init__(self):
@@ -52,10 +160,11 @@ class NeptuniumAI(ctk.CTk):
         self.title("Neptunium AI")
         self.geometry("900x750")
         
-        self.specs = HardwareEngine.get_specs()
-        self.history = []
-        self.pending_context = ""
-        self.llm = None
+        # Models, caches, attachments and generation; this class only draws them
+        self.engine = Engine(on_memory=self.show_memory_pressure)
+        self.prefill_timer = None
+        self.stream = None  # the reply currently streaming
+        self.catalog_entries = {}  # path -> GGUF header facts
 
         # --- Top Bar (Model Selection) ---
         self.top_bar = ctk.CTkFrame(self, height=50, fg_color="transparent")
@@ -66,17 +175,36 @@ class NeptuniumAI(ctk.CTk):
         
         self.model_dropdown = ctk.CTkOptionMenu(self.top_bar, values=["Scanning..."], command=self.switch_model)
         self.model_dropdown.pack(side="left")
+
+        self.spec_label = ctk.CTkLabel(self.top_bar, text="Speculative:", font=("Segoe UI", 12, "bold"))
+        self.spec_label.pack(side="left", padx=(20, 10))
+
+        self.spec_dropdown = ctk.CTkOptionMenu(self.top_bar, values=[OFF], command=self.set_speculative, width=120)
+        self.spec_dropdown.pack(side="left")
         
         self.status_indicator = ctk.CTkLabel(self.top_bar, text="● Offline", text_color="gray")
         self.status_indicator.pack(side="right")
 
+        self.memory_label = ctk.CTkLabel(self.top_bar, text="", text_color="orange")
+        self.memory_label.pack(side="right", padx=15)
+
+        # Opt-in: repeated questions are answered from disk (replies become deterministic)
+        self.cache_switch = ctk.CTkSwitch(self.top_bar, text="Reuse answers", command=self.toggle_response_cache)
+        self.cache_switch.pack(side="right", padx=15)
+        if self.engine.response_cache.enabled:
+            self.cache_switch.select()
+
+        self.model_info = ctk.CTkLabel(self, text="", text_color="gray", font=("Segoe UI", 11))
+        self.model_info.pack(anchor="w", padx=20)
+
         # --- Chat Area ---
-        self.chat_container = ctk.CTkScrollableFrame(self, fg_color="transparent")
-        self.chat_container.pack(fill="both", expand=True, padx=20, pady=10)
+        self.chat_view = TranscriptView(self)
+        self.chat_view.pack(fill="both", expand=True, padx=20, pady=10)
 
         # --- Attachment Preview ---
         self.file_pill = ctk.CTkLabel(self, text="", text_color="#3498db", font=("Segoe UI", 11, "italic"))
         self.file_pill.pack(pady=0)
+        self.file_pill.bind("<Button-1>", lambda e: self.detach_document())
 
         # --- Input Bar (Gemini Style) ---
         self.input_container = ctk.CTkFrame(self, corner_radius=25, fg_color="#252525", border_width=1, border_color="#444")
@@ -91,115 +219,193 @@ class NeptuniumAI(ctk.CTk):
                                      border_width=0, fg_color="transparent", height=40)
         self.input_box.pack(side="left", fill="x", expand=True, padx=5)
         self.input_box.bind("<Return>", lambda e: self.start_generation())
+        self.input_box.bind("<KeyRelease>", self.schedule_prefill)
 
         self.submit_btn = ctk.CTkButton(self.input_container, text="Send", width=80, height=34, 
                                        corner_radius=17, command=self.start_generation, state="disabled")
         self.submit_btn.pack(side="right", padx=10)
 
-        # Initialize
+        # Initialize once the window is up; the model loads in the background
+        self.after_idle(self.on_startup)
+
+    def on_startup(self):
+        self.update_idletasks()
+        self.engine.started()
         self.refresh_models()
 
     def refresh_models(self):
-        models = [f for f in os.listdir(".") if f.endswith(".gguf")]
+        # Only GGUF headers are read (and cached), so details show before anything loads
+        self.catalog_entries = {e["path"]: e for e in self.engine.catalog.scan()}
+        models = list(self.catalog_entries)
         if not models:
             self.model_dropdown.configure(values=["No .gguf files found"])
         else:
             self.model_dropdown.configure(values=models)
-            self.model_dropdown.set(models[0])
-            self.switch_model(models[0])
+            last = self.engine.last_model
+            first = last if last in models else models[0]
+            self.model_dropdown.set(first)
+            self.switch_model(first)
 
     def switch_model(self, model_name):
+        entry = self.catalog_entries.get(model_name)
+        self.model_info.configure(text=summary(entry) if entry else "")
+        fits, need = self.engine.check_fit(model_name)
+        if not fits:
+            # Refused before loading: it would only swap the machine to a halt
+            self.status_indicator.configure(text=f"● Too large: needs {need / 1024**3:.1f} GB RAM", text_color="red")
+            if self.engine.model_name:
+                self.model_dropdown.set(self.engine.model_name)
+            return
+        self.cancel_prefill()
         self.status_indicator.configure(text="○ Loading...", text_color="yellow")
         self.submit_btn.configure(state="disabled")
-        threading.Thread(target=self._load_engine, args=(model_name,), daemon=True).start()
+        self.engine.load(model_name, self.on_model_ready, self.on_model_error)
 
-    def _load_engine(self, model_name):
-        try:
-            # Clean up old model if exists
-            if self.llm: del self.llm
-            
-            self.llm = Llama(
-                model_path=model_name,
-                n_gpu_layers=self.specs["offload"],
-                n_threads=self.specs["cores"],
-                n_ctx=self.specs["ctx"],
-                verbose=False
-            )
-            self.after(0, lambda: self.status_indicator.configure(text="● Ready", text_color="#4CAF50"))
-            self.after(0, lambda: self.submit_btn.configure(state="normal"))
-        except Exception as e:
-            self.after(0, lambda: self.status_indicator.configure(text="● Error", text_color="red"))
-            print(f"Engine Error: {e}")
+    def on_model_ready(self, model_name, load_s):
+        # Loader thread
+        ready = f"● Ready | loaded in {load_s:.1f}s"
+        modes = mode_choices(model_name)
+        self.after(0, lambda: self.spec_dropdown.configure(values=modes))
+        self.after(0, lambda: self.spec_dropdown.set(get_mode(model_name)))
+        self.after(0, lambda: self.status_indicator.configure(text=ready, text_color="#4CAF50"))
+        self.after(0, lambda: self.submit_btn.configure(state="normal"))
+
+    def on_model_error(self, error):
+        self.after(0, lambda: self.status_indicator.configure(text="● Error", text_color="red"))
+
+    def set_speculative(self, mode):
+        model_name = self.engine.set_speculative(mode)
+        if model_name:
+            self.switch_model(model_name)
 
     def upload_handler(self):
-        path = filedialog.askopenfilename(filetypes=[("Documents", "*.txt *.pdf")])
+        path = filedialog.askopenfilename(filetypes=[("Documents and images", f"*.txt *.pdf {IMAGE_TYPES}")])
         if not path: return
         
-        ext = os.path.splitext(path)[1].lower()
+        cancel = self.detach_document()
+        self.file_pill.configure(text=f"📎 {os.path.basename(path)}: reading...  ✕")
+        threading.Thread(target=self._ingest_document, args=(path, cancel), daemon=True).start()
+
+    def _ingest_document(self, path, cancel):
         filename = os.path.basename(path)
-        
-        try:
-            if ext == ".pdf":
-                doc = fitz.open(path)
-                content = "\n".join([page.get_text() for page in doc])
+
+        def progress(stage, i, n):
+            if stage == "page":
+                self._set_pill(cancel, f"📎 {filename}: page {i}/{n}  ✕")
             else:
-                with open(path, "r", encoding="utf-8") as f:
-                    content = f.read()
+                self._set_pill(cancel, f"📎 {filename} attached (indexing {i}/{n})  ✕")
 
-            # Limit context to avoid crashing small models
-            char_limit = self.specs["ctx"] * 3 
-            self.pending_context = f"\n[Document Content: {filename}]\n{content[:char_limit]}\n[End of Document]\n"
-            self.file_pill.configure(text=f"📎 {filename} attached")
+        try:
+            doc = self.engine.ingest(path, cancel, lambda doc: self.after(0, lambda: self._attach_document(doc, cancel)),
+                                     progress)
         except Exception as e:
-            self.file_pill.configure(text=f"❌ Error loading file: {e}")
+            self._set_pill(cancel, f"❌ Error loading file: {e}")
+            return
+        if not doc: return
+        if isinstance(doc, ImageAttachment):
+            note = "" if has_vision(self.engine.llm) else " - needs a vision model"
+            self._set_pill(cancel, f"🖼 {doc.name} attached{note}  ✕")
+            return
+        self._set_pill(cancel, f"📎 {doc.name} attached ({len(doc.chunks)} sections)  ✕")
+        # Embedding search may pick other excerpts than the keyword search did
+        self.after(0, lambda: cancel.is_set() or self.schedule_prefill())
+
+    def _attach_document(self, doc, cancel):
+        # The whole document is indexed; questions only pull in the relevant chunks
+        if self.engine.attach(doc, cancel):
+            self.schedule_prefill()
+
+    def _set_pill(self, cancel, text):
+        # Callable from worker threads; updates from a detached document are dropped
+        self.after(0, lambda: cancel.is_set() or self.file_pill.configure(text=text))
+
+    def detach_document(self):
+        self.cancel_prefill()
+        self.file_pill.configure(text="")
+        return self.engine.detach()
 
     def start_generation(self):
         query = self.input_box.get().strip()
-        if not query or not self.llm: return
+        if not query or not self.engine.llm: return
         
         self.add_message("user", query)
         self.input_box.delete(0, "end")
-        self.submit_btn.configure(state="disabled")
         
-        # Inject file context if it exists
-        full_prompt = f"{self.pending_context}\nQuestion: {query}" if self.pending_context else query
-        self.history.append({"role": "user", "content": full_prompt})
-        
-        # Clear UI file indicator and internal buffer
-        self.pending_context = ""
-        self.file_pill.configure(text="")
-        
-        threading.Thread(target=self.generate_response, daemon=True).start()
-
-    def generate_response(self):
         ai_msg = self.add_message("assistant", "...")
-        full_txt = ""
-        try:
-            stream = self.llm.create_chat_completion(messages=self.history, stream=True)
-            for chunk in stream:
-                if "content" in chunk["choices"][0]["delta"]:
-                    token = chunk["choices"][0]["delta"]["content"]
-                    full_txt += token
-                    self.after(0, lambda t=full_txt: self.update_ai_bubble(ai_msg, t))
-            self.history.append({"role": "assistant", "content": full_txt})
-        except Exception as e:
-            self.after(0, lambda: self.update_ai_bubble(ai_msg, f"Generation Error: {e}"))
-        
-        self.after(0, lambda: self.submit_btn.configure(state="normal"))
+        self.cancel_prefill()
+        # A new question preempts the reply that is still running (and any prefill)
+        stream = self.stream = self.engine.ask(query)
+        self.submit_btn.configure(text="Stop", command=self.stop_generation, state="normal")
+        self.after(stream.interval_ms, lambda: self.pump_stream(ai_msg, stream, first=True))
+
+    def show_memory_pressure(self, level, text):
+        # Governor thread; empty text once the limits are lifted
+        self.after(0, lambda: self.memory_label.configure(text=text))
+
+    def stop_generation(self):
+        self.engine.stop()
+
+    def toggle_response_cache(self):
+        self.engine.response_cache.set_enabled(bool(self.cache_switch.get()))
+
+    # --- Background prefill ---
+    def schedule_prefill(self, event=None):
+        """On attach and typing pauses: evaluate the document part of the next prompt early"""
+        if self.prefill_timer:
+            self.after_cancel(self.prefill_timer)
+            self.prefill_timer = None
+        if self.engine.can_prefill() and not (event and event.keysym == "Return"):
+            self.prefill_timer = self.after(DEBOUNCE_MS, self.start_prefill)
+
+    def start_prefill(self):
+        self.prefill_timer = None
+        self.engine.start_prefill(self.input_box.get().strip())
+
+    def cancel_prefill(self):
+        if self.prefill_timer:
+            self.after_cancel(self.prefill_timer)
+            self.prefill_timer = None
+        self.engine.cancel_prefill()
+
+    def pump_stream(self, ai_msg, stream, first=False):
+        # UI thread: one repaint per frame with everything decoded since the last one
+        tail, finished = stream.drain()
+        if tail:
+            stream.metrics.frame(stream.lag)
+            if first:
+                self.chat_view.set_text(ai_msg, tail)
+            else:
+                self.chat_view.append(ai_msg, tail)
+
+        if stream.error:
+            self.chat_view.set_text(ai_msg, f"Generation Error: {stream.error}")
+        elif finished and stream.stopped:
+            note = "[timed out]" if stream.stopped == "timeout" else "[stopped]"
+            if first and not tail:
+                self.chat_view.set_text(ai_msg, note)
+            else:
+                self.chat_view.append(ai_msg, f" {note}")
+
+        current = stream is self.stream  # a preempted reply must not touch the new one's controls
+        if finished:
+            # Logged from here so the last frame's render lag is included
+            self.engine.finished(stream)
+            if current:
+                self.submit_btn.configure(text="Send", command=self.start_generation, state="normal")
+                if not stream.error:
+                    self.status_indicator.configure(text=stream.metrics.summary(), text_color="#4CAF50")
+        else:
+            live = stream.metrics.live()
+            if live and current:
+                self.status_indicator.configure(text=live, text_color="#4CAF50")
+            self.after(stream.interval_ms, lambda: self.pump_stream(ai_msg, stream, first=first and not tail))
 
     def add_message(self, role, text):
-        msg = ChatMessage(self.chat_container, role, text)
-        msg.pack(fill="x", padx=5, pady=5)
-        self.after(100, lambda: self.chat_container._parent_canvas.yview_moveto(1.0))
-        return msg
-
-    def update_ai_bubble(self, msg_obj, text):
-        msg_obj.textbox.configure(state="normal")
-        msg_obj.textbox.delete("0.0", "end")
-        msg_obj.textbox.insert("0.0", text)
-        msg_obj.textbox.configure(state="disabled")
-        msg_obj.update_height()
+        index = self.chat_view.add(role, text)
+        self.after(100, self.chat_view.scroll_to_end)
+        return index
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # PDF extraction workers in PyInstaller builds
     app = NeptuniumAI()
     app.mainloop()
\ No newline at end of file
@@ -0,0 +1,279 @@
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+from hardware import HardwareEngine
+from catalog import get_catalog, footprint
+from context import ContextManager
+from retrieval import DocumentIndex
+from ingest import DocumentIngestor
+from telemetry import MetricsLog
+from engine import excerpt_count, document_prompt
+
+CACHE_DIR = ".neptunium_cache"
+MAX_TOKENS = 512
+REPORT_EVERY = 10  # seconds between progress lines
+
+
+# --- Input / checkpoint ---
+def read_prompts(path):
+    """Records from the prompt JSONL; each gets an "id" (its line number if it has none)"""
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                print(f"Batch Error: {path}:{lineno}: {e}")
+                continue
+            if isinstance(record, str):
+                record = {"prompt": record}
+            record.setdefault("id", lineno)
+            records.append(record)
+    return records
+
+
+def finished_ids(path):
+    """Ids already answered in the output file. A line cut short by an interrupted
+    run is removed, so appending starts on a clean line."""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "rb+") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end != len(data):
+            f.truncate(end)
+    for line in data[:end].splitlines():
+        try:
+            result = json.loads(line)
+        except ValueError:
+            continue
+        if "error" not in result:
+            done.add(result["id"])
+    return done
+
+
+def build_task(record, default_model, ingestor, n_ctx):
+    """Prompt text for one record, attachment excerpts included (done in the main
+    process: PDF extraction uses its own process pool). A record that cannot be
+    built (no prompt, unreadable attachment) comes back as an error result instead."""
+    model = record.get("model", default_model)
+    try:
+        prompt = record["prompt"]
+        path = record.get("attachment")
+        if path:
+            text = ingestor.extract(path)
+            if record.get("whole_document"):
+                prompt = f"[Document: {os.path.basename(path)}]\n{text}\n[End of Document]\nQuestion: {prompt}"
+            else:
+                # Same excerpts as the desktop app (keyword ranking, no embedder needed)
+                doc = DocumentIndex(path, text)
+                doc.ready.set()
+                prompt = document_prompt(doc.context_for(prompt, excerpt_count(n_ctx)), prompt)
+    except KeyError as e:
+        return {"id": record["id"], "model": os.path.basename(model), "error": f"missing field {e}", "seconds": 0.0}
+    except Exception as e:
+        return {"id": record["id"], "model": os.path.basename(model), "error": str(e), "seconds": 0.0}
+    return {
+        "id": record["id"],
+        "model": model,
+        "system": record.get("system"),
+        "prompt": prompt,
+        "max_tokens": record.get("max_tokens", MAX_TOKENS),
+        "temperature": record.get("temperature"),
+    }
+
+
+# --- Worker processes ---
+_worker = {}
+
+
+def _init_worker(specs, n_threads):
+    _worker.update(specs=specs, n_threads=n_threads, model=None, llm=None)
+
+
+def _run_task(task):
+    """One prompt in a worker process; the model stays loaded for the next task"""
+    from llama_cpp import Llama
+    t0 = time.perf_counter()
+    try:
+        if _worker["model"] != task["model"]:
+            _worker["llm"] = None  # tasks are sorted by model, so this happens once per model
+            params = HardwareEngine.engine_params(task["model"], _worker["specs"])
+            params["n_threads"] = _worker["n_threads"]
+            _worker["llm"] = Llama(model_path=task["model"], verbose=False, **params)
+            _worker["model"] = task["model"]
+        llm = _worker["llm"]
+
+        # The context manager clips an oversized prompt the same way the app does
+        context = ContextManager(n_ctx=llm.n_ctx(), reserve=task["max_tokens"])
+        context.attach(llm, llm.n_ctx())
+        if task["system"]:
+            context.add("system", task["system"])
+        context.add("user", task["prompt"])
+        kwargs = {} if task["temperature"] is None else {"temperature": task["temperature"]}
+        out = llm.create_chat_completion(messages=context.build(), max_tokens=context.reserve, **kwargs)
+        return {
+            "id": task["id"],
+            "model": os.path.basename(task["model"]),
+            "output": out["choices"][0]["message"]["content"],
+            "finish_reason": out["choices"][0]["finish_reason"],
+            "prompt_tokens": out["usage"]["prompt_tokens"],
+            "completion_tokens": out["usage"]["completion_tokens"],
+            "seconds": round(time.perf_counter() - t0, 3),
+        }
+    except Exception as e:
+        return {"id": task["id"], "model": os.path.basename(task["model"]), "error": str(e),
+                "seconds": round(time.perf_counter() - t0, 3)}
+
+
+def default_workers(model_path, specs, n_ctx):
+    """Model instances that fit: weights are mmap'd and shared between processes,
+    so each extra instance costs its own KV cache and a share of the cores"""
+    try:
+        from llama_cpp import llama_supports_gpu_offload
+        if specs["offload"] != 0 and llama_supports_gpu_offload():
+            return 1  # one GPU: parallel instances would only queue on it
+    except ImportError:
+        pass
+    entry = get_catalog().entry(model_path)
+    size = os.path.getsize(model_path)
+    kv = footprint(entry, n_ctx) - size if entry else size // 8
+    by_ram = (specs["model_pool"] - size) // max(kv, 1)
+    by_cores = specs["cores"] // 4  # below ~4 threads an instance's prompt eval crawls
+    return int(max(1, min(by_ram, by_cores)))
+
+
+# --- Run ---
+class BatchRun:
+    """Answers every prompt in a JSONL file and appends one JSON line per answer.
+
+    The output file doubles as the checkpoint: answered ids are skipped when the
+    same command is run again, and failed ones are retried.
+    """
+
+    def __init__(self, prompts_path, output_path, model, workers=None, specs=None):
+        self.prompts_path = prompts_path
+        self.output_path = output_path
+        self.model = model
+        self.specs = specs or HardwareEngine.get_specs()
+        self.n_ctx = HardwareEngine.engine_params(model, self.specs)["n_ctx"]
+        self.workers = workers or default_workers(model, self.specs, self.n_ctx)
+        self.stats = {"done": 0, "errors": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+    def tasks(self):
+        records = read_prompts(self.prompts_path)
+        done = finished_ids(self.output_path)
+        todo = [r for r in records if r["id"] not in done]
+        ingestor = DocumentIngestor(os.path.join(CACHE_DIR, "text"))
+        try:
+            built = [build_task(r, self.model, ingestor, self.n_ctx) for r in todo]
+        finally:
+            ingestor.shutdown()
+        failed = [t for t in built if "error" in t]
+        tasks = [t for t in built if "error" not in t]
+        tasks.sort(key=lambda t: t["model"])  # each worker loads each model once
+        return tasks, failed, len(records) - len(todo)
+
+    def run(self, progress=print):
+        tasks, failed, skipped = self.tasks()
+        if skipped:
+            progress(f"Resuming: {skipped} prompts already answered in {self.output_path}")
+        if failed:
+            # Written like a failed answer, so the next run retries these rows
+            with open(self.output_path, "a", encoding="utf-8") as out:
+                for result in failed:
+                    out.write(json.dumps(result, ensure_ascii=False) + "\n")
+                    self._count(result)
+        if not tasks:
+            return self.report(0.0, skipped)
+
+        n_threads = max(self.specs["cores"] // self.workers, 1)
+        progress(f"{len(tasks)} prompts | {self.workers} x {os.path.basename(self.model)} | {n_threads} threads each")
+        t0 = last = time.perf_counter()
+        pool = multiprocessing.Pool(self.workers, initializer=_init_worker, initargs=(self.specs, n_threads))
+        try:
+            with open(self.output_path, "a", encoding="utf-8") as out:
+                for result in pool.imap_unordered(_run_task, tasks):
+                    out.write(json.dumps(result, ensure_ascii=False) + "\n")
+                    out.flush()  # a crash loses at most the answers still in flight
+                    self._count(result)
+                    if time.perf_counter() - last >= REPORT_EVERY:
+                        last = time.perf_counter()
+                        progress(self.progress_text(last - t0, len(tasks)))
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        return self.report(time.perf_counter() - t0, skipped)
+
+    def _count(self, result):
+        if "error" in result:
+            self.stats["errors"] += 1
+            print(f"Batch Error: prompt {result['id']}: {result['error']}")
+            return
+        self.stats["done"] += 1
+        self.stats["prompt_tokens"] += result["prompt_tokens"]
+        self.stats["completion_tokens"] += result["completion_tokens"]
+
+    def progress_text(self, elapsed, total):
+        finished = self.stats["done"] + self.stats["errors"]
+        rate = finished / elapsed if elapsed else 0.0
+        eta = (total - finished) / rate if rate else 0
+        return (f"{finished}/{total} | {rate:.2f} prompts/s | "
+                f"{self.stats['completion_tokens'] / elapsed:.1f} tok/s | ETA {int(eta // 60)}:{int(eta % 60):02d}")
+
+    def report(self, elapsed, skipped):
+        """Aggregate throughput for this run (the resumed part excluded)"""
+        return {
+            "model": os.path.basename(self.model),
+            "workers": self.workers,
+            "answered": self.stats["done"],
+            "errors": self.stats["errors"],
+            "skipped": skipped,
+            "elapsed_s": round(elapsed, 2),
+            "prompts_per_s": round(self.stats["done"] / elapsed, 3) if elapsed else 0.0,
+            "prompt_tokens": self.stats["prompt_tokens"],
+            "completion_tokens": self.stats["completion_tokens"],
+            "decode_tps": round(self.stats["completion_tokens"] / elapsed, 1) if elapsed else 0.0,
+            "total_tps": round((self.stats["prompt_tokens"] + self.stats["completion_tokens"]) / elapsed, 1) if elapsed else 0.0,
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Neptunium batch mode: answer a JSONL of prompts",
+        epilog='Input lines: {"id": ..., "prompt": "...", "system": "...", "attachment": "manual.pdf", '
+               '"whole_document": false, "model": "other.gguf", "max_tokens": 512, "temperature": 0.2}',
+    )
+    parser.add_argument("prompts", help="input .jsonl")
+    parser.add_argument("output", help="results .jsonl (appended; rerun the same command to resume)")
+    parser.add_argument("--model", help="default .gguf (first catalog model if omitted)")
+    parser.add_argument("--workers", type=int, help="model instances (default: sized by HardwareEngine)")
+    args = parser.parse_args(argv)
+
+    model = args.model or next((e["path"] for e in get_catalog().scan()), None)
+    if not model:
+        parser.error("no .gguf models found; pass --model")
+
+    run = BatchRun(args.prompts, args.output, model, workers=args.workers)
+    try:
+        report = run.run()
+    except KeyboardInterrupt:
+        print(f"\nInterrupted - run the same command again to resume from {args.output}")
+        sys.exit(130)
+    MetricsLog(os.path.join(CACHE_DIR, "metrics.jsonl")).write("batch", **report)
+    print(json.dumps(report, indent=2))
+    if report["errors"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    main()
@@ -0,0 +1,406 @@
+import os
+import re
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+import threading
+import psutil
+from hardware import HardwareEngine
+from kv_cache import StateCache, cache_key
+from streaming import StreamBuffer
+from transcript import Transcript
+from context import ContextManager
+from retrieval import DocumentIndex
+from engine import excerpt_count, document_prompt, stream_completion
+
+DECODE_TOKENS = 64
+TURNS = 6
+
+# Start-up: importing a front-end must stay cheap and must not pull these in
+# (they load with the first model / attachment, on a background thread)
+STARTUP_TARGET_MS = 500
+DEFERRED_MODULES = ("llama_cpp", "numpy", "fitz")
+FRONTENDS = {"tk": "Neptunium.py", "qt": "Neptunium pyside6.py"}
+TOOLKITS = {"tk": ("customtkinter", "tkinter", "_tkinter"), "qt": ("PySide6", "shiboken6")}
+MISSING_MODULE_RE = re.compile(r"ModuleNotFoundError: No module named '([^'.]+)")
+STARTUP_PROBE = (
+    "import sys, time, json, importlib.util\n"
+    "t0 = time.perf_counter()\n"
+    "spec = importlib.util.spec_from_file_location('frontend', sys.argv[1])\n"
+    "spec.loader.exec_module(importlib.util.module_from_spec(spec))\n"
+    "ms = (time.perf_counter() - t0) * 1000\n"
+    "print(json.dumps({'import_ms': ms, 'eager': [m for m in sys.argv[2:] if m in sys.modules]}))\n"
+)
+
+# Lower is better for these; everything else (tokens/sec) is higher-is-better
+LOWER_IS_BETTER = ("_ms", "_mb", "_s")
+
+FILLER = (
+    "The reactor cooling loop is inspected every quarter. Valve V-12 must be closed "
+    "before the pump is serviced, and the pressure log is signed by the shift lead. "
+)
+
+
+class PeakRSS:
+    """Samples this process's RSS on a thread; use as a context manager"""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.proc = psutil.Process()
+        self.peak = 0
+        self.done = threading.Event()
+
+    def __enter__(self):
+        self.peak = self.proc.memory_info().rss
+        self.done.clear()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def _sample(self):
+        while not self.done.wait(self.interval):
+            self.peak = max(self.peak, self.proc.memory_info().rss)
+
+    def __exit__(self, *exc):
+        self.done.set()
+        self.thread.join()
+        self.peak = max(self.peak, self.proc.memory_info().rss)
+
+    @property
+    def mb(self):
+        return round(self.peak / 1024**2, 1)
+
+
+class StubLlama:
+    """Stands in for llama_cpp.Llama so the harness runs without a GGUF (CI).
+
+    One token per word; prompt eval and decode sleep at fixed rates, and a
+    prompt that extends the previous one only pays for the new suffix, like the
+    real KV prefix reuse. Timings are therefore deterministic and any change in
+    the numbers comes from Neptunium's own code path.
+    """
+
+    def __init__(self, model_path="stub.gguf", n_ctx=4096, prompt_tps=2000.0, decode_tps=100.0, load_s=0.05, **kwargs):
+        time.sleep(load_s)
+        self.model_path = model_path
+        self._n_ctx = n_ctx
+        self.prompt_tps = prompt_tps
+        self.decode_tps = decode_tps
+        self.metadata = {"general.architecture": "stub"}
+        self.cache = None
+        self.last = []
+
+    def n_ctx(self):
+        return self._n_ctx
+
+    def set_cache(self, cache):
+        self.cache = cache
+
+    def token_eos(self):
+        return 0
+
+    def tokenize(self, text, add_bos=True, special=False):
+        return [hash(w) & 0xFFFF or 1 for w in text.decode("utf-8", errors="ignore").split()]
+
+    def detokenize(self, tokens, prev_tokens=None, special=False):
+        return " ".join("tok" for _ in tokens).encode("utf-8")
+
+    def create_chat_completion(self, messages, max_tokens=256, stream=False, **kwargs):
+        prompt = []
+        for msg in messages:
+            prompt += self.tokenize(f"{msg['role']}: {msg['content']}".encode("utf-8"))
+        reused = 0
+        for a, b in zip(self.last, prompt):
+            if a != b:
+                break
+            reused += 1
+        time.sleep((len(prompt) - reused) / self.prompt_tps)
+
+        def chunks():
+            out = []
+            for i in range(max_tokens):
+                if i:
+                    time.sleep(1 / self.decode_tps)
+                out.append(i + 1)
+                yield {"choices": [{"delta": {"content": " tok"}, "finish_reason": None}]}
+            self.last = prompt + out
+
+        return chunks() if stream else list(chunks())
+
+
+class Bench:
+    """Drives the same path as Engine._generate (both front-ends) and reports timings"""
+
+    def __init__(self, model_path=None, stub=False, decode_tokens=DECODE_TOKENS):
+        self.model_path = model_path or "stub.gguf"
+        self.stub = stub
+        self.decode_tokens = decode_tokens
+        self.specs = HardwareEngine.get_specs()
+        self.state_cache = StateCache(ram_bytes=self.specs["state_cache"])  # RAM only: nothing carried between runs
+        self.llm = None
+        self.results = {}
+
+    # --- Engine (same construction as the desktop app) ---
+    def create_engine(self):
+        if self.stub:
+            llm = StubLlama(self.model_path, n_ctx=self.specs["ctx"])
+        else:
+            from llama_cpp import Llama
+            params = HardwareEngine.engine_params(self.model_path, self.specs)
+            llm = Llama(model_path=self.model_path, verbose=False, seed=1234, **params)
+        llm.set_cache(self.state_cache.for_model(cache_key(self.model_path, llm)))
+        return llm
+
+    def reply(self, context, query, doc=None, stream=None):
+        """One Engine._generate turn (through its stream_completion); returns
+        (ttft_s, total_s, prompt_tokens, decoded)"""
+        if doc:
+            query = document_prompt(doc.context_for(query, excerpt_count(self.specs["ctx"])), query)
+        context.add("user", query)
+        stream = stream or StreamBuffer()
+
+        kwargs = {"temperature": 0.0}
+        if not self.stub:
+            kwargs["logit_bias"] = {self.llm.token_eos(): -100.0}  # fixed decode length
+        first = []
+        t0 = time.perf_counter()
+        stream_completion(self.llm, context, stream, max_tokens=self.decode_tokens,
+                          on_token=lambda: first or first.append(time.perf_counter() - t0), **kwargs)
+        total = time.perf_counter() - t0
+        ttft = first[0] if first else None
+        prompt_tokens = context.prompt_tokens
+        # Chunks are not always one token each (stop-string hold back), so count the text
+        decoded = len(self.llm.tokenize(stream.text.encode("utf-8"), add_bos=False))
+        context.add("assistant", stream.text)
+        stream.close()
+        return ttft or total, total, prompt_tokens, decoded
+
+    def record(self, name, ttft, total, prompt_tokens, decoded, rss):
+        decode_s = max(total - ttft, 1e-9)
+        self.results[name] = {
+            "ttft_ms": round(ttft * 1000, 2),
+            "prompt_tps": round(prompt_tokens / ttft, 1),
+            "decode_tps": round((decoded - 1) / decode_s, 1) if decoded > 1 else 0.0,
+            "prompt_tokens": prompt_tokens,
+            "decoded": decoded,
+            "peak_rss_mb": rss.mb,
+        }
+
+    # --- Scenarios ---
+    def bench_load(self):
+        with PeakRSS() as rss:
+            t0 = time.perf_counter()
+            self.llm = self.create_engine()
+            load = time.perf_counter() - t0
+        self.results["load"] = {"load_s": round(load, 3), "peak_rss_mb": rss.mb}
+
+    def new_context(self):
+        context = ContextManager(n_ctx=self.llm.n_ctx())
+        context.attach(self.llm, self.llm.n_ctx())
+        return context
+
+    def bench_short(self):
+        with PeakRSS() as rss:
+            result = self.reply(self.new_context(), "Give me three tips for writing clear commit messages.")
+        self.record("short_prompt", *result, rss)
+
+    def bench_document(self):
+        text = "\n\n".join(f"Section {i}. " + FILLER * 4 for i in range(200))
+        doc = DocumentIndex("bench-manual.txt", text)  # keyword search: no embedder dependence
+        doc.ready.set()
+        with PeakRSS() as rss:
+            result = self.reply(self.new_context(), "When must valve V-12 be closed?", doc=doc)
+        self.record("document_prompt", *result, rss)
+
+    def bench_multi_turn(self):
+        context = self.new_context()
+        turns = []
+        with PeakRSS() as rss:
+            for i in range(TURNS):
+                turns.append(self.reply(context, f"Question {i}: " + FILLER))
+        # The last turn is the interesting one: a long history, mostly cached
+        self.record("multi_turn", *turns[-1], rss)
+        self.results["multi_turn"]["first_turn_ttft_ms"] = round(turns[0][0] * 1000, 2)
+
+    def bench_ui_stream(self, tokens=2000, token_interval=0.0005):
+        """UI-side cost of streaming: drain + transcript update per frame (no toolkit needed)"""
+        stream = StreamBuffer()
+        transcript = Transcript(lambda role, text: 22 * (text.count("\n") + len(text) // 60 + 1))
+        row = transcript.add("assistant", "")
+
+        def produce():
+            for _ in range(tokens):
+                stream.push(" tok")
+                time.sleep(token_interval)
+            stream.close()
+
+        producer = threading.Thread(target=produce, daemon=True)
+        frames, frame_times = 0, []
+        with PeakRSS() as rss:
+            producer.start()
+            while True:
+                t0 = time.perf_counter()
+                tail, finished = stream.drain()
+                if tail:
+                    transcript.append(row, tail)
+                    transcript.visible_range(max(transcript.total_height - 600, 0), 600)
+                frame_times.append(time.perf_counter() - t0)
+                frames += 1
+                if finished:
+                    break
+                time.sleep(stream.interval_ms / 1000)
+            producer.join()
+        frame_times.sort()
+        self.results["ui_stream"] = {
+            "frames": frames,
+            "tokens_per_frame": round(tokens / frames, 1),
+            "mean_frame_ms": round(sum(frame_times) / frames * 1000, 4),
+            "p99_frame_ms": round(frame_times[int(frames * 0.99) - 1] * 1000, 4),
+            "peak_rss_mb": rss.mb,
+        }
+
+    def bench_startup(self, runs=5):
+        """Fresh-interpreter import of each front-end (median of `runs`) and any heavy
+        module it imported eagerly. Only a toolkit that isn't installed is skipped."""
+        for name in FRONTENDS:
+            result = probe_startup(name, runs)
+            if result is None:
+                print(f"startup: skipped {FRONTENDS[name]} ({TOOLKITS[name][0]} is not installed)")
+                continue
+            self.results[f"startup_{name}"] = result
+
+    def run(self, scenarios=None):
+        self.bench_load()
+        for name in scenarios or ("short", "document", "multi_turn", "ui_stream", "startup"):
+            getattr(self, f"bench_{name}")()
+        return self.report()
+
+    def report(self):
+        try:
+            from importlib.metadata import version
+            llama_version = version("llama-cpp-python")
+        except Exception:
+            llama_version = None
+        return {
+            "model": os.path.basename(self.model_path),
+            "stub": self.stub,
+            "machine": HardwareEngine.machine_id(),
+            "platform": f"{platform.system()} {platform.machine()} | Python {platform.python_version()}",
+            "llama_cpp": llama_version,
+            "profile": None if self.stub else HardwareEngine.load_profile(self.model_path) is not None,
+            "decode_tokens": self.decode_tokens,
+            "results": self.results,
+        }
+
+
+def compare(current, baseline, threshold=0.10):
+    """Returns a list of (scenario, metric, baseline, current, change) that got worse than `threshold`"""
+    regressions = []
+    for scenario, metrics in baseline.get("results", {}).items():
+        for metric, old in metrics.items():
+            new = current["results"].get(scenario, {}).get(metric)
+            if not isinstance(old, (int, float)) or not isinstance(new, (int, float)) or not old:
+                continue
+            if metric in ("prompt_tokens", "decoded", "frames", "tokens_per_frame"):
+                continue  # workload descriptors, not performance
+            change = (new - old) / old
+            worse = change > threshold if metric.endswith(LOWER_IS_BETTER) else change < -threshold
+            if worse:
+                regressions.append((scenario, metric, old, new, round(change * 100, 1)))
+    return regressions
+
+
+def probe_startup(name, runs=5, pythonpath=None):
+    """Times a fresh-interpreter import of front-end `name` (median of `runs`).
+
+    Returns None if its GUI toolkit isn't installed, {"error": ...} if it fails
+    to import for any other reason (a broken front-end must not pass as skipped).
+    `pythonpath` is put in front of the import path (toolkit stand-ins in tests).
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ)
+    if pythonpath:
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [pythonpath, env.get("PYTHONPATH")]))
+    times, eager = [], []
+    for _ in range(runs):
+        proc = subprocess.run(
+            [sys.executable, "-c", STARTUP_PROBE, os.path.join(here, FRONTENDS[name]), *DEFERRED_MODULES],
+            cwd=here, capture_output=True, text=True, env=env
+        )
+        if proc.returncode != 0:
+            lines = proc.stderr.strip().splitlines() or [f"exit code {proc.returncode}"]
+            missing = MISSING_MODULE_RE.search(lines[-1])
+            if missing and missing.group(1) in TOOLKITS[name]:
+                return None
+            return {"error": lines[-1]}
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        times.append(result["import_ms"])
+        eager = result["eager"]
+    times.sort()
+    return {
+        "import_ms": round(times[len(times) // 2], 1),
+        "eager_imports": len(eager),
+        "eager_modules": ",".join(eager),
+    }
+
+
+def startup_failures(report, target_ms=STARTUP_TARGET_MS):
+    """Absolute start-up checks (independent of any baseline)"""
+    failures = []
+    for scenario, metrics in report["results"].items():
+        if not scenario.startswith("startup_"):
+            continue
+        if "error" in metrics:
+            failures.append(f"{scenario}: failed to import: {metrics['error']}")
+            continue
+        if metrics["import_ms"] > target_ms:
+            failures.append(f"{scenario}: import took {metrics['import_ms']} ms (target {target_ms} ms)")
+        if metrics["eager_imports"]:
+            failures.append(f"{scenario}: imported {metrics['eager_modules']} at start-up")
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Neptunium inference benchmark")
+    parser.add_argument("model", nargs="?", help=".gguf to benchmark (omit with --stub)")
+    parser.add_argument("--stub", action="store_true", help="use the stub backend (no model needed)")
+    parser.add_argument("--scenarios", help="comma separated: short,document,multi_turn,ui_stream,startup")
+    parser.add_argument("--decode-tokens", type=int, default=DECODE_TOKENS)
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--baseline", help="compare against this saved report")
+    parser.add_argument("--threshold", type=float, default=0.10, help="allowed slowdown (0.10 = 10%%)")
+    args = parser.parse_args(argv)
+
+    if not args.model and not args.stub:
+        parser.error("give a model path or --stub")
+
+    bench = Bench(args.model, stub=args.stub, decode_tokens=args.decode_tokens)
+    report = bench.run(args.scenarios.split(",") if args.scenarios else None)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    print(text)
+
+    failures = startup_failures(report)
+    for failure in failures:
+        print(f"STARTUP {failure}")
+    if failures:
+        sys.exit(1)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        for scenario, metric, old, new, change in regressions:
+            print(f"REGRESSION {scenario}.{metric}: {old} -> {new} ({change:+}%)")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {args.threshold:.0%} against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+import os
+import sys
+import json
+import struct
+import threading
+
+CACHE_DIR = ".neptunium_cache"
+CATALOG_PATH = os.path.join(CACHE_DIR, "catalog.json")
+MODEL_DIRS_PATH = os.path.join(CACHE_DIR, "model_dirs.json")
+LAST_MODEL_PATH = os.path.join(CACHE_DIR, "last_model.json")
+
+# GGUF key/value types
+UINT8, INT8, UINT16, INT16, UINT32, INT32, FLOAT32, BOOL, STRING, ARRAY, UINT64, INT64, FLOAT64 = range(13)
+SCALARS = {
+    UINT8: "<B", INT8: "<b", UINT16: "<H", INT16: "<h", UINT32: "<I", INT32: "<i",
+    FLOAT32: "<f", BOOL: "<?", UINT64: "<Q", INT64: "<q", FLOAT64: "<d",
+}
+
+# ggml tensor type -> (name, elements per block, bytes per block)
+GGML_TYPES = {
+    0: ("F32", 1, 4), 1: ("F16", 1, 2), 2: ("Q4_0", 32, 18), 3: ("Q4_1", 32, 20),
+    6: ("Q5_0", 32, 22), 7: ("Q5_1", 32, 24), 8: ("Q8_0", 32, 34), 9: ("Q8_1", 32, 36),
+    10: ("Q2_K", 256, 84), 11: ("Q3_K", 256, 110), 12: ("Q4_K", 256, 144), 13: ("Q5_K", 256, 176),
+    14: ("Q6_K", 256, 210), 15: ("Q8_K", 256, 292), 16: ("IQ2_XXS", 256, 66), 17: ("IQ2_XS", 256, 74),
+    18: ("IQ3_XXS", 256, 98), 19: ("IQ1_S", 256, 50), 20: ("IQ4_NL", 32, 18), 21: ("IQ3_S", 256, 110),
+    22: ("IQ2_S", 256, 82), 23: ("IQ4_XS", 256, 136), 24: ("I8", 1, 1), 25: ("I16", 1, 2),
+    26: ("I32", 1, 4), 27: ("I64", 1, 8), 28: ("F64", 1, 8), 29: ("IQ1_M", 256, 56),
+    30: ("BF16", 1, 2), 34: ("TQ1_0", 256, 54), 35: ("TQ2_0", 256, 66),
+}
+
+# general.file_type (llama_ftype) -> quantization name
+FILE_TYPES = {
+    0: "F32", 1: "F16", 2: "Q4_0", 3: "Q4_1", 7: "Q8_0", 8: "Q5_0", 9: "Q5_1", 10: "Q2_K",
+    11: "Q3_K_S", 12: "Q3_K_M", 13: "Q3_K_L", 14: "Q4_K_S", 15: "Q4_K_M", 16: "Q5_K_S",
+    17: "Q5_K_M", 18: "Q6_K", 19: "IQ2_XXS", 20: "IQ2_XS", 21: "Q2_K_S", 22: "IQ3_XS",
+    23: "IQ3_XXS", 24: "IQ1_S", 25: "IQ4_NL", 26: "IQ3_S", 27: "IQ3_M", 28: "IQ2_S",
+    29: "IQ2_M", 30: "IQ4_XS", 31: "IQ1_M", 32: "BF16", 36: "TQ1_0", 37: "TQ2_0",
+}
+
+
+class GGUFError(Exception):
+    pass
+
+
+# --- Header parsing ---
+class _Reader:
+    def __init__(self, f):
+        self.f = f
+
+    def unpack(self, fmt):
+        size = struct.calcsize(fmt)
+        data = self.f.read(size)
+        if len(data) != size:
+            raise GGUFError("truncated header")
+        return struct.unpack(fmt, data)[0]
+
+    def string(self, keep=True):
+        n = self.unpack("<Q")
+        if not keep:
+            self.f.seek(n, 1)
+            return None
+        return self.f.read(n).decode("utf-8", errors="replace")
+
+    def value(self, vtype, keep=True):
+        if vtype == STRING:
+            return self.string(keep)
+        if vtype == ARRAY:
+            itype = self.unpack("<I")
+            n = self.unpack("<Q")
+            if itype in SCALARS:
+                self.f.seek(n * struct.calcsize(SCALARS[itype]), 1)
+            else:
+                for _ in range(n):
+                    self.value(itype, keep=False)
+            return [n]  # only the length is kept (e.g. the vocabulary size)
+        if vtype not in SCALARS:
+            raise GGUFError(f"unknown value type {vtype}")
+        return self.unpack(SCALARS[vtype])
+
+
+def read_header(path):
+    """(metadata, tensors) from a GGUF file without loading it.
+
+    metadata maps keys to values (arrays become [length]); tensors is a list of
+    (name, shape, ggml type). Only the header is read - a few MB at most, most
+    of it the tokenizer vocabulary.
+    """
+    with open(path, "rb") as f:
+        r = _Reader(f)
+        if f.read(4) != b"GGUF":
+            raise GGUFError(f"{os.path.basename(path)} is not a GGUF file")
+        version = r.unpack("<I")
+        if version < 2:
+            raise GGUFError(f"GGUF v{version} is not supported")
+        n_tensors = r.unpack("<Q")
+        n_kv = r.unpack("<Q")
+
+        metadata = {}
+        for _ in range(n_kv):
+            key = r.string()
+            metadata[key] = r.value(r.unpack("<I"))
+
+        tensors = []
+        for _ in range(n_tensors):
+            name = r.string()
+            shape = [r.unpack("<Q") for _ in range(r.unpack("<I"))]
+            ttype = r.unpack("<I")
+            r.unpack("<Q")  # data offset
+            tensors.append((name, shape, ttype))
+    return metadata, tensors
+
+
+def describe(path):
+    """Catalog entry for one model file"""
+    metadata, tensors = read_header(path)
+    arch = metadata.get("general.architecture", "unknown")
+
+    params = 0
+    by_type = {}
+    for name, shape, ttype in tensors:
+        n = 1
+        for d in shape:
+            n *= d
+        params += n
+        tname, block, block_bytes = GGML_TYPES.get(ttype, (f"type{ttype}", None, None))
+        if block:
+            by_type[tname] = by_type.get(tname, 0) + n // block * block_bytes
+
+    file_type = metadata.get("general.file_type")
+    quant = FILE_TYPES.get(file_type) or (max(by_type, key=by_type.get) if by_type else None)
+    tokens = metadata.get("tokenizer.ggml.tokens")
+    stat = os.stat(path)
+    return {
+        "path": path,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "name": metadata.get("general.name") or os.path.basename(path),
+        "architecture": arch,
+        "type": metadata.get("general.type", "model"),  # "mmproj" for vision projectors
+        "parameters": params,
+        "quant": quant,
+        "context_length": metadata.get(f"{arch}.context_length"),
+        "vocab_size": tokens[0] if isinstance(tokens, list) else None,
+        "chat_template": metadata.get("tokenizer.chat_template"),
+        "tensor_bytes": sum(by_type.values()),
+        "tensor_types": by_type,
+        # Scalars in the same form as Llama.metadata (strings), for the memory estimates
+        "metadata": {k: str(v) for k, v in metadata.items()
+                     if not isinstance(v, list) and k != "tokenizer.chat_template"},
+    }
+
+
+# --- Memory estimates ---
+def kv_bytes(meta, n_ctx):
+    """f16 KV cache for n_ctx positions, from the attention shape in the header; None if unknown"""
+    arch = meta.get("general.architecture")
+    try:
+        layers = int(meta[f"{arch}.block_count"])
+        embd = int(meta[f"{arch}.embedding_length"])
+        heads = int(meta[f"{arch}.attention.head_count"])
+        kv_heads = int(meta.get(f"{arch}.attention.head_count_kv", heads))
+        return 2 * layers * n_ctx * embd * kv_heads // heads * 2
+    except (KeyError, ValueError, ZeroDivisionError):
+        return None
+
+
+def is_projector(entry):
+    """Vision projectors (mmproj / older "clip" files) can't be loaded as chat models"""
+    return entry["type"] == "mmproj" or entry["architecture"] == "clip"
+
+
+def footprint(entry, n_ctx, logits_all=False):
+    """Weights plus KV cache for this model at n_ctx (plus the n_ctx x n_vocab float
+    logits buffer llama_cpp allocates with logits_all, as speculative decoding needs)"""
+    kv = kv_bytes(entry["metadata"], n_ctx)
+    need = entry["size"] + (kv if kv is not None else entry["size"] // 8)
+    if logits_all:
+        need += n_ctx * (entry["vocab_size"] or 0) * 4
+    return need
+
+
+def summary(entry):
+    """One line for the model picker, e.g. "llama · 3.2B · Q4_K_M · 128k ctx · 1.9 GB" """
+    parts = [entry["architecture"]]
+    if entry["parameters"]:
+        p = entry["parameters"]
+        parts.append(f"{p / 1e9:.1f}B" if p >= 1e9 else f"{p / 1e6:.0f}M" if p >= 1e6 else f"{p / 1e3:.0f}K")
+    if entry["quant"]:
+        parts.append(entry["quant"])
+    if entry["context_length"]:
+        ctx = int(entry["context_length"])
+        parts.append(f"{ctx // 1024}k ctx" if ctx >= 1024 else f"{ctx} ctx")
+    parts.append(f"{entry['size'] / 1024**3:.1f} GB")
+    return " · ".join(parts)
+
+
+# --- Catalog ---
+def load_model_dirs():
+    """Folders scanned for .gguf files: .neptunium_cache/model_dirs.json, or the working directory"""
+    try:
+        with open(MODEL_DIRS_PATH, "r", encoding="utf-8") as f:
+            return json.load(f) or ["."]
+    except (OSError, ValueError):
+        return ["."]
+
+
+def save_model_dirs(dirs):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(MODEL_DIRS_PATH, "w", encoding="utf-8") as f:
+        json.dump(dirs, f, indent=2)
+
+
+def load_last_model():
+    """The model that was loaded last time, if it still exists"""
+    try:
+        with open(LAST_MODEL_PATH, "r", encoding="utf-8") as f:
+            path = json.load(f)["path"]
+        return path if os.path.exists(path) else None
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def save_last_model(path):
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(LAST_MODEL_PATH, "w", encoding="utf-8") as f:
+            json.dump({"path": path}, f)
+    except OSError as e:
+        print(f"Catalog Error: {e}")
+
+
+class ModelCatalog:
+    """Header facts for every .gguf in the model folders, cached by path, size and mtime.
+
+    A rescan only parses files that are new or changed, so listing models costs
+    a directory walk instead of a model load.
+    """
+
+    def __init__(self, dirs=None, cache_path=CATALOG_PATH):
+        self.dirs = dirs or load_model_dirs()
+        self.cache_path = cache_path
+        self.lock = threading.Lock()
+        self.entries = self._load()
+
+    def _load(self):
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+        tmp = self.cache_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp, self.cache_path)
+
+    def entry(self, path):
+        """The (cached) entry for one file, or None if it isn't a readable GGUF"""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        with self.lock:
+            cached = self.entries.get(path)
+            if cached and cached["size"] == stat.st_size and cached["mtime"] == stat.st_mtime:
+                return cached
+        try:
+            entry = describe(path)
+        except (OSError, GGUFError, struct.error) as e:
+            print(f"Catalog Error: {path}: {e}")
+            return None
+        with self.lock:
+            self.entries[path] = entry
+            self._save()
+        return entry
+
+    def scan(self):
+        """Entries for every model in the folders (vision projectors excluded), by path"""
+        found = []
+        for directory in self.dirs:
+            try:
+                names = sorted(os.listdir(directory))
+            except OSError as e:
+                print(f"Catalog Error: {e}")
+                continue
+            for name in names:
+                if name.endswith(".gguf"):
+                    path = name if directory == "." else os.path.join(directory, name)
+                    entry = self.entry(path)
+                    if entry and not is_projector(entry):
+                        found.append(entry)
+        with self.lock:
+            paths = {e["path"] for e in found}
+            stale = [p for p in self.entries if p not in paths and not os.path.exists(p)]
+            for p in stale:
+                del self.entries[p]
+            if stale:
+                self._save()
+        return found
+
+
+_catalog = None
+
+
+def get_catalog():
+    """Shared catalog for the app's model folders"""
+    global _catalog
+    if _catalog is None:
+        _catalog = ModelCatalog()
+    return _catalog
+
+
+if __name__ == "__main__":
+    # python catalog.py [folder ...]  |  python catalog.py --add-dir <folder>
+    if sys.argv[1:2] == ["--add-dir"]:
+        save_model_dirs(load_model_dirs() + [os.path.abspath(d) for d in sys.argv[2:]])
+        print(f"Model folders: {load_model_dirs()}")
+        sys.exit(0)
+    catalog = ModelCatalog(sys.argv[1:] or None)
+    for entry in catalog.scan():
+        print(f"{entry['path']}: {summary(entry)}")
@@ -0,0 +1,289 @@
+import json
+import hashlib
+import threading
+from inference import InferenceJob, GenerationCancelled
+
+SUMMARY_PROMPT = (
+    "Summarize the earlier part of this conversation in a few sentences. "
+    "Keep names, numbers, decisions and any open questions. Reply with the summary only."
+)
+IMAGE_TOKENS = 768  # context an attached image takes (projectors emit ~576-729 embeddings)
+
+
+def text_of(content):
+    """The text of a message's content (image parts dropped)"""
+    if isinstance(content, str):
+        return content
+    return "\n".join(part["text"] for part in content if part.get("type") == "text")
+
+
+def image_count(content):
+    return 0 if isinstance(content, str) else sum(1 for part in content if part.get("type") == "image_url")
+
+
+class ContextManager:
+    """Sits between the chat history and create_chat_completion.
+
+    Every message's token count is computed once and cached. build() returns the
+    newest messages that fit n_ctx minus the room reserved for the reply; older
+    turns fall out of the window in chunks (so the prompt prefix - and the KV cache
+    built on it - stays stable for several turns) and are folded into a running
+    summary once the user goes idle. With an InferenceWorker attached the summary
+    is a job on it, so the next question preempts it, even mid-prompt.
+    """
+
+    MSG_OVERHEAD = 8  # role markers / separators added by the chat template
+
+    def __init__(self, n_ctx=2048, reserve=None, low_water=0.6, idle_delay=4.0):
+        self.n_ctx = n_ctx
+        self.limit = None  # smaller window set by the memory governor (None: all of n_ctx)
+        self.reserve_setting = reserve
+        self.low_water = low_water
+        self.idle_delay = idle_delay
+
+        self.llm = None
+        self.llm_lock = None
+        self.worker = None
+        self.lock = threading.RLock()
+
+        self.messages = []
+        self.counts = []  # tokens per message, None until counted with the current model
+        self.start = 0  # first message still inside the window
+        self.summary = ""
+        self.summary_count = 0
+        self.summarized = 0  # messages[:summarized] are covered by self.summary
+        self.prompt_tokens = 0  # size of the last build(), for telemetry
+
+        self.timer = None
+        self.summary_job = None
+
+    # --- Model binding ---
+    def attach(self, llm, n_ctx, llm_lock=None, worker=None):
+        """Counts depend on the tokenizer, so a new model means recounting (lazily)"""
+        with self.lock:
+            self.llm = llm
+            self.llm_lock = llm_lock
+            self.worker = worker
+            self.n_ctx = n_ctx
+            self.counts = [None] * len(self.messages)
+            self.summary_count = self.count(self.summary) if self.summary else 0
+
+    def count(self, text):
+        if not isinstance(text, str):
+            return self.count(text_of(text)) + image_count(text) * IMAGE_TOKENS
+        if not self.llm:
+            return len(text) // 3 + self.MSG_OVERHEAD
+        tokens = self.llm.tokenize(text.encode("utf-8"), add_bos=False, special=True)
+        return len(tokens) + self.MSG_OVERHEAD
+
+    # --- History ---
+    def history_digest(self):
+        """Identifies the conversation the next reply builds on (summary + window)"""
+        with self.lock:
+            raw = json.dumps([self.summary, self.messages[self.start:]])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def add(self, role, content):
+        """Appends a message; returns its index"""
+        with self.lock:
+            self.messages.append({"role": role, "content": content})
+            self.counts.append(None)
+            return len(self.messages) - 1
+
+    def replace(self, index, content):
+        """Swaps a message's content (recounted on the next build)"""
+        with self.lock:
+            self.messages[index] = {"role": self.messages[index]["role"], "content": content}
+            self.counts[index] = None
+
+    def preview(self, content):
+        """What build() would return after add("user", content), without adding it"""
+        with self.lock:
+            start = self.start
+            self.add("user", content)
+            try:
+                return self.build()
+            finally:
+                self.messages.pop()
+                self.counts.pop()
+                self.start = start
+
+    def clear(self):
+        self.cancel_summary()
+        with self.lock:
+            self.messages, self.counts = [], []
+            self.start = self.summarized = 0
+            self.summary, self.summary_count = "", 0
+
+    @property
+    def window(self):
+        """Tokens the next request may use (prompt + reply)"""
+        return min(self.n_ctx, self.limit or self.n_ctx)
+
+    @property
+    def reserve(self):
+        """Tokens kept free for the reply (pass as max_tokens)"""
+        return self.reserve_setting or min(1024, self.window // 4)
+
+    @property
+    def budget(self):
+        return self.window - self.reserve
+
+    def _count_at(self, i):
+        if self.counts[i] is None:
+            self.counts[i] = self.count(self.messages[i]["content"])
+        return self.counts[i]
+
+    def build(self):
+        """Messages for the next completion, guaranteed to leave `reserve` tokens free"""
+        with self.lock:
+            if not self.messages:
+                return []
+            fixed = self.summary_count
+            total = fixed + sum(self._count_at(i) for i in range(self.start, len(self.messages)))
+
+            # Over budget: slide the window down to the low-water mark in one go
+            if total > self.budget:
+                target = int(self.budget * self.low_water)
+                while total > target and self.start < len(self.messages) - 1:
+                    total -= self.counts[self.start]
+                    self.start += 1
+                # Never open on a reply whose question was dropped: strict templates reject it
+                while self.messages[self.start]["role"] != "user" and self.start < len(self.messages) - 1:
+                    total -= self.counts[self.start]
+                    self.start += 1
+
+            # A single oversized message (usually a pasted document) gets clipped
+            last = len(self.messages) - 1
+            if total > self.budget:
+                self._clip(last, self.budget - fixed - (total - self.counts[last]))
+
+            self.prompt_tokens = fixed + sum(self.counts[i] for i in range(self.start, len(self.messages)))
+            prompt = []
+            if self.summary:
+                prompt.append({"role": "system", "content": f"Summary of the earlier conversation: {self.summary}"})
+            # Images only go to the model with the question they came with
+            for i in range(self.start, len(self.messages)):
+                msg = self.messages[i]
+                if i != last and not isinstance(msg["content"], str):
+                    msg = {"role": msg["role"], "content": text_of(msg["content"])}
+                prompt.append(msg)
+            return prompt
+
+    def _clip(self, i, max_tokens):
+        # Keep the head (document start) and the tail (the actual question)
+        content = self.messages[i]["content"]
+        if not isinstance(content, str):
+            images = [part for part in content if part.get("type") == "image_url"]
+            self.messages[i] = {"role": self.messages[i]["role"], "content": text_of(content)}
+            self._clip(i, max_tokens - len(images) * IMAGE_TOKENS)
+            self.messages[i]["content"] = images + [{"type": "text", "text": self.messages[i]["content"]}]
+            self.counts[i] = None
+            self._count_at(i)
+            return
+        max_tokens = max(max_tokens - self.MSG_OVERHEAD, 16)
+        if not self.llm:
+            keep = max_tokens * 3
+            content = content[: keep // 2] + "\n[...]\n" + content[-keep // 2:]
+        else:
+            tokens = self.llm.tokenize(content.encode("utf-8"), add_bos=False, special=True)
+            tail = min(256, max_tokens // 4)
+            head = max_tokens - tail - 8
+            content = (
+                self.llm.detokenize(tokens[:head]).decode("utf-8", errors="ignore")
+                + "\n[...]\n"
+                + self.llm.detokenize(tokens[-tail:]).decode("utf-8", errors="ignore")
+            )
+        self.messages[i] = {"role": self.messages[i]["role"], "content": content}
+        self.counts[i] = None
+        self._count_at(i)
+
+    # --- Background summarization ---
+    def schedule_summary(self):
+        """Call when a reply finishes; summarizes evicted turns after `idle_delay` seconds"""
+        with self.lock:
+            if self.summarized >= self.start or not self.llm:
+                return
+        self.cancel_summary()
+        self.timer = threading.Timer(self.idle_delay, self._start_summary)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def cancel_summary(self):
+        """Call before a new generation; aborts a summary that is running or pending"""
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if self.summary_job:
+            self.summary_job.cancel("preempted")
+            self.summary_job = None
+
+    def _start_summary(self):
+        if self.worker:
+            # Queued behind a running reply; the next ask() cancels it
+            self.summary_job = self.worker.submit(self._summarize, preempt=False)
+        else:
+            job = self.summary_job = InferenceJob(self._summarize, ())
+            try:
+                self._summarize(job)
+            except GenerationCancelled:
+                pass
+
+    def _summarize(self, job):
+        lock = self.llm_lock
+        if lock and not lock.acquire(blocking=False):
+            return  # model is busy - try again after the next reply
+        try:
+            with self.lock:
+                llm, end = self.llm, self.start
+                evicted = self.messages[self.summarized:end]
+                counts = self.counts[self.summarized:end]
+                previous = self.summary
+            if not evicted:
+                return
+
+            # Newest evicted turns first, until half the context is used
+            room = self.n_ctx // 2
+            lines = []
+            for msg, n in zip(reversed(evicted), reversed(counts)):
+                n = n or self.count(msg["content"])
+                if n > room:
+                    break
+                lines.append(f"{msg['role']}: {text_of(msg['content'])}")
+                room -= n
+            lines.reverse()
+            if previous:
+                lines.insert(0, f"(Earlier summary: {previous})")
+
+            messages = [
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": "\n".join(lines)},
+            ]
+            if getattr(llm, "chat_handler", None) is None:
+                # The prompt in n_batch slices, so a question stops it within one batch;
+                # the completion then only evaluates the last token
+                from prefill import make_formatter, prompt_tokens, eval_prefix
+                eval_prefix(job, llm, prompt_tokens(llm, make_formatter(llm)(messages=messages))[:-1])
+            job.check()
+            stream = llm.create_chat_completion(messages=messages, max_tokens=256, temperature=0.2, stream=True)
+            parts = []
+            try:
+                for chunk in stream:
+                    job.check()
+                    parts.append(chunk["choices"][0]["delta"].get("content", ""))
+            finally:
+                stream.close()
+
+            summary = "".join(parts).strip()
+            with self.lock:
+                if self.llm is llm and summary:
+                    self.summary = summary
+                    self.summary_count = self.count(summary)
+                    self.summarized = end
+        except GenerationCancelled:
+            pass  # evicted turns stay unsummarized until the next idle period
+        except Exception as e:
+            print(f"Summary Error: {e}")
+        finally:
+            if lock:
+                lock.release()
@@ -1,7 +1,8 @@
 import os
-import threading
 import customtkinter as ctk
-from huggingface_hub import hf_hub_download
+from download_queue import Download, DownloadQueue, resolve_hf, progress_text, STATE_SUFFIX
+
+LIMITS = {"Unlimited": None, "10 MB/s": 10, "5 MB/s": 5, "1 MB/s": 1}
 
 class ModelDownloader(ctk.CTk):
     def __init__(self):
@@ -17,7 +18,8 @@ class ModelDownloader(ctk.CTk):
             {"name": "Llama-3.2-1B (Ultra Fast)", "repo": "bartowski/Llama-3.2-1B-Instruct-GGUF", "file": "Llama-3.2-1B-Instruct-Q4_K_M.gguf"},
             {"name": "Qwen-2.5-Coder-1.5B", "repo": "Qwen/Qwen2.5-Coder-1.5B-Instruct-GGUF", "file": "qwen2.5-coder-1.5b-instruct-q4_k_m.gguf"},
             {"name": "Phi-3.5-Mini (Logic)", "repo": "lm-kit/phi-3.5-mini-3.8b-instruct-gguf", "file": "Phi-3.5-mini-Instruct-Q4_K_M.gguf"},
-            {"name": "Moondream2 (Vision)", "repo": "vikhyatk/moondream2", "file": "moondream2.gguf"}
+            {"name": "Moondream2 (Vision)", "repo": "vikhyatk/moondream2", "file": "moondream2-text-model-f16.gguf"},
+            {"name": "Moondream2 image projector (needed for Vision)", "repo": "vikhyatk/moondream2", "file": "moondream2-mmproj-f16.gguf"}
         ]
 
         # UI Components
@@ -26,9 +28,16 @@ class ModelDownloader(ctk.CTk):
         self.scroll_frame = ctk.CTkScrollableFrame(self, width=580, height=320)
         self.scroll_frame.pack(pady=10, padx=20)
 
+        self.queue = DownloadQueue()
+        self.jobs = {}  # file -> Download
         self.buttons = {} # Store buttons to update them after download
         self.render_model_list()
 
+        limit_row = ctk.CTkFrame(self, fg_color="transparent")
+        limit_row.pack()
+        ctk.CTkLabel(limit_row, text="Bandwidth:", font=("Arial", 12)).pack(side="left", padx=5)
+        ctk.CTkOptionMenu(limit_row, values=list(LIMITS), width=120, command=self.set_limit).pack(side="left")
+
         self.status_label = ctk.CTkLabel(self, text="Ready", font=("Arial", 12))
         self.status_label.pack(pady=(10, 0))
 
@@ -36,6 +45,8 @@ class ModelDownloader(ctk.CTk):
         self.progress_bar.set(0)
         self.progress_bar.pack(pady=20)
 
+        self.after(500, self.poll_downloads)
+
     def render_model_list(self):
         """Clears and rebuilds the list to show current file status"""
         for widget in self.scroll_frame.winfo_children():
@@ -50,8 +61,8 @@ class ModelDownloader(ctk.CTk):
             label_text = f"{model['name']}\n({model['file']})"
             ctk.CTkLabel(frame, text=label_text, font=("Arial", 11), justify="left").pack(side="left", padx=10, pady=5)
             
-            # Change button appearance if model exists
-            btn_text = "Installed ✅" if file_exists else "Download"
+            # Change button appearance if model exists; a .part.json means it can resume
+            btn_text = "Installed ✅" if file_exists else "Resume" if os.path.exists(model["file"] + STATE_SUFFIX) else "Download"
             btn_state = "disabled" if file_exists else "normal"
             btn_color = "#2e7d32" if file_exists else "#1f6aa5"
 
@@ -61,46 +72,59 @@ class ModelDownloader(ctk.CTk):
                 width=110,
                 state=btn_state,
                 fg_color=btn_color,
-                command=lambda m=model: self.start_download(m)
+                command=lambda m=model: self.toggle_download(m)
             )
             btn.pack(side="right", padx=10)
             self.buttons[model["file"]] = btn
 
-    def start_download(self, model_data):
-        self.status_label.configure(text=f"Downloading {model_data['file']}...", text_color="white")
-        self.progress_bar.configure(mode="indeterminate")
-        self.progress_bar.start()
-        
-        thread = threading.Thread(target=self.download_engine, args=(model_data,))
-        thread.daemon = True
-        thread.start()
-
-    def download_engine(self, model_data):
-        try:
-            # hf_hub_download handles the download and returns the local path
-            hf_hub_download(
-                repo_id=model_data["repo"],
-                filename=model_data["file"],
-                local_dir=".", 
-                local_dir_use_symlinks=False
-            )
-            
-            # Update UI on completion
-            self.after(0, self.on_download_complete, model_data)
-            
-        except Exception as e:
-            self.after(0, lambda: self.status_label.configure(text=f"Error: {str(e)}", text_color="red"))
-            self.after(0, self.progress_bar.stop)
-
-    def on_download_complete(self, model_data):
-        self.progress_bar.stop()
-        self.progress_bar.set(1.0)
-        self.status_label.configure(text=f"Success! {model_data['name']} is ready.", text_color="#4CAF50")
-        
-        # Update the button specifically for this model
-        btn = self.buttons.get(model_data["file"])
-        if btn:
-            btn.configure(text="Installed ✅", state="disabled", fg_color="#2e7d32")
+    def toggle_download(self, model_data):
+        """Queues the model, or pauses it if it is already queued/downloading (the partial file is kept)"""
+        job = self.jobs.get(model_data["file"])
+        if job and job.status in ("queued", "downloading", "verifying"):
+            self.queue.cancel(job)
+            return
+        job = Download(
+            model_data["file"], model_data["file"],
+            resolver=lambda: resolve_hf(model_data["repo"], model_data["file"]),
+        )
+        if self.queue.add(job):
+            self.jobs[model_data["file"]] = job
+            self.buttons[model_data["file"]].configure(text="Queued (pause)")
+
+    def set_limit(self, choice):
+        mb = LIMITS[choice]
+        self.queue.set_rate(mb * 1024**2 if mb else None)
+
+    # --- Progress (polled on the UI thread; the queue runs on its own threads) ---
+    def poll_downloads(self):
+        active = []
+        for file, job in self.jobs.items():
+            btn = self.buttons.get(file)
+            if job.status == "done":
+                btn.configure(text="Installed ✅", state="disabled", fg_color="#2e7d32")
+            elif job.status == "downloading":
+                btn.configure(text=f"{job.fraction:.0%} (pause)")
+                active.append(job)
+            elif job.status == "verifying":
+                btn.configure(text="Verifying...")
+                active.append(job)
+            elif job.status in ("cancelled", "error"):
+                btn.configure(text="Resume" if os.path.exists(job.state_path) else "Download")
+
+        if active:
+            total = sum(j.size or 0 for j in active)
+            self.progress_bar.set(sum(j.downloaded for j in active) / total if total else 0)
+            self.status_label.configure(text="\n".join(progress_text(j) for j in active), text_color="white")
+        elif self.jobs:
+            last = list(self.jobs.values())[-1]
+            if last.status == "error":
+                self.status_label.configure(text=f"Error: {last.error}", text_color="red")
+            elif all(j.status == "done" for j in self.jobs.values()):
+                self.progress_bar.set(1.0)
+                self.status_label.configure(text="Success! Downloads are verified and ready.", text_color="#4CAF50")
+            else:
+                self.status_label.configure(text="Paused", text_color="white")
+        self.after(500, self.poll_downloads)
 
 if __name__ == "__main__":
     app = ModelDownloader()
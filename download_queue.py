@@ -0,0 +1,326 @@
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+import urllib.request
+import urllib.error
+import http.client
+from collections import deque
+
+SEGMENTS = 4  # parallel range requests per file
+MAX_ACTIVE = 2  # files downloading at once
+CHUNK = 1 << 20
+RETRIES = 5
+STATE_SUFFIX = ".part.json"
+SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+class DownloadError(Exception):
+    pass
+
+
+class DownloadCancelled(Exception):
+    pass
+
+
+def resolve_hf(repo, filename, token=None):
+    """(url, size, sha256) for a file on the Hugging Face Hub.
+
+    For LFS files (every GGUF) the etag is the SHA256 of the content, and
+    `location` is the final CDN URL, which accepts range requests.
+    """
+    from huggingface_hub import get_hf_file_metadata, hf_hub_url
+    meta = get_hf_file_metadata(hf_hub_url(repo, filename), token=token)
+    etag = (meta.etag or "").strip('"').lower()
+    return meta.location, meta.size, etag if SHA256_RE.match(etag) else None
+
+
+class RateLimiter:
+    """Token bucket shared by every segment of every download (bytes/sec, None = unlimited)"""
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.allowance = 0.0
+        self.stamp = time.monotonic()
+
+    def take(self, n):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.allowance + (now - self.stamp) * self.rate, self.rate)
+            self.stamp = now
+            self.allowance -= n
+            wait = -self.allowance / self.rate if self.allowance < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class Download:
+    """One file: parallel range segments into <dest>.part, resumable, SHA256-verified.
+
+    Segment progress is saved next to the partial file, so a dropped connection
+    or a restart of the app continues where each segment stopped.
+    """
+
+    def __init__(self, name, dest, url=None, size=None, sha256=None, resolver=None, segments=SEGMENTS):
+        self.name = name
+        self.dest = dest
+        self.url = url
+        self.size = size
+        self.sha256 = sha256
+        self.resolver = resolver  # () -> (url, size, sha256), called when the job starts
+        self.segments = segments
+
+        self.part = dest + ".part"
+        self.state_path = dest + STATE_SUFFIX
+        self.ranges = []  # [start, end_inclusive, done]
+        self.lock = threading.Lock()
+        self.cancel = threading.Event()
+        self.status = "queued"  # queued / downloading / verifying / done / error / cancelled
+        self.error = None
+        self.started = None
+        self.samples = deque(maxlen=20)  # (time, downloaded) for the speed estimate
+
+    # --- Progress ---
+    @property
+    def downloaded(self):
+        with self.lock:
+            return sum(r[2] for r in self.ranges)
+
+    @property
+    def fraction(self):
+        return self.downloaded / self.size if self.size else 0.0
+
+    @property
+    def speed(self):
+        """Bytes/sec over the last few seconds"""
+        if len(self.samples) < 2:
+            return 0.0
+        (t0, b0), (t1, b1) = self.samples[0], self.samples[-1]
+        return (b1 - b0) / (t1 - t0) if t1 > t0 else 0.0
+
+    @property
+    def eta(self):
+        speed = self.speed
+        return (self.size - self.downloaded) / speed if speed and self.size else None
+
+    def sample(self):
+        self.samples.append((time.monotonic(), self.downloaded))
+
+    # --- Resume state ---
+    def _load_state(self):
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            if state["size"] == self.size and state["sha256"] == self.sha256 and os.path.exists(self.part):
+                return state["ranges"]
+        except (OSError, ValueError, KeyError):
+            pass
+        return None
+
+    def _save_state(self):
+        with self.lock:
+            state = {"size": self.size, "sha256": self.sha256, "ranges": self.ranges}
+        tmp = self.state_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.state_path)
+
+    def _plan(self, ranged):
+        saved = self._load_state()
+        if saved and ranged:
+            self.ranges = saved
+            return
+        n = self.segments if ranged else 1
+        step = max(-(-self.size // n), 1)
+        self.ranges = [[s, min(s + step, self.size) - 1, 0] for s in range(0, self.size, step)]
+        with open(self.part, "wb") as f:
+            f.truncate(self.size)
+
+    # --- Transfer ---
+    def run(self, limiter):
+        self.status = "downloading"
+        self.started = time.monotonic()
+        if self.resolver:
+            self.url, self.size, self.sha256 = self.resolver()
+        if not self.size:
+            self.size = self._probe_size()
+        ranged = self._supports_ranges()
+        self._plan(ranged)
+        self.sample()
+
+        errors = []
+        threads = [
+            threading.Thread(target=self._segment, args=(r, limiter, ranged, errors), daemon=True)
+            for r in self.ranges if r[2] < r[1] - r[0] + 1
+        ]
+        for t in threads:
+            t.start()
+        while any(t.is_alive() for t in threads):
+            time.sleep(0.5)
+            self.sample()
+            self._save_state()
+        self._save_state()
+
+        if errors:
+            raise DownloadError(errors[0])
+        if self.cancel.is_set():
+            raise DownloadCancelled()
+        if self.downloaded != self.size:
+            raise DownloadError(f"{self.name}: incomplete ({self.downloaded} of {self.size} bytes)")
+
+        self.status = "verifying"
+        if self.sha256:
+            digest = hashlib.sha256()
+            with open(self.part, "rb") as f:
+                for block in iter(lambda: f.read(CHUNK * 8), b""):
+                    if self.cancel.is_set():
+                        raise DownloadCancelled()
+                    digest.update(block)
+            if digest.hexdigest() != self.sha256:
+                os.remove(self.part)
+                os.remove(self.state_path)
+                raise DownloadError(f"SHA256 mismatch for {self.name}, the partial file was discarded")
+        os.replace(self.part, self.dest)
+        os.remove(self.state_path)
+        self.status = "done"
+
+    def _request(self, headers=None, method="GET"):
+        req = urllib.request.Request(self.url, headers=headers or {}, method=method)
+        return urllib.request.urlopen(req, timeout=30)
+
+    def _probe_size(self):
+        with self._request(method="HEAD") as r:
+            return int(r.headers["Content-Length"])
+
+    def _supports_ranges(self):
+        try:
+            with self._request({"Range": "bytes=0-0"}) as r:
+                return r.status == 206
+        except urllib.error.URLError:
+            return False
+
+    def _segment(self, rng, limiter, ranged, errors):
+        attempt = 0
+        while rng[2] < rng[1] - rng[0] + 1 and not self.cancel.is_set():
+            if not ranged:
+                with self.lock:
+                    rng[2] = 0  # no ranges: a retry starts the file again
+            start = rng[0] + rng[2]
+            headers = {"Range": f"bytes={start}-{rng[1]}"} if ranged else {}
+            try:
+                with self._request(headers) as r, open(self.part, "r+b") as f:
+                    if ranged and r.status != 206:
+                        raise DownloadError("server ignored the range request")
+                    f.seek(start)
+                    while not self.cancel.is_set():
+                        block = r.read(min(CHUNK, rng[1] - rng[0] + 1 - rng[2]))
+                        if not block:
+                            break
+                        limiter.take(len(block))
+                        f.write(block)
+                        with self.lock:
+                            rng[2] += len(block)
+                        attempt = 0
+            except (OSError, http.client.HTTPException, DownloadError) as e:
+                attempt += 1
+                if attempt > RETRIES:
+                    errors.append(f"{self.name}: {e}")
+                    self.cancel.set()  # the other segments stop too; progress is kept
+                    return
+                time.sleep(min(2 ** attempt, 30))
+
+
+class DownloadQueue:
+    """Runs queued downloads, at most `max_active` at a time, under one bandwidth limit"""
+
+    def __init__(self, max_active=MAX_ACTIVE, rate=None):
+        self.max_active = max_active
+        self.limiter = RateLimiter(rate)
+        self.cond = threading.Condition()
+        self.waiting = deque()
+        self.jobs = []
+        self.active = 0
+
+    def add(self, download):
+        with self.cond:
+            if any(j.dest == download.dest and j.status in ("queued", "downloading", "verifying") for j in self.jobs):
+                return None
+            self.jobs.append(download)
+            self.waiting.append(download)
+            self._start_next()
+        return download
+
+    def cancel(self, download):
+        download.cancel.set()
+        with self.cond:
+            if download in self.waiting:
+                self.waiting.remove(download)
+                download.status = "cancelled"
+
+    def set_rate(self, rate):
+        self.limiter.rate = rate
+
+    def _start_next(self):
+        while self.waiting and self.active < self.max_active:
+            job = self.waiting.popleft()
+            self.active += 1
+            threading.Thread(target=self._run, args=(job,), daemon=True).start()
+
+    def _run(self, job):
+        try:
+            job.run(self.limiter)
+        except DownloadCancelled:
+            job.status = "cancelled"
+        except Exception as e:
+            job.status = "error"
+            job.error = str(e)
+            print(f"Download Error: {e}")
+        finally:
+            with self.cond:
+                self.active -= 1
+                self._start_next()
+                self.cond.notify_all()
+
+    def wait(self):
+        with self.cond:
+            while self.active or self.waiting:
+                self.cond.wait()
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Neptunium model downloads")
+    parser.add_argument("repo", nargs="?", help="Hugging Face repo, e.g. bartowski/Llama-3.2-1B-Instruct-GGUF")
+    parser.add_argument("files", nargs="*", help=".gguf files in the repo")
+    parser.add_argument("--limit", type=float, help="bandwidth limit in MB/s")
+    args = parser.parse_args(argv)
+
+    if not args.repo or not args.files:
+        parser.error("give a repo and at least one file")
+
+    queue = DownloadQueue(rate=args.limit * 1024**2 if args.limit else None)
+    for name in args.files:
+        queue.add(Download(name, name, resolver=lambda n=name: resolve_hf(args.repo, n)))
+    while queue.active or queue.waiting:
+        time.sleep(1)
+        print(" | ".join(progress_text(j) for j in queue.jobs), end="\r", flush=True)
+    print()
+
+
+def progress_text(job):
+    if job.status == "downloading" and job.size:
+        eta = job.eta
+        left = f"{int(eta // 60)}:{int(eta % 60):02d}" if eta is not None else "--:--"
+        return f"{job.name} {job.fraction:.0%} {job.speed / 1024**2:.1f} MB/s ETA {left}"
+    if job.status == "error":
+        return f"{job.name} failed: {job.error}"
+    return f"{job.name} {job.status}"
+
+
+if __name__ == "__main__":
+    main()
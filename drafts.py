@@ -0,0 +1,104 @@
+import numpy as np
+from llama_cpp.llama_speculative import LlamaDraftModel
+
+DRAFT_TOKENS = 8  # proposals per step from a draft model
+MIN_ACCEPTANCE = 0.2  # below this (over a window of proposals) drafting costs more than it saves
+WINDOW = 64
+BACKOFF_STEPS = 64
+
+
+class DraftModel(LlamaDraftModel):
+    """Greedy proposals from a small model that shares the target's vocabulary.
+
+    Its KV cache follows the target's token sequence: every call keeps the
+    common prefix and only evaluates what changed since the last step.
+    """
+
+    def __init__(self, llm, num_pred_tokens=DRAFT_TOKENS):
+        self.llm = llm
+        self.num_pred_tokens = num_pred_tokens
+
+    def __call__(self, input_ids, **kwargs):
+        llm = self.llm
+        n = len(input_ids)
+        room = min(self.num_pred_tokens, llm.n_ctx() - n - 1)
+        if room <= 0:
+            return np.array([], dtype=np.intc)
+
+        cached = llm.input_ids[:min(llm.n_tokens, n)]
+        mismatch = np.flatnonzero(cached != input_ids[:len(cached)])
+        prefix = int(mismatch[0]) if len(mismatch) else len(cached)
+        prefix = min(prefix, n - 1)  # the last token is always re-evaluated for fresh logits
+        llm.n_tokens = prefix
+        llm.eval(input_ids[prefix:].tolist())
+
+        eos = llm.token_eos()
+        out = []
+        while True:
+            token = llm.sample(top_k=1, temp=0.0)
+            if token == eos:
+                break
+            out.append(token)
+            if len(out) >= room:
+                break
+            llm.eval([token])
+        return np.array(out, dtype=np.intc)
+
+
+class CountingDraft(LlamaDraftModel):
+    """Wraps a draft model and counts how many proposals the target accepted.
+
+    llama_cpp does not report acceptance, but it can be inferred: after a step
+    the sequence grows by (accepted proposals + 1 token sampled by the target).
+    When recent acceptance is poor (the text isn't repeating, or the draft
+    disagrees with the target) drafting pauses for a while, so a bad pairing
+    costs little more than plain decoding.
+    """
+
+    def __init__(self, inner, kind):
+        self.inner = inner
+        self.kind = kind
+        self.reset()
+
+    def reset(self):
+        self.proposed = 0
+        self.accepted = 0
+        self.steps = 0
+        self.last_len = 0
+        self.last_token = None
+        self.last_proposed = 0
+        self.window = [0, 0]  # proposed, accepted since the last check
+        self.paused = 0
+
+    def __call__(self, input_ids, **kwargs):
+        n = len(input_ids)
+        if self.last_proposed and n > self.last_len and input_ids[self.last_len - 1] == self.last_token:
+            accepted = min(max(n - self.last_len - 1, 0), self.last_proposed)
+            self.accepted += accepted
+            self.window[1] += accepted
+
+        self.steps += 1
+        if self.paused:
+            self.paused -= 1
+            self.last_proposed = 0
+            return np.array([], dtype=np.intc)
+        if self.window[0] >= WINDOW:
+            if self.window[1] < self.window[0] * MIN_ACCEPTANCE:
+                self.paused = BACKOFF_STEPS
+            self.window = [0, 0]
+
+        proposal = self.inner(input_ids, **kwargs)
+        self.window[0] += len(proposal)
+        self.proposed += len(proposal)
+        self.last_len = n
+        self.last_token = input_ids[-1]
+        self.last_proposed = len(proposal)
+        return proposal
+
+    def snapshot(self):
+        """Counters so far; diff two snapshots to get the numbers for one reply"""
+        return {"proposed": self.proposed, "accepted": self.accepted, "steps": self.steps}
+
+    @property
+    def acceptance(self):
+        return self.accepted / self.proposed if self.proposed else 0.0
@@ -0,0 +1,415 @@
+import os
+import time
+import threading
+from kv_cache import StateCache, cache_key
+from streaming import StreamBuffer
+from context import ContextManager
+from retrieval import DocumentIndex, Embedder, find_embedding_model
+from ingest import DocumentIngestor, IngestCancelled
+from model_pool import ModelPool, warm_pages
+from hardware import HardwareEngine
+from telemetry import MetricsLog, GenerationMetrics, process_snapshot, process_uptime
+from inference import InferenceWorker, GenerationCancelled
+from speculative import get_mode, set_mode, build_draft, OFF
+from catalog import get_catalog, load_last_model, save_last_model
+from response_cache import ResponseCache, TEMPERATURE
+from prefill import Prefill
+from governor import MemoryGovernor, OK
+from vision import (ImageAttachment, ImageEmbeddingCache, is_image, find_projector, make_handler,
+                    has_vision, pick_images, user_content, encode_images)
+
+CACHE_DIR = ".neptunium_cache"
+
+
+def excerpt_count(n_ctx):
+    """Document excerpts per question: one per 1k tokens of context, at least two"""
+    return max(n_ctx // 1024, 2)
+
+
+def document_prompt(excerpts, query):
+    return f"{excerpts}\nQuestion: {query}"
+
+
+def stream_completion(llm, context, stream, max_tokens=None, check=None, on_prompt=None, on_token=None, **sampling):
+    """One completion over the context's window, pushed into `stream` as it decodes.
+
+    on_prompt(prompt_tokens) runs once the prompt is built, check() before each
+    chunk (it raises to stop) and on_token() before each piece of text is pushed.
+    Engine._generate and bench.py both go through here, so the benchmark times
+    the app's own loop.
+    """
+    messages = context.build()
+    if on_prompt:
+        on_prompt(context.prompt_tokens)
+    completion = llm.create_chat_completion(
+        messages=messages, max_tokens=max_tokens or context.reserve, stream=True, **sampling
+    )
+    try:
+        for chunk in completion:
+            if check:
+                check()
+            delta = chunk["choices"][0]["delta"]
+            if delta.get("content"):
+                if on_token:
+                    on_token()
+                stream.push(delta["content"])
+    finally:
+        completion.close()
+
+
+class Engine:
+    """Everything between a front-end and llama_cpp: hardware sizing, the model
+    pool and caches, attachments, background prefill and the generation loop.
+
+    Owns no widgets. Methods marked (UI thread) are meant for the front-end's
+    event loop; callbacks handed to the engine run on background threads, so
+    each front-end forwards them to its own loop (Tk after(), Qt signals).
+    Replies stream through a StreamBuffer, which a UI polls once per frame and
+    scripts can iterate (for / async for).
+    """
+
+    def __init__(self, on_memory=None):
+        self.specs = HardwareEngine.get_specs()
+        # Start reading the last model's weights now; llama_cpp is imported later, on a thread
+        self.last_model = load_last_model()
+        if self.last_model:
+            threading.Thread(target=warm_pages, args=(self.last_model,), daemon=True).start()
+        self.context = ContextManager(n_ctx=self.specs["ctx"])
+        self.llm_lock = threading.Lock()  # one user of the model at a time
+        self.active_doc = None  # stays attached; each question pulls its own excerpts
+        self.doc_cancel = threading.Event()
+        self.ingestor = DocumentIngestor(os.path.join(CACHE_DIR, "text"))
+        self.embedder = None  # built from the current model unless a dedicated embedding GGUF is found
+        self.embedder_lock = threading.Lock()
+        self.llm = None
+        self.model_name = None
+        self.requested_model = None
+        self.pool = ModelPool(self._create_llm, self.specs["model_pool"], self.specs["ctx"])
+        self.state_cache = StateCache(
+            ram_bytes=self.specs["state_cache"],
+            disk_dir=os.path.join(CACHE_DIR, "states"),
+            disk_bytes=self.specs["state_cache"] * 4
+        )
+        self.metrics = MetricsLog(os.path.join(CACHE_DIR, "metrics.jsonl"))
+        self.response_cache = ResponseCache(os.path.join(CACHE_DIR, "responses"))
+        self.image_cache = ImageEmbeddingCache(os.path.join(CACHE_DIR, "images"))
+        # Re-checks free RAM every second; on_memory(level, text) says what was limited
+        self.governor = MemoryGovernor(self.pool, self.state_cache, self.context, self.metrics, on_change=on_memory)
+        self.worker = InferenceWorker()  # every generation runs here, one at a time
+        self.prefill = Prefill()
+        self.prefill_job = None
+        self.prefilled = (None, 0)  # (document, tokens) the last finished prefill left in the KV
+        self.plain_tps = {}  # model -> decode tok/s without speculation (speedup baseline)
+        self.catalog = get_catalog()
+
+    def started(self):
+        """(UI thread) Logs how long the window took to come up"""
+        self.metrics.write("startup", ui_ready_s=round(process_uptime(), 3), **process_snapshot())
+
+    # --- Models ---
+    def check_fit(self, model_name):
+        """(fits, bytes needed) at the context this machine would give the model"""
+        logits_all = self._logits_all(model_name)
+        n_ctx = HardwareEngine.engine_params(model_name, self.specs, logits_all)["n_ctx"]
+        return HardwareEngine.check_fit(model_name, n_ctx, logits_all)
+
+    def load(self, model_name, on_ready, on_error):
+        """(UI thread) Loads on a thread. on_ready(model_name, load_s) once it is the
+        current model (skipped if another was picked meanwhile), on_error(e) on failure"""
+        self.requested_model = model_name
+        self.cancel_prefill()
+        self.worker.stop()  # frees the model lock within one decode step
+        threading.Thread(target=self._load, args=(model_name, on_ready, on_error), daemon=True).start()
+
+    def _load(self, model_name, on_ready, on_error):
+        try:
+            # Instant if the model is still resident; a running generation keeps
+            # its own model until it finishes
+            t0 = time.perf_counter()
+            resident = model_name in self.pool.resident()
+            llm = self.pool.get(model_name)
+            load_s = time.perf_counter() - t0
+            self.metrics.write("load", model=os.path.basename(model_name), load_s=round(load_s, 3),
+                               resident=resident, n_ctx=llm.n_ctx(), **process_snapshot())
+            if model_name != self.requested_model: return  # user already picked another
+
+            with self.llm_lock:
+                self.llm = llm
+                self.model_name = model_name
+                self.context.attach(self.llm, self.llm.n_ctx(), self.llm_lock, self.worker)
+            if self.embedder and self.embedder.model_path != (find_embedding_model() or model_name):
+                # The old model's embedder would keep its weights mapped outside the pool
+                threading.Thread(target=self._reindex, args=(self.active_doc,), daemon=True).start()
+            self.governor.set_model(model_name, llm)
+            save_last_model(model_name)
+            on_ready(model_name, load_s)
+
+            if self.specs["preload"] and self.governor.level == OK:
+                self.pool.prefetch(self.pool.likely_next(model_name))
+        except Exception as e:
+            print(f"Engine Error: {e}")
+            on_error(e)
+
+    def _create_llm(self, model_name):
+        from llama_cpp import Llama  # first model use, not start-up
+        # Calibrated settings for this machine + model if `python hardware.py model.gguf` was run;
+        # otherwise n_ctx is sized to the pool budget (which the memory governor may have cut)
+        # A vision model's projector (mmproj) is found next to it; its chat handler encodes images
+        projector = find_projector(model_name)
+        handler = make_handler(model_name, projector, self.image_cache) if projector else None
+        mode = get_mode(model_name) if not projector else OFF
+        params = HardwareEngine.engine_params(model_name, dict(self.specs, model_pool=self.pool.budget), mode != OFF)
+        # Speculative decoding needs logits for every drafted position
+        llm = Llama(model_path=model_name, verbose=False, logits_all=mode != OFF, chat_handler=handler, **params)
+        if mode != OFF:
+            llm.draft_model = build_draft(mode, llm, lambda path: Llama(
+                model_path=path, n_ctx=llm.n_ctx(), n_threads=params["n_threads"],
+                n_gpu_layers=params["n_gpu_layers"], verbose=False
+            ))
+        # Reuses evaluated prompt prefixes across turns, conversations and model switches
+        # (not for vision models: their handler re-evaluates the whole prompt every time)
+        if not projector:
+            llm.set_cache(self.state_cache.for_model(cache_key(model_name, llm)))
+        return llm
+
+    @staticmethod
+    def _logits_all(model_name):
+        """Speculative models keep n_ctx x n_vocab logits, which the sizing has to count"""
+        return get_mode(model_name) != OFF and not find_projector(model_name)
+
+    def set_speculative(self, mode):
+        """(UI thread) The draft is wired in when the model is built, so the model is
+        dropped from the pool; returns the model to load again (None if there is none)"""
+        if not self.model_name: return None
+        set_mode(self.model_name, mode)
+        self.worker.stop()
+        self.pool.discard(self.model_name)
+        return self.model_name
+
+    # --- Attachments ---
+    def detach(self):
+        """(UI thread) Drops the attachment and stops any work on it; returns the
+        cancel event for the next one"""
+        self.doc_cancel.set()
+        self.cancel_prefill()
+        if self.active_doc:
+            self.active_doc.cancelled = True
+        self.active_doc = None
+        self.doc_cancel = threading.Event()
+        return self.doc_cancel
+
+    def attach(self, doc, cancel):
+        """(UI thread) Makes `doc` what questions are asked about, unless it was detached meanwhile"""
+        if cancel.is_set():
+            return False
+        self.active_doc = doc
+        return True
+
+    def ingest(self, path, cancel, on_attach, progress=None):
+        """(Background thread) Reads and indexes a file or picture.
+
+        on_attach(doc) comes as soon as the text is in (keyword search already
+        works), progress(stage, i, n) while "page"s are read and "index" chunks
+        are embedded. Returns the document, None if cancelled; errors are raised.
+        Extraction (process pool for big PDFs, cached by content hash) and
+        indexing both run here so the window never blocks on a large file.
+        """
+        progress = progress or (lambda stage, i, n: None)
+        if is_image(path):
+            doc = ImageAttachment(path)  # encoded later, through the prefill path
+            on_attach(doc)
+            return doc
+        filename = os.path.basename(path)
+        t0 = time.perf_counter()
+        try:
+            content = self.ingestor.extract(path, progress=lambda i, n: progress("page", i, n), cancel=cancel)
+            doc = DocumentIndex(path, content)
+            doc.images = self.ingestor.page_images(path)
+        except IngestCancelled:
+            return None
+        except Exception as e:
+            self.metrics.write("document", file=filename, error=str(e))
+            raise
+        extract_s = time.perf_counter() - t0
+
+        on_attach(doc)
+        if cancel.is_set(): return None
+        t0 = time.perf_counter()
+        try:
+            doc.embedder = self.get_embedder()
+        except Exception as e:
+            print(f"Embedder Error: {e}")  # keyword search still works
+        doc.build(progress=lambda i, n: progress("index", i, n))
+        self.metrics.write("document", file=filename, bytes=os.path.getsize(path), chars=len(content),
+                           chunks=len(doc.chunks), extract_s=round(extract_s, 3),
+                           index_s=round(time.perf_counter() - t0, 3), embedded=doc.vectors is not None,
+                           **process_snapshot())
+        return None if cancel.is_set() else doc
+
+    def get_embedder(self):
+        """(Background thread) The embedder for the current model, rebuilt after a model switch"""
+        path = find_embedding_model() or self.model_name
+        with self.embedder_lock:
+            if self.embedder is None or self.embedder.model_path != path:
+                self.embedder = None  # the old instance goes before the new one loads
+                self.embedder = Embedder(path, self.specs["cores"])
+            return self.embedder
+
+    def _reindex(self, doc):
+        # Background thread: moves the attached document to the new embedder (a saved
+        # index is just reloaded); keyword search covers the gap
+        if isinstance(doc, DocumentIndex) and doc.embedder is not None:
+            doc.vectors, doc.embedder = None, None
+        try:
+            embedder = self.get_embedder()
+        except Exception as e:
+            print(f"Embedder Error: {e}")
+            return
+        if isinstance(doc, DocumentIndex) and doc is self.active_doc:
+            doc.embedder = embedder
+            doc.build()
+
+    def excerpts(self, doc, query):
+        return doc.context_for(query, excerpt_count(self.specs["ctx"]))
+
+    # --- Background prefill ---
+    def can_prefill(self):
+        return bool(self.active_doc and self.llm)
+
+    def start_prefill(self, partial):
+        """(UI thread) Evaluates the document part of the next prompt for the question typed so far"""
+        if not self.active_doc or not self.model_name: return
+        if self.prefill_job:
+            self.prefill_job.cancel("superseded")
+        # Queued behind a running reply; asking, detaching and model switches cancel it
+        self.prefill_job = self.worker.submit(self._prefill, self.active_doc, self.model_name, partial,
+                                              preempt=False)
+
+    def cancel_prefill(self):
+        if self.prefill_job:
+            self.prefill_job.cancel("cancelled")
+            self.prefill_job = None
+
+    def _prefill(self, job, doc, model_name, partial):
+        # Inference worker: the excerpts the question typed so far would pull in,
+        # evaluated up to where the question itself starts
+        t0 = time.perf_counter()
+        try:
+            job.check()
+            excerpts = self.excerpts(doc, partial)
+            with self.llm_lock, self.pool.lease(model_name) as llm:
+                if model_name != self.model_name or doc is not self.active_doc: return
+                if has_vision(llm):
+                    # The vision handler re-evaluates every prompt; what can be done early is the images
+                    if doc.images:
+                        stats = encode_images(llm, pick_images(doc.images, excerpts), job.check)
+                        self.metrics.write("image", model=os.path.basename(model_name), **stats,
+                                           seconds=round(time.perf_counter() - t0, 3))
+                    return
+                if llm.chat_handler is not None:
+                    return  # a stock vision handler (no mtmd API): nothing can be done early
+                evaluated, cached = self.prefill.run(
+                    job, llm, model_name, lambda q: self.context.preview(document_prompt(excerpts, q))
+                )
+            self.prefilled = (doc, evaluated + cached)
+            self.metrics.write("prefill", model=os.path.basename(model_name), evaluated=evaluated, cached=cached,
+                               seconds=round(time.perf_counter() - t0, 3))
+        except GenerationCancelled as e:
+            self.prefilled = (None, 0)  # partly evaluated; the prefix match still reuses it
+            self.metrics.write("prefill", model=os.path.basename(model_name), cancelled=e.reason,
+                               seconds=round(time.perf_counter() - t0, 3))
+        except Exception as e:
+            print(f"Prefill Error: {e}")
+
+    # --- Generation ---
+    def ask(self, query, on_done=None):
+        """(UI thread) Queues a reply about the attached document, preempting the one
+        still running. Returns its StreamBuffer; on_done(stream) is called from the
+        inference worker once the stream is closed"""
+        self.context.cancel_summary()
+        stream = StreamBuffer()
+        stream.metrics = GenerationMetrics(self.model_name)
+        if self.active_doc and self.prefilled[0] is self.active_doc:
+            stream.metrics.prefilled = self.prefilled[1]
+        self.cancel_prefill()
+        self.worker.submit(self._generate, stream, query, self.active_doc, on_done)
+        return stream
+
+    def stop(self):
+        self.worker.stop()
+
+    def finished(self, stream):
+        """(UI thread) Logs a reply; called after its last frame is drawn so that frame's lag counts"""
+        self.metrics.write("generation", document=bool(self.active_doc), stopped=stream.stopped,
+                           memory=self.governor.level, **stream.metrics.record(stream.error))
+        if not stream.metrics.draft and stream.metrics.tokens > 16:
+            self.plain_tps[stream.metrics.model] = stream.metrics.decode_tps
+
+    def _generate(self, job, stream, query, doc, on_done):
+        # Inference worker: never touches the UI, just hands tokens to the buffer
+        metrics = stream.metrics
+        answering = False
+        turn = None
+        try:
+            job.check()
+            question = query
+            # Retrieval embeds the question, so it stays off the UI thread too
+            if doc:
+                excerpts = self.excerpts(doc, query)
+                query = document_prompt(excerpts, query)
+                if doc.images and has_vision(self.llm):
+                    query = user_content(query, pick_images(doc.images, excerpts))
+            job.check()
+
+            cache_key = None
+            if self.response_cache.enabled:
+                params = {"temperature": TEMPERATURE, "max_tokens": self.context.reserve}
+                cache_key = ResponseCache.key(self.model_name, params, question,
+                                              doc.digest if doc else None, self.context.history_digest())
+                metrics.prompt_ready(0)
+                cached = self.response_cache.get(cache_key)
+                metrics.cache_lookup(cached is not None, self.response_cache.stats()["hit_rate"])
+                if cached is not None:
+                    # Served through the same buffer, so the UI path is the normal one
+                    turn = self.context.add("user", query)
+                    metrics.token()
+                    stream.push(cached)
+                    self.context.add("assistant", cached)
+                    stream.close()
+                    return
+            turn = self.context.add("user", query)
+            answering = True
+
+            # The lock keeps model swaps out; the lease keeps the pool from evicting it
+            with self.llm_lock, self.pool.lease(self.model_name) as llm:
+                if llm.draft_model is not None:
+                    metrics.speculative(llm.draft_model, self._baseline_tps(self.model_name))
+                sampling = {"temperature": TEMPERATURE} if cache_key else {}
+                # job.check: stop / preempt / timeout land within one decode step
+                stream_completion(llm, self.context, stream, check=job.check,
+                                  on_prompt=metrics.prompt_ready, on_token=metrics.token, **sampling)
+            if cache_key and stream.text:
+                self.response_cache.put(cache_key, stream.text)
+            self.context.add("assistant", stream.text)
+            answering = False
+            self.context.schedule_summary()
+            stream.close()
+        except GenerationCancelled as e:
+            if answering:
+                self.context.add("assistant", stream.text)  # keep the history in user/assistant pairs
+            stream.close(stopped=e.reason)
+        except Exception as e:
+            if answering:
+                self.context.add("assistant", stream.text)
+            stream.close(error=e)
+        finally:
+            if doc and turn is not None:
+                # Excerpts serve one question: later turns keep only the question itself,
+                # so the history (and every prompt after it) doesn't grow by k chunks a turn
+                self.context.replace(turn, question)
+            if on_done:
+                on_done(stream)
+
+    def _baseline_tps(self, model_name):
+        profile = HardwareEngine.load_profile(model_name) or {}
+        return self.plain_tps.get(os.path.basename(model_name)) or profile.get("decode_tps")
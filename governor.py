@@ -0,0 +1,188 @@
+import sys
+import time
+import threading
+import psutil
+from catalog import kv_bytes
+
+INTERVAL = 1.0  # seconds between samples
+OK, TIGHT, CRITICAL = "ok", "tight", "critical"
+
+# Available RAM below min(share of total, bytes) counts as pressure
+TIGHT_SHARE, TIGHT_BYTES = 0.15, 2 * 1024**3
+CRITICAL_SHARE, CRITICAL_BYTES = 0.07, 1024**3
+SWAP_IN_MBPS = 4.0  # sustained swap-in above this is thrashing, whatever `available` says
+RECOVER_SAMPLES = 10  # calm samples in a row before the limits are lifted
+MIN_WINDOW = 512
+# Share of the available RAM the next prompt's KV may grow into. A finished
+# reply's KV is also snapshotted into the state cache, so each token costs ~2x
+KV_SHARE = {TIGHT: 0.25, CRITICAL: 0.1}
+
+
+def sample(last=None):
+    """Available/total RAM, this process's RSS and the swap-in rate since `last`"""
+    vm = psutil.virtual_memory()
+    now = time.monotonic()
+    try:
+        swapped_in = psutil.swap_memory().sin  # cumulative bytes; 0 where the OS doesn't say
+    except (RuntimeError, OSError):
+        swapped_in = 0
+    swap_in_mbps = 0.0
+    if last and now > last["t"]:
+        swap_in_mbps = max(swapped_in - last["swapped_in"], 0) / 1024**2 / (now - last["t"])
+    return {
+        "t": now,
+        "available": vm.available,
+        "total": vm.total,
+        "rss": psutil.Process().memory_info().rss,
+        "swapped_in": swapped_in,
+        "swap_in_mbps": swap_in_mbps,
+    }
+
+
+def assess(s, swapping):
+    """Pressure level for a sample; `swapping`: swap-in stayed high for two samples"""
+    if s["available"] < min(CRITICAL_SHARE * s["total"], CRITICAL_BYTES):
+        return CRITICAL
+    if s["available"] < min(TIGHT_SHARE * s["total"], TIGHT_BYTES):
+        return CRITICAL if swapping else TIGHT
+    return TIGHT if swapping else OK
+
+
+class MemoryGovernor:
+    """Watches available RAM, swap-in activity and RSS on a background thread, and
+    backs off before the machine starts swapping.
+
+    "tight": resident states in the state cache move to its disk tier, the pool's
+    budget shrinks to what is resident plus half the free RAM, and the next
+    request's context window is capped to what its KV can grow into. "critical"
+    (or sustained swap-in) also unloads every model that isn't the current one
+    or in use, and caps the window harder. The limits are lifted after
+    RECOVER_SAMPLES calm samples. Every change is logged as a "memory" event and
+    reported through on_change(level, text) so the UI can show it.
+    """
+
+    def __init__(self, pool, state_cache, context, metrics=None, on_change=None, interval=INTERVAL):
+        self.pool = pool
+        self.state_cache = state_cache
+        self.context = context
+        self.metrics = metrics
+        self.on_change = on_change or (lambda level, text: None)
+        self.interval = interval
+
+        self.base_budget = pool.budget
+        self.base_states = state_cache.ram_bytes
+        self.current = None  # the model the UI has selected (never unloaded)
+        self.kv_per_token = None
+        self.level = OK
+        self.text = ""
+        self.last = None
+        self.swap_samples = 0
+        self.calm = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="memory-governor", daemon=True)
+        self.thread.start()
+
+    def set_model(self, name, llm):
+        self.current = name
+        self.kv_per_token = kv_bytes(getattr(llm, "metadata", None) or {}, 1)
+
+    def stop(self):
+        self.stopped.set()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.step()
+            except Exception as e:
+                print(f"Memory governor Error: {e}")
+
+    # --- Policy ---
+    def step(self, s=None):
+        s = s or sample(self.last)
+        self.last = s
+        self.swap_samples = self.swap_samples + 1 if s["swap_in_mbps"] >= SWAP_IN_MBPS else 0
+        level = assess(s, self.swap_samples >= 2)
+        if level == OK:
+            self.calm += 1
+            if self.level != OK and self.calm >= RECOVER_SAMPLES:
+                self._relax(s)
+            return self.level
+        self.calm = 0
+        if self.level == CRITICAL and level == TIGHT:
+            level = CRITICAL  # stays until things are calm, not just less bad
+        self._throttle(level, s)
+        return self.level
+
+    def window_cap(self, level, s):
+        """Largest context window whose KV fits in the RAM the level allows"""
+        if self.kv_per_token:
+            in_kv = self.context.prompt_tokens  # already resident
+            cap = in_kv + int(s["available"] * KV_SHARE[level]) // self.kv_per_token
+        else:
+            cap = self.context.n_ctx // (2 if level == TIGHT else 4)
+        return max(MIN_WINDOW, min(self.context.n_ctx, cap // 256 * 256))
+
+    def _throttle(self, level, s):
+        actions = []
+        moved = self.state_cache.stats()["ram_mb"]
+        self.state_cache.set_ram_limit(0)
+        if moved:
+            actions.append(f"moved {moved:.0f} MB of cached states to disk")
+
+        budget = min(self.base_budget, self.pool.used + s["available"] // 2)
+        if budget < self.pool.budget:
+            before = len(self.pool.resident())
+            self.pool.set_budget(budget)
+            unloaded = before - len(self.pool.resident())
+            if unloaded:
+                actions.append(f"unloaded {unloaded} model(s) over budget")
+        if level == CRITICAL:
+            before = len(self.pool.resident())
+            self.pool.evict_idle(keep=self.current)
+            unloaded = before - len(self.pool.resident())
+            if unloaded:
+                actions.append(f"unloaded {unloaded} idle model(s)")
+
+        cap = self.window_cap(level, s)
+        if cap < self.context.window:
+            self.context.limit = cap
+            actions.append(f"context capped at {cap} tokens")
+
+        swapping = self.swap_samples >= 2
+        text = (f"⚠ Low memory ({s['available'] / 1024**3:.1f} GB free{', swapping' if swapping else ''}): "
+                f"context {self.context.window} tok")
+        if level != self.level or actions or text != self.text:
+            self._report(level, text, s, actions)
+
+    def _relax(self, s):
+        self.context.limit = None
+        self.pool.set_budget(self.base_budget)
+        self.state_cache.set_ram_limit(self.base_states)
+        self._report(OK, "", s, ["limits lifted"])
+
+    def _report(self, level, text, s, actions):
+        changed, level_changed = text != self.text, level != self.level
+        self.level, self.text = level, text
+        if self.metrics and (actions or level_changed):
+            self.metrics.write("memory", level=level, actions=actions,
+                               available_mb=round(s["available"] / 1024**2), rss_mb=round(s["rss"] / 1024**2),
+                               swap_in_mbps=round(s["swap_in_mbps"], 2), window=self.context.window)
+        if changed:
+            self.on_change(level, text)
+
+
+if __name__ == "__main__":
+    # python governor.py: prints what the governor would see, once a second
+    last = None
+    swap_samples = 0
+    try:
+        while True:
+            s = sample(last)
+            last = s
+            swap_samples = swap_samples + 1 if s["swap_in_mbps"] >= SWAP_IN_MBPS else 0
+            print(f"{assess(s, swap_samples >= 2):8} | {s['available'] / 1024**3:6.2f} of {s['total'] / 1024**3:.1f} GB free"
+                  f" | swap-in {s['swap_in_mbps']:6.2f} MB/s")
+            sys.stdout.flush()
+            time.sleep(INTERVAL)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,254 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import platform
+import threading
+import psutil
+from catalog import get_catalog, footprint
+
+CACHE_DIR = ".neptunium_cache"
+PROFILE_PATH = os.path.join(CACHE_DIR, "profiles.json")
+
+CALIBRATION_TEXT = (
+    "Neptunium runs large language models locally. This paragraph is only used to "
+    "measure how fast the current machine evaluates prompts and generates tokens. "
+)
+
+
+class HardwareEngine:
+    @staticmethod
+    def get_specs():
+        ram_gb = round(psutil.virtual_memory().total / (1024**3))
+        cores = os.cpu_count() or 4
+        is_mac = platform.system() == "Darwin"
+
+        # Heuristic for local LLM settings (used until a model has been calibrated)
+        ctx_limit = 4096 if ram_gb > 8 else 2048
+        offload = -1 if ram_gb > 12 else 0 # -1 uses all GPU layers if available
+
+        # Saved prompt states (KV cache snapshots) may use ~1/8 of RAM, disk gets 4x that
+        state_cache = max(ram_gb // 8, 1) * 1024**3
+        # Resident models (mmap'd weights + KV) may use half of RAM
+        model_pool = max(ram_gb // 2, 1) * 1024**3
+
+        return {
+            "ram": ram_gb,
+            "cores": max(cores - 2, 1),
+            "ctx": ctx_limit,
+            "offload": offload,
+            "state_cache": state_cache,
+            "model_pool": model_pool,
+            "preload": ram_gb > 8,
+            "desc": f"{platform.system()} | {ram_gb}GB RAM"
+        }
+
+    # --- Calibrated profiles ---
+    @staticmethod
+    def machine_id():
+        ram_gb = round(psutil.virtual_memory().total / (1024**3))
+        raw = f"{platform.node()}|{platform.machine()}|{platform.processor()}|{os.cpu_count()}|{ram_gb}"
+        return hashlib.sha1(raw.encode()).hexdigest()[:16]
+
+    @staticmethod
+    def model_key(model_path):
+        return f"{os.path.basename(model_path)}|{os.path.getsize(model_path)}"
+
+    @staticmethod
+    def _read_profiles():
+        try:
+            with open(PROFILE_PATH, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def load_profile(model_path):
+        profiles = HardwareEngine._read_profiles()
+        return profiles.get(HardwareEngine.machine_id(), {}).get(HardwareEngine.model_key(model_path))
+
+    @staticmethod
+    def save_profile(model_path, profile):
+        profiles = HardwareEngine._read_profiles()
+        profiles.setdefault(HardwareEngine.machine_id(), {})[HardwareEngine.model_key(model_path)] = profile
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(PROFILE_PATH, "w", encoding="utf-8") as f:
+            json.dump(profiles, f, indent=2)
+
+    @staticmethod
+    def engine_params(model_path, specs, logits_all=False):
+        """Llama() keyword arguments: the measured profile if there is one, else the
+        heuristic sized from the model's GGUF header"""
+        params = {
+            "n_gpu_layers": specs["offload"],
+            "n_threads": specs["cores"],
+            "n_ctx": specs["ctx"],
+        }
+        profile = HardwareEngine.load_profile(model_path)
+        if profile:
+            params.update(profile["params"])
+            return params
+        entry = get_catalog().entry(model_path)
+        if entry:
+            params["n_ctx"] = HardwareEngine.fit_ctx(entry, specs["ctx"], specs["model_pool"], logits_all)
+        return params
+
+    @staticmethod
+    def fit_ctx(entry, ctx, budget, logits_all=False):
+        """Largest context up to `ctx` that the model was trained for and whose KV fits the budget"""
+        n_ctx = min(ctx, int(entry["context_length"] or ctx))
+        while n_ctx > 512 and footprint(entry, n_ctx, logits_all) > budget:
+            n_ctx //= 2
+        return n_ctx
+
+    @staticmethod
+    def check_fit(model_path, n_ctx, logits_all=False):
+        """(fits, bytes needed): refuses models whose weights + KV exceed physical RAM"""
+        entry = get_catalog().entry(model_path)
+        if not entry:
+            return True, None
+        need = footprint(entry, min(n_ctx, int(entry["context_length"] or n_ctx)), logits_all)
+        return need <= psutil.virtual_memory().total, need
+
+    # --- Calibration ---
+    @staticmethod
+    def measure(model_path, params, prompt_tokens=256, decode_tokens=32):
+        """Loads the model with `params` and times one prefill and a short decode"""
+        from llama_cpp import Llama
+
+        proc = psutil.Process()
+        peak = [proc.memory_info().rss]
+        done = threading.Event()
+
+        def sample_rss():
+            while not done.wait(0.02):
+                peak[0] = max(peak[0], proc.memory_info().rss)
+
+        sampler = threading.Thread(target=sample_rss, daemon=True)
+        sampler.start()
+        try:
+            t0 = time.perf_counter()
+            llm = Llama(model_path=model_path, verbose=False, **params)
+            load_s = time.perf_counter() - t0
+
+            text = CALIBRATION_TEXT
+            tokens = llm.tokenize(text.encode("utf-8"))
+            while len(tokens) < prompt_tokens:
+                text += CALIBRATION_TEXT
+                tokens = llm.tokenize(text.encode("utf-8"))
+            tokens = tokens[:min(prompt_tokens, llm.n_ctx() - decode_tokens - 1)]
+
+            t0 = time.perf_counter()
+            llm.eval(tokens)
+            prompt_s = time.perf_counter() - t0
+
+            # Decode speed = one token per eval, which is what generation does
+            t0 = time.perf_counter()
+            for i in range(decode_tokens):
+                llm.eval([tokens[i % len(tokens)]])
+            decode_s = time.perf_counter() - t0
+            arch = llm.metadata.get("general.architecture")
+            n_ctx_train = int(llm.metadata.get(f"{arch}.context_length", 0))
+            del llm
+        finally:
+            done.set()
+            sampler.join()
+
+        return {
+            "params": dict(params),
+            "load_s": round(load_s, 3),
+            "prompt_tps": round(len(tokens) / prompt_s, 1),
+            "decode_tps": round(decode_tokens / decode_s, 1),
+            "peak_rss_mb": round(peak[0] / 1024**2),
+            "n_ctx_train": n_ctx_train,
+        }
+
+    @staticmethod
+    def calibrate(model_path, specs=None, progress=None, save=True):
+        """Grid-searches threads, batch sizes, flash attention and n_ctx for one model.
+
+        Decode and prompt threads are tuned separately (decode is memory-bound and
+        often peaks below the core count, prefill is compute-bound). n_ctx is the
+        largest candidate up to the trained context whose peak RSS stays within
+        half of the available RAM.
+        """
+        specs = specs or HardwareEngine.get_specs()
+        logical = os.cpu_count() or 4
+        physical = psutil.cpu_count(logical=False) or logical
+        thread_grid = sorted({max(n, 1) for n in (physical // 2, physical - 1, physical, logical - 2, logical)})
+        batch_grid = [128, 256, 512, 1024]
+        ctx_grid = [2048, 4096, 8192, 16384]
+
+        trials = []
+        log = progress or (lambda msg: None)
+
+        def run(params):
+            result = HardwareEngine.measure(model_path, params)
+            trials.append(result)
+            log(f"{params} -> prompt {result['prompt_tps']} t/s, decode {result['decode_tps']} t/s, "
+                f"{result['peak_rss_mb']} MB")
+            return result
+
+        base = {"n_gpu_layers": specs["offload"], "n_ctx": 2048, "n_batch": 512, "n_ubatch": 512}
+
+        # 1. Threads
+        by_threads = [run(dict(base, n_threads=t, n_threads_batch=t)) for t in thread_grid]
+        best_decode = max(by_threads, key=lambda r: r["decode_tps"])["params"]["n_threads"]
+        best_prompt = max(by_threads, key=lambda r: r["prompt_tps"])["params"]["n_threads_batch"]
+        base.update(n_threads=best_decode, n_threads_batch=best_prompt)
+
+        # 2. Batch size (only matters for prefill)
+        by_batch = [run(dict(base, n_batch=b, n_ubatch=min(b, 512))) for b in batch_grid]
+        best = max(by_batch, key=lambda r: r["prompt_tps"])["params"]
+        base.update(n_batch=best["n_batch"], n_ubatch=best["n_ubatch"])
+
+        # 3. Flash attention (not every backend/model supports it)
+        try:
+            fa = run(dict(base, flash_attn=True))
+            plain = max(by_batch, key=lambda r: r["prompt_tps"])
+            if fa["prompt_tps"] + fa["decode_tps"] > plain["prompt_tps"] + plain["decode_tps"]:
+                base["flash_attn"] = True
+        except Exception as e:
+            log(f"flash_attn unavailable: {e}")
+
+        # 4. Largest context that fits (and that the model was trained for)
+        budget_mb = psutil.virtual_memory().available / 1024**2 * 0.5
+        n_ctx_train = trials[0]["n_ctx_train"] or max(ctx_grid)
+        chosen = None
+        for n_ctx in [c for c in ctx_grid if c <= n_ctx_train] or [min(ctx_grid)]:
+            try:
+                result = run(dict(base, n_ctx=n_ctx))
+            except Exception as e:
+                log(f"n_ctx={n_ctx} failed: {e}")
+                break
+            if result["peak_rss_mb"] > budget_mb:
+                break
+            chosen = result
+        if chosen is None:
+            chosen = run(dict(base, n_ctx=specs["ctx"]))
+
+        profile = {
+            "params": chosen["params"],
+            "prompt_tps": chosen["prompt_tps"],
+            "decode_tps": chosen["decode_tps"],
+            "peak_rss_mb": chosen["peak_rss_mb"],
+            "heuristic_threads": specs["cores"],
+            "measured": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "trials": trials,
+        }
+        if save:
+            HardwareEngine.save_profile(model_path, profile)
+        return profile
+
+
+if __name__ == "__main__":
+    # python hardware.py model.gguf [model2.gguf ...]
+    if len(sys.argv) < 2:
+        print("Usage: python hardware.py <model.gguf> [...]")
+        sys.exit(1)
+    for path in sys.argv[1:]:
+        print(f"Calibrating {path} ...")
+        profile = HardwareEngine.calibrate(path, progress=print)
+        print(f"Best for {os.path.basename(path)}: {profile['params']}")
+        print(f"  prompt {profile['prompt_tps']} t/s | decode {profile['decode_tps']} t/s | {profile['peak_rss_mb']} MB")
@@ -0,0 +1,105 @@
+import time
+import threading
+from collections import deque
+
+GENERATION_TIMEOUT = 300  # seconds; a reply still running after this is stopped
+
+
+class GenerationCancelled(Exception):
+    def __init__(self, reason="stopped"):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class InferenceJob:
+    """Handle for one queued generation. The job function calls check() once per
+    token, so stop()/a timeout takes effect at the next decode step."""
+
+    def __init__(self, fn, args, timeout=GENERATION_TIMEOUT):
+        self.fn = fn
+        self.args = args
+        self.timeout = timeout
+        self.deadline = None
+        self.cancelled = threading.Event()
+        self.reason = None
+        self.done = threading.Event()
+
+    def cancel(self, reason="stopped"):
+        if not self.cancelled.is_set():
+            self.reason = reason
+            self.cancelled.set()
+
+    def check(self):
+        if self.deadline and time.monotonic() > self.deadline:
+            self.cancel("timeout")
+        if self.cancelled.is_set():
+            raise GenerationCancelled(self.reason)
+
+
+class InferenceWorker:
+    """The one thread that runs generations, strictly one at a time.
+
+    submit() queues a job; with preempt=True (a new question) the running job
+    and anything still queued are cancelled first, so the latest request starts
+    as soon as the current decode step returns.
+    """
+
+    def __init__(self, name="inference"):
+        self.cond = threading.Condition()
+        self.jobs = deque()
+        self.current = None
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def submit(self, fn, *args, timeout=GENERATION_TIMEOUT, preempt=True):
+        """Runs fn(job, *args) on the worker thread; returns the job"""
+        job = InferenceJob(fn, args, timeout)
+        with self.cond:
+            if preempt:
+                self._cancel_all("preempted")
+            self.jobs.append(job)
+            self.cond.notify()
+        return job
+
+    def stop(self):
+        """Stops the running generation (and drops queued ones)"""
+        with self.cond:
+            self._cancel_all("stopped")
+
+    def busy(self):
+        with self.cond:
+            return self.current is not None or bool(self.jobs)
+
+    def shutdown(self):
+        with self.cond:
+            self._cancel_all("shutdown")
+            self.running = False
+            self.cond.notify()
+
+    def _cancel_all(self, reason):
+        if self.current:
+            self.current.cancel(reason)
+        for job in self.jobs:
+            job.cancel(reason)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while self.running and not self.jobs:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                job = self.current = self.jobs.popleft()
+            # Cancelled jobs still run: fn's first check() raises and it cleans up its own UI
+            job.deadline = time.monotonic() + job.timeout if job.timeout else None
+            try:
+                job.fn(job, *job.args)
+            except GenerationCancelled:
+                pass
+            except Exception as e:
+                print(f"Inference Error: {e}")
+            finally:
+                job.done.set()
+                with self.cond:
+                    self.current = None
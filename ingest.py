@@ -0,0 +1,167 @@
+import os
+import json
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+PAGES_PER_TASK = 8
+POOL_MIN_PAGES = 24  # smaller PDFs are quicker to read in-thread than to ship to the pool
+IMAGE_PAGE_CHARS = 20  # a page with less text than this is a scan or a figure
+PAGE_DPI = 110  # page renders for vision models (the projector downsizes anyway)
+
+
+class IngestCancelled(Exception):
+    pass
+
+
+def _page_text(page, image_prefix):
+    """The page's text; a page that is only an image is rendered to <prefix>-pNNNN.png
+    and stands in the text as a "[Page N: image]" marker"""
+    text = page.get_text()
+    if len(text.strip()) >= IMAGE_PAGE_CHARS or not image_prefix:
+        return text
+    page.get_pixmap(dpi=PAGE_DPI).save(f"{image_prefix}-p{page.number + 1:04d}.png")
+    return f"{text}\n[Page {page.number + 1}: image]\n"
+
+
+def _extract_pages(path, start, stop, image_prefix=None):
+    # Runs in a worker process - each one opens its own handle
+    import fitz
+    with fitz.open(path) as doc:
+        return start, [_page_text(doc[i], image_prefix) for i in range(start, stop)]
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class DocumentIngestor:
+    """Turns attached files into text off the UI thread.
+
+    PDFs are split into page ranges and extracted in a process pool; pages with
+    no text (scans, figures) are rendered to PNG for vision models. Results are
+    cached on disk by content hash; a (path, size, mtime) index in front of that
+    means re-attaching an unchanged file does not even re-hash it.
+    """
+
+    def __init__(self, cache_dir, workers=None):
+        self.cache_dir = cache_dir
+        self.workers = workers or max((os.cpu_count() or 2) - 1, 1)
+        self.pool = None
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index_path = os.path.join(cache_dir, "files.json")
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+
+    def extract(self, path, progress=None, cancel=None):
+        """Returns the document text. progress(done_pages, total_pages); cancel is a threading.Event"""
+        st = os.stat(path)
+        stat_key = f"{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}"
+
+        digest = self.index.get(stat_key)
+        text = self._read_cache(digest) if digest else None
+        if text is None:
+            digest = file_digest(path)
+            text = self._read_cache(digest)
+        if text is None:
+            if path.lower().endswith(".pdf"):
+                text = self._extract_pdf(path, progress, cancel, os.path.join(self.cache_dir, digest))
+            else:
+                with open(path, "r", encoding="utf-8", errors="replace") as f:
+                    text = f.read()
+            self._write_cache(digest, text)
+
+        with self.lock:
+            self.index[stat_key] = digest
+            self._save_index()
+        return text
+
+    def page_images(self, path):
+        """(label, png path) for the image-only pages of an extracted PDF, in page order"""
+        st = os.stat(path)
+        digest = self.index.get(f"{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}")
+        if not digest:
+            return []
+        names = sorted(n for n in os.listdir(self.cache_dir) if n.startswith(digest + "-p") and n.endswith(".png"))
+        return [(f"Page {int(n[len(digest) + 2:-4])}", os.path.join(self.cache_dir, n)) for n in names]
+
+    def _extract_pdf(self, path, progress, cancel, image_prefix):
+        import fitz
+        with fitz.open(path) as doc:
+            total = doc.page_count
+            if total < POOL_MIN_PAGES:
+                pages = []
+                for page in doc:
+                    if cancel and cancel.is_set():
+                        raise IngestCancelled()
+                    pages.append(_page_text(page, image_prefix))
+                    if progress:
+                        progress(len(pages), total)
+                return "\n".join(pages)
+
+        pages = [None] * total
+        done = 0
+        pending = {
+            self._get_pool().submit(_extract_pages, path, start, min(start + PAGES_PER_TASK, total), image_prefix)
+            for start in range(0, total, PAGES_PER_TASK)
+        }
+        try:
+            while pending:
+                finished, pending = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+                if cancel and cancel.is_set():
+                    raise IngestCancelled()
+                for future in finished:
+                    start, texts = future.result()
+                    pages[start:start + len(texts)] = texts
+                    done += len(texts)
+                    if progress:
+                        progress(done, total)
+        finally:
+            for future in pending:
+                future.cancel()
+        return "\n".join(pages)
+
+    def _get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                # spawn, not fork: forking a process that runs llama.cpp and UI threads can deadlock
+                self.pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                mp_context=multiprocessing.get_context("spawn"))
+            return self.pool
+
+    def shutdown(self):
+        if self.pool:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+    # --- Text cache ---
+    def _cache_file(self, digest):
+        return os.path.join(self.cache_dir, digest + ".txt")
+
+    def _read_cache(self, digest):
+        try:
+            with open(self._cache_file(digest), "r", encoding="utf-8") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _write_cache(self, digest, text):
+        try:
+            with open(self._cache_file(digest), "w", encoding="utf-8") as f:
+                f.write(text)
+        except OSError as e:
+            print(f"Extraction cache write failed: {e}")
+
+    def _save_index(self):
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.index, f)
+        os.replace(tmp, self.index_path)
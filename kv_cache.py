@@ -0,0 +1,229 @@
+import os
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def common_prefix(a, b):
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+def state_size(state):
+    return int(state.llama_state_size) + int(state.scores.nbytes) + int(state.input_ids.nbytes)
+
+
+def cache_key(model_path, llm):
+    """A saved state only restores into a context of the same shape: the KV size
+    (n_ctx) and the scores buffer (n_batch rows, or n_ctx with logits_all)"""
+    return (model_path, llm.n_ctx(), getattr(llm, "n_batch", None), bool(getattr(llm, "_logits_all", False)))
+
+
+class StateCache:
+    """Prefix-aware llama.cpp state cache: RAM tier + optional disk tier, both LRU by bytes"""
+
+    def __init__(self, ram_bytes=1 << 30, disk_dir=None, disk_bytes=4 << 30):
+        self.ram_bytes = ram_bytes
+        self.disk_dir = disk_dir
+        self.disk_bytes = disk_bytes
+        self.lock = threading.RLock()
+
+        # (model_key, tokens) -> (state, size), oldest first
+        self.ram = OrderedDict()
+        self.ram_used = 0
+
+        # (model_key, tokens) -> (filename, size), oldest first
+        self.disk = OrderedDict()
+        self.disk_used = 0
+
+        self.hits = 0
+        self.misses = 0
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._load_disk_index()
+
+    def for_model(self, model_key, keep_logits=False):
+        """Returns the view a single Llama instance plugs into llm.set_cache(); model_key
+        is cache_key(path, llm) so states never cross context shapes"""
+        return ModelStateCache(self, model_key, keep_logits)
+
+    # --- Lookup ---
+    def lookup(self, model_key, tokens):
+        tokens = tuple(tokens)
+        with self.lock:
+            key, tier = self._longest_prefix(model_key, tokens)
+            if key is None:
+                self.misses += 1
+                raise KeyError("No cached state for this prefix")
+            if tier == "ram":
+                self.hits += 1
+                self.ram.move_to_end(key)
+                return self.ram[key][0]
+
+            # Promote from disk so the next turn hits RAM
+            try:
+                state = self._read_disk(key)
+            except KeyError:
+                self.misses += 1
+                raise
+            self.hits += 1
+            self._put_ram(key, state)
+            return state
+
+    def _longest_prefix(self, model_key, tokens):
+        best_len, best_key, best_tier = 0, None, None
+        for tier, store in (("ram", self.ram), ("disk", self.disk)):
+            for key in store:
+                if key[0] != model_key:
+                    continue
+                n = common_prefix(key[1], tokens)
+                if n > best_len:
+                    best_len, best_key, best_tier = n, key, tier
+        return best_key, best_tier
+
+    # --- Insert / eviction ---
+    def store(self, model_key, tokens, state):
+        with self.lock:
+            self._put_ram((model_key, tuple(tokens)), state)
+
+    def _put_ram(self, key, state):
+        if key in self.ram:
+            self.ram_used -= self.ram.pop(key)[1]
+        size = state_size(state)
+        self.ram[key] = (state, size)
+        self.ram_used += size
+        self._spill()
+
+    def _spill(self):
+        while self.ram_used > self.ram_bytes and self.ram:
+            old_key, (old_state, old_size) = self.ram.popitem(last=False)
+            self.ram_used -= old_size
+            if self.disk_dir and old_key not in self.disk:
+                self._write_disk(old_key, old_state, old_size)
+
+    def _write_disk(self, key, state, size):
+        if size > self.disk_bytes:
+            return
+        name = hashlib.sha1(repr(key).encode()).hexdigest() + ".state"
+        try:
+            # Written under a temporary name so a kill mid-write never leaves a truncated state
+            path = os.path.join(self.disk_dir, name)
+            with open(path + ".tmp", "wb") as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            print(f"State cache write failed: {e}")
+            self._remove_file(name + ".tmp")
+            return
+        self.disk[key] = (name, size)
+        self.disk_used += size
+
+        while self.disk_used > self.disk_bytes and self.disk:
+            _, (old_name, old_size) = self.disk.popitem(last=False)
+            self.disk_used -= old_size
+            self._remove_file(old_name)
+        self._save_disk_index()
+
+    def _read_disk(self, key):
+        name, size = self.disk.pop(key)
+        self.disk_used -= size
+        try:
+            with open(os.path.join(self.disk_dir, name), "rb") as f:
+                state = pickle.load(f)
+            return state
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ValueError) as e:
+            # A missing or corrupt file is a miss: llama_cpp only expects KeyError here
+            print(f"State cache read failed: {e}")
+            raise KeyError("Cached state unreadable") from e
+        finally:
+            self._remove_file(name)
+            self._save_disk_index()
+
+    def _remove_file(self, name):
+        try:
+            os.remove(os.path.join(self.disk_dir, name))
+        except OSError:
+            pass
+
+    # --- Disk index (keys must survive restarts without unpickling every state) ---
+    def _index_path(self):
+        return os.path.join(self.disk_dir, "index.pkl")
+
+    def _load_disk_index(self):
+        try:
+            with open(self._index_path(), "rb") as f:
+                entries = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return
+        for key, name, size in entries:
+            if os.path.exists(os.path.join(self.disk_dir, name)):
+                self.disk[key] = (name, size)
+                self.disk_used += size
+
+    def _save_disk_index(self):
+        entries = [(key, name, size) for key, (name, size) in self.disk.items()]
+        tmp = self._index_path() + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(entries, f)
+        os.replace(tmp, self._index_path())
+
+    def set_ram_limit(self, ram_bytes):
+        """Resizes the RAM tier; states over the new limit move to disk (memory pressure)"""
+        with self.lock:
+            self.ram_bytes = ram_bytes
+            self._spill()
+
+    def drop(self, model_key=None):
+        """Forget RAM states (for one model, or all of them)"""
+        with self.lock:
+            for key in [k for k in self.ram if model_key is None or k[0] == model_key]:
+                self.ram_used -= self.ram.pop(key)[1]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "ram_entries": len(self.ram), "ram_mb": self.ram_used / 1024**2,
+                "disk_entries": len(self.disk), "disk_mb": self.disk_used / 1024**2,
+                "hits": self.hits, "misses": self.misses,
+            }
+
+
+class ModelStateCache:
+    """Duck-types llama_cpp.BaseLlamaCache so Llama.create_completion uses it directly"""
+
+    def __init__(self, parent, model_key, keep_logits=False):
+        self.parent = parent
+        self.model_key = model_key
+        self.keep_logits = keep_logits
+        self.capacity_bytes = parent.ram_bytes
+
+    @property
+    def cache_size(self):
+        return self.parent.ram_used
+
+    def __getitem__(self, key):
+        return self.parent.lookup(self.model_key, key)
+
+    def __contains__(self, key):
+        with self.parent.lock:
+            return self.parent._longest_prefix(self.model_key, tuple(key))[0] is not None
+
+    def __setitem__(self, key, state):
+        if not self.keep_logits:
+            self._strip_scores(state)
+        self.parent.store(self.model_key, key, state)
+
+    @staticmethod
+    def _strip_scores(state):
+        # Without logits_all the scores buffer is only scratch space (n_batch x n_vocab floats,
+        # hundreds of MB for 128k vocabularies). load_state() sets _requires_eval so the logits
+        # get recomputed anyway - keep a single (n_vocab,) zero row instead, which
+        # load_state's scores[:n_tokens] = state.scores broadcasts to any row count.
+        import numpy as np
+        state.scores = np.zeros(state.scores.shape[-1:], dtype=state.scores.dtype)
@@ -0,0 +1,197 @@
+import os
+import threading
+from collections import OrderedDict
+from catalog import get_catalog, kv_bytes
+
+
+def estimate_model_bytes(path, llm=None, n_ctx=4096):
+    """Weights (the mmap'd file) plus the f16 KV cache the context will allocate"""
+    size = os.path.getsize(path)
+    if llm is not None:
+        n_ctx = llm.n_ctx()  # a calibrated profile may have picked a different size
+        meta = getattr(llm, "metadata", None) or {}
+    else:
+        entry = get_catalog().entry(path)  # header only, no load
+        meta = entry["metadata"] if entry else {}
+    kv = kv_bytes(meta, n_ctx)
+    if kv is None:
+        kv = size // 8  # rough guess when the header doesn't say
+    projector = getattr(getattr(llm, "chat_handler", None), "clip_model_path", None)
+    if projector:
+        size += os.path.getsize(projector)
+    if getattr(llm, "draft_model", None) is not None:
+        kv += n_ctx * llm.n_vocab() * 4  # speculative decoding keeps logits for every position
+        draft = getattr(llm.draft_model.inner, "llm", None)
+        if draft is not None:
+            kv += estimate_model_bytes(draft.model_path, draft, n_ctx)
+    return size + kv
+
+
+def warm_pages(path, chunk=8 * 1024**2):
+    """Pulls a model file into the page cache so the mmap in Llama() doesn't wait on
+    the disk. Meant for a background thread started before llama_cpp is imported."""
+    try:
+        import psutil
+        if os.path.getsize(path) > psutil.virtual_memory().available // 2:
+            return  # would only push itself (or everything else) back out
+        if hasattr(os, "posix_fadvise"):
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)  # kernel readahead, no copy
+            finally:
+                os.close(fd)
+            return
+        with open(path, "rb", buffering=0) as f:
+            while f.read(chunk):
+                pass
+    except OSError as e:
+        print(f"Prefetch Error: {e}")
+
+
+class ModelPool:
+    """Keeps recently used models loaded, within a RAM budget (LRU eviction).
+
+    `factory(name)` builds a ready-to-use Llama. Models that are leased (a
+    generation is running on them) are never evicted; switching back to a
+    resident model is instant. Weights are mmap'd, so an evicted-then-reloaded
+    model usually comes back from the page cache rather than the disk.
+    """
+
+    def __init__(self, factory, budget_bytes, n_ctx=4096):
+        self.factory = factory
+        self.budget = budget_bytes
+        self.n_ctx = n_ctx
+        self.cond = threading.Condition()
+
+        self.models = OrderedDict()  # name -> llm, least recently used first
+        self.sizes = {}
+        self.leases = {}
+        self.loading = set()
+        self.history = []  # names in the order they were requested
+
+    @property
+    def used(self):
+        return sum(self.sizes.values())
+
+    def resident(self):
+        with self.cond:
+            return list(self.models)
+
+    # --- Access ---
+    def get(self, name):
+        """Returns the loaded model, loading it (and evicting others) if needed"""
+        with self.cond:
+            if not self.history or self.history[-1] != name:
+                self.history.append(name)
+                del self.history[:-20]
+            while name in self.loading:
+                self.cond.wait()
+            if name in self.models:
+                self.models.move_to_end(name)
+                return self.models[name]
+            self.loading.add(name)
+
+        try:
+            llm = self.factory(name)
+        except Exception:
+            with self.cond:
+                self.loading.discard(name)
+                self.cond.notify_all()
+            raise
+
+        with self.cond:
+            self.loading.discard(name)
+            self.models[name] = llm
+            self.sizes[name] = estimate_model_bytes(name, llm, self.n_ctx)
+            self._evict(keep=name)
+            self.cond.notify_all()
+            return llm
+
+    def lease(self, name):
+        """Context manager that pins a model for the length of a generation"""
+        return _Lease(self, name)
+
+    def _evict(self, keep=None):
+        for name in list(self.models):
+            if self.used <= self.budget:
+                break
+            if name == keep or self.leases.get(name):
+                continue
+            self._drop(name)
+
+    def _drop(self, name):
+        self.models.pop(name)
+        self.sizes.pop(name)
+        print(f"Model pool: unloaded {name}")
+
+    def discard(self, name):
+        """Forgets a model so the next get() rebuilds it (e.g. its settings changed)"""
+        with self.cond:
+            if name in self.models:
+                self._drop(name)
+
+    def set_budget(self, budget_bytes):
+        """Resizes the budget; idle models beyond it are unloaded now"""
+        with self.cond:
+            self.budget = budget_bytes
+            self._evict()
+
+    def evict_idle(self, keep=None):
+        """Unloads every model that is neither leased nor `keep` (memory pressure)"""
+        with self.cond:
+            for name in list(self.models):
+                if name != keep and not self.leases.get(name):
+                    self._drop(name)
+
+    # --- Preloading ---
+    def likely_next(self, current):
+        """The model used before `current` - toggling between two is the common case"""
+        with self.cond:
+            for name in reversed(self.history):
+                if name != current:
+                    return name
+        return None
+
+    def prefetch(self, name):
+        """Loads `name` in the background, but only into spare budget"""
+        if not name or not os.path.exists(name):
+            return
+        with self.cond:
+            if name in self.models or name in self.loading:
+                return
+            if self.used + estimate_model_bytes(name, None, self.n_ctx) > self.budget:
+                return
+            self.loading.add(name)
+
+        def run():
+            try:
+                llm = self.factory(name)
+                with self.cond:
+                    self.models[name] = llm
+                    self.models.move_to_end(name, last=False)  # a guess, not a use
+                    self.sizes[name] = estimate_model_bytes(name, llm, self.n_ctx)
+                    self._evict()
+            except Exception as e:
+                print(f"Preload Error: {e}")
+            finally:
+                with self.cond:
+                    self.loading.discard(name)
+                    self.cond.notify_all()
+
+        threading.Thread(target=run, daemon=True).start()
+
+
+class _Lease:
+    def __init__(self, pool, name):
+        self.pool = pool
+        self.name = name
+
+    def __enter__(self):
+        with self.pool.cond:
+            self.pool.leases[self.name] = self.pool.leases.get(self.name, 0) + 1
+        return self.pool.get(self.name)
+
+    def __exit__(self, *exc):
+        with self.pool.cond:
+            self.pool.leases[self.name] -= 1
+            self.pool._evict()
@@ -0,0 +1,73 @@
+from kv_cache import common_prefix
+
+# Two different questions: the prompt tokens they have in common are the part
+# that can be evaluated before the real question is known
+PLACEHOLDERS = ("A", "Z")
+DEBOUNCE_MS = 700  # typing pause before the excerpts are re-picked and prefilled
+
+
+def make_formatter(llm):
+    """The chat formatter create_chat_completion uses for this model: Llama() swaps a
+    template it recognizes for the built-in format (llm.chat_format), otherwise it
+    formats with the GGUF's own Jinja template"""
+    from llama_cpp import llama_chat_format
+    builtin = {
+        "chatml": llama_chat_format.format_chatml,
+        "llama-3": llama_chat_format.format_llama3,
+        "mistral-instruct": llama_chat_format.format_mistral_instruct,
+        "llama-2": llama_chat_format.format_llama2,
+    }
+    chat_format = getattr(llm, "chat_format", None)
+    if chat_format in builtin:
+        return builtin[chat_format]
+    template = llm.metadata.get("tokenizer.chat_template")
+    if chat_format and chat_format.startswith("chat_template.") and chat_format != "chat_template.default":
+        template = llm.metadata.get(f"tokenizer.{chat_format}", template)
+    if not template:
+        return llama_chat_format.format_llama2  # llama_cpp's own fallback
+    return llama_chat_format.Jinja2ChatFormatter(
+        template=template,
+        eos_token=llm.detokenize([llm.token_eos()], special=True).decode("utf-8", errors="ignore"),
+        bos_token=llm.detokenize([llm.token_bos()], special=True).decode("utf-8", errors="ignore"),
+    )
+
+
+def prompt_tokens(llm, result):
+    """Tokens for a formatter result, exactly as create_chat_completion tokenizes them"""
+    return llm.tokenize(result.prompt.encode("utf-8"), add_bos=not result.added_special, special=True)
+
+
+def eval_prefix(job, llm, tokens):
+    """Evaluates `tokens` into the KV in n_batch slices, job.check() before each one,
+    starting after whatever prefix is already there. Returns (evaluated, cached)"""
+    cached = common_prefix(llm.input_ids[:llm.n_tokens].tolist(), tokens)
+    llm.n_tokens = cached  # eval() appends from here, dropping the stale KV tail
+    for i in range(cached, len(tokens), llm.n_batch):
+        job.check()
+        llm.eval(tokens[i:i + llm.n_batch])
+    return len(tokens) - cached, cached
+
+
+class Prefill:
+    """Evaluates the question-independent part of the next prompt into the KV cache.
+
+    Runs as a job on the inference worker while the user types. The real
+    request later finds those tokens already in the KV (llama_cpp keeps the
+    longest common prefix), so only the question itself is left to evaluate.
+    Evaluation goes in n_batch slices with job.check() in between, so Send,
+    detaching or switching model stops it within one batch; whatever was
+    evaluated by then is still reused.
+    """
+
+    def __init__(self):
+        self.formatters = {}  # model -> chat formatter
+
+    def run(self, job, llm, model, make_messages):
+        """make_messages(question) -> the messages that question would be sent with.
+        Returns (tokens evaluated, tokens already cached)"""
+        formatter = self.formatters.get(model)
+        if formatter is None:
+            formatter = self.formatters[model] = make_formatter(llm)
+        a = prompt_tokens(llm, formatter(messages=make_messages(PLACEHOLDERS[0])))
+        b = prompt_tokens(llm, formatter(messages=make_messages(PLACEHOLDERS[1])))
+        return eval_prefix(job, llm, a[:common_prefix(a, b)])
@@ -0,0 +1,139 @@
+import os
+import re
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+MAX_BYTES = 64 * 1024**2
+TEMPERATURE = 0.0  # the cache only serves deterministic replies
+SPACE_RE = re.compile(r"\s+")
+
+
+def normalize(prompt):
+    """Case, runs of whitespace and trailing punctuation don't change the question"""
+    return SPACE_RE.sub(" ", prompt).strip().rstrip("?!. ").casefold()
+
+
+class ResponseCache:
+    """Finished replies on disk, keyed by model, sampling parameters, the normalized
+    question, the attached document's content hash and the conversation so far.
+
+    Opt-in: while it is enabled, replies are generated at temperature 0 so that
+    a stored reply is exactly what the model would produce again. Entries are
+    evicted least-recently-used once they exceed `max_bytes`. Hit/miss counts
+    are kept across sessions.
+    """
+
+    def __init__(self, directory, max_bytes=MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> size, least recently used first
+        self.enabled = False
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        self.index_path = os.path.join(directory, "index.json")
+        self._load_index()
+
+    # --- Keys ---
+    @staticmethod
+    def key(model_path, params, prompt, doc_digest=None, history=None):
+        model = f"{os.path.basename(model_path)}|{os.path.getsize(model_path)}"
+        raw = json.dumps([model, sorted(params.items()), normalize(prompt), doc_digest, history])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    # --- Access ---
+    def get(self, key):
+        """The stored reply, or None. Counts a hit or a miss"""
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                self._save_index()
+                return None
+            try:
+                with open(self._file(key), "r", encoding="utf-8") as f:
+                    text = json.load(f)["text"]
+            except (OSError, ValueError, KeyError):
+                self._remove(key)
+                self.misses += 1
+                self._save_index()
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            self._save_index()
+            return text
+
+    def put(self, key, text):
+        data = json.dumps({"text": text}, ensure_ascii=False)
+        with self.lock:
+            try:
+                with open(self._file(key), "w", encoding="utf-8") as f:
+                    f.write(data)
+            except OSError as e:
+                print(f"Response cache Error: {e}")
+                return
+            self.entries[key] = len(data.encode("utf-8"))
+            self.entries.move_to_end(key)
+            while sum(self.entries.values()) > self.max_bytes and len(self.entries) > 1:
+                self._remove(next(iter(self.entries)))
+            self._save_index()
+
+    def set_enabled(self, enabled):
+        with self.lock:
+            self.enabled = enabled
+            self._save_index()
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.entries):
+                self._remove(key)
+            self.hits = self.misses = 0
+            self._save_index()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "entries": len(self.entries),
+                "bytes": sum(self.entries.values()),
+            }
+
+    # --- Storage ---
+    def _file(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def _remove(self, key):
+        self.entries.pop(key, None)
+        try:
+            os.remove(self._file(key))
+        except OSError:
+            pass
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+            self.enabled = index.get("enabled", False)
+            self.hits = index.get("hits", 0)
+            self.misses = index.get("misses", 0)
+            for key, size in index.get("entries", []):
+                if os.path.exists(self._file(key)):
+                    self.entries[key] = size
+        except (OSError, ValueError):
+            pass
+
+    def _save_index(self):
+        index = {"enabled": self.enabled, "hits": self.hits, "misses": self.misses,
+                 "entries": list(self.entries.items())}
+        tmp = self.index_path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(index, f)
+            os.replace(tmp, self.index_path)
+        except OSError as e:
+            print(f"Response cache Error: {e}")
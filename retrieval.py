@@ -0,0 +1,174 @@
+import os
+import re
+import json
+import hashlib
+import threading
+
+INDEX_SUFFIX = ".nidx"
+CHUNK_CHARS = 800
+CHUNK_OVERLAP = 150
+WORD_RE = re.compile(r"\w+")
+
+
+def chunk_text(text, size=CHUNK_CHARS, overlap=CHUNK_OVERLAP):
+    """Splits on paragraph/sentence boundaries where possible, with a little overlap"""
+    chunks, start = [], 0
+    text = text.strip()
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text):
+            # Prefer to cut at a paragraph, then a sentence, then a space
+            window = text[start + size // 2:end]
+            for sep in ("\n\n", ". ", "\n", " "):
+                cut = window.rfind(sep)
+                if cut != -1:
+                    end = start + size // 2 + cut + len(sep)
+                    break
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(chunk)
+        if end >= len(text):
+            break
+        # Step back for overlap, but start on a word boundary
+        start = max(end - overlap, start + 1)
+        space = text.find(" ", start, end)
+        if space != -1:
+            start = space + 1
+    return chunks
+
+
+def find_embedding_model(directory="."):
+    """A dedicated embedding GGUF (nomic-embed, bge, e5, ...) beats reusing the chat model"""
+    for f in sorted(os.listdir(directory)):
+        name = f.lower()
+        if name.endswith(".gguf") and any(k in name for k in ("embed", "bge", "e5-", "minilm")):
+            return os.path.join(directory, f)
+    return None
+
+
+class Embedder:
+    """Loads a GGUF in embedding mode (mean pooled, L2 normalized vectors).
+
+    Pointing it at the chat model's file is cheap: the weights are mmap'd, so the
+    second instance shares pages with the one that is already loaded.
+    """
+
+    def __init__(self, model_path, n_threads=None):
+        from llama_cpp import Llama, LLAMA_POOLING_TYPE_MEAN
+        self.model_path = model_path
+        self.llm = Llama(
+            model_path=model_path, embedding=True, pooling_type=LLAMA_POOLING_TYPE_MEAN,
+            n_ctx=1024, n_batch=1024, n_threads=n_threads, verbose=False
+        )
+        self.lock = threading.Lock()
+
+    @property
+    def key(self):
+        return os.path.basename(self.model_path)
+
+    def embed(self, texts, batch=16):
+        import numpy as np
+        vectors = []
+        with self.lock:
+            for i in range(0, len(texts), batch):
+                vectors.extend(self.llm.embed(texts[i:i + batch], normalize=True))
+        return np.asarray(vectors, dtype=np.float32)
+
+
+class DocumentIndex:
+    """Chunked, embedded copy of one attached document.
+
+    Vectors are saved as <file>.nidx.npy (memory-mapped on reload) with the chunks
+    in <file>.nidx.json, so re-attaching a big manual does not re-embed it. Until
+    the vectors are ready (or with no embedder at all) search falls back to
+    keyword overlap, so a question sent straight after attaching still works.
+    """
+
+    def __init__(self, path, text, embedder=None):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        self.chunks = chunk_text(text)
+        self.embedder = embedder
+        self.vectors = None
+        self.ready = threading.Event()
+        self.cancelled = False
+        self.images = []  # (label, png) for image-only PDF pages, shown to vision models
+
+    # --- Persistence ---
+    def _base(self):
+        base = self.path + INDEX_SUFFIX
+        if os.access(os.path.dirname(os.path.abspath(base)), os.W_OK):
+            return base
+        # Read-only folder: keep the index in the app cache instead
+        os.makedirs(os.path.join(".neptunium_cache", "index"), exist_ok=True)
+        return os.path.join(".neptunium_cache", "index", self.digest[:32] + INDEX_SUFFIX)
+
+    def _load(self):
+        import numpy as np
+        base = self._base()
+        try:
+            with open(base + ".json", "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta["digest"] != self.digest or meta["embedder"] != self.embedder.key:
+                return False
+            self.chunks = meta["chunks"]
+            self.vectors = np.load(base + ".npy", mmap_mode="r")
+            return len(self.vectors) == len(self.chunks)
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def _save(self):
+        import numpy as np
+        base = self._base()
+        try:
+            np.save(base + ".npy", self.vectors)
+            with open(base + ".json", "w", encoding="utf-8") as f:
+                json.dump({"digest": self.digest, "embedder": self.embedder.key, "chunks": self.chunks}, f)
+        except OSError as e:
+            print(f"Index save failed: {e}")
+
+    # --- Build ---
+    def build(self, progress=None):
+        """Embeds all chunks (or loads a saved index). Safe to run on a worker thread"""
+        import numpy as np  # on first attachment, not at startup
+        try:
+            if not self.embedder or self._load():
+                return
+            vectors = []
+            step = 16
+            for i in range(0, len(self.chunks), step):
+                if self.cancelled:
+                    return
+                vectors.append(self.embedder.embed(self.chunks[i:i + step]))
+                if progress:
+                    progress(min(i + step, len(self.chunks)), len(self.chunks))
+            self.vectors = np.concatenate(vectors) if vectors else np.zeros((0, 1), np.float32)
+            self._save()
+        except Exception as e:
+            print(f"Embedding Error: {e}")
+            self.vectors = None
+        finally:
+            self.ready.set()
+
+    # --- Search ---
+    def search(self, query, k=4):
+        import numpy as np
+        if not self.chunks:
+            return []
+        vectors, embedder = self.vectors, self.embedder  # the engine may swap the embedder meanwhile
+        if vectors is not None and len(vectors) and embedder is not None:
+            q = embedder.embed([query])[0]
+            scores = np.asarray(vectors @ q)
+        else:
+            words = set(WORD_RE.findall(query.lower()))
+            scores = np.array([
+                len(words.intersection(WORD_RE.findall(c.lower()))) for c in self.chunks
+            ], dtype=np.float32)
+        top = np.argsort(-scores)[:k]
+        return sorted(int(i) for i in top)  # document order reads better than score order
+
+    def context_for(self, query, k=4):
+        picked = self.search(query, k)
+        body = "\n...\n".join(self.chunks[i] for i in picked)
+        return f"\n[Document Excerpts: {self.name} ({len(picked)} of {len(self.chunks)} sections)]\n{body}\n[End of Document]\n"
@@ -0,0 +1,455 @@
+import sys
+import json
+import time
+import uuid
+import asyncio
+import argparse
+import threading
+from collections import deque
+from llama_cpp import Llama
+from hardware import HardwareEngine
+from catalog import get_catalog
+from model_pool import ModelPool
+from prefill import make_formatter, prompt_tokens
+from kv_cache import state_size
+
+# A switch copies the whole KV out and back in (save_state / load_state), so a
+# turn has to be long enough for that copy to be small next to the decoding
+QUANTUM = 128  # tokens a request may generate before the next one gets a turn
+MAX_ACTIVE = 4  # requests interleaved at once (each paused one holds a KV snapshot)
+MAX_PENDING = 32  # active + queued; beyond this new requests get 503
+OUT_HIGH_WATER = 256  # undelivered tokens before a slow client is skipped for a round
+
+
+def find_models():
+    """Same discovery as the desktop apps: the model catalog's folders"""
+    return [entry["path"] for entry in get_catalog().scan()]
+
+
+class SchedulerFull(Exception):
+    pass
+
+
+class ChatRequest:
+    """One /v1/chat/completions call as the scheduler sees it"""
+
+    def __init__(self, model, messages, loop, max_tokens=None, temperature=0.8, top_p=0.95, stop=None):
+        self.id = "chatcmpl-" + uuid.uuid4().hex[:24]
+        self.model = model
+        self.messages = messages
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.stop = [stop] if isinstance(stop, str) else list(stop or [])
+
+        self.loop = loop
+        self.out = asyncio.Queue()  # ("delta", text) / ("done", finish_reason) / ("error", message) / ("cancelled", None)
+        self.undelivered = 0  # counted up by the scheduler thread, down by the event loop
+        self.lock = threading.Lock()
+        self.cancelled = threading.Event()
+
+        # Filled in by the scheduler thread
+        self.tokens = None  # prompt + generated so far
+        self.prompt_len = 0
+        self.generated = 0
+        self.pending = b""  # bytes of a UTF-8 character split across tokens
+        self.text = ""  # decoded text not yet sent (held back while it could start a stop string)
+        self.state = None  # KV snapshot while paused
+
+    def emit(self, kind, value):
+        with self.lock:
+            self.undelivered += 1
+        self.loop.call_soon_threadsafe(self.out.put_nowait, (kind, value))
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+class Scheduler:
+    """Runs chat requests against shared models on one worker thread.
+
+    Up to `max_active` requests are interleaved round-robin, `quantum` tokens at
+    a time, so a long answer can't starve a short one. When the worker moves to
+    another request it snapshots the KV of the one it leaves (save_state) and
+    restores it on that request's next turn, which costs a copy instead of a
+    re-evaluation. Paused snapshots are held within `snapshot_budget` bytes: once
+    a snapshot's size is known, no more requests are interleaved than their
+    snapshots fit. Beyond `max_pending` requests submit() refuses (backpressure);
+    a cancelled request is dropped at its next token.
+    """
+
+    def __init__(self, pool, quantum=QUANTUM, max_active=MAX_ACTIVE, max_pending=MAX_PENDING, snapshot_budget=None):
+        self.pool = pool
+        self.quantum = quantum
+        self.max_active = max_active
+        self.max_pending = max_pending
+        self.snapshot_budget = snapshot_budget
+        self.snapshot_size = 0  # largest snapshot seen so far
+
+        self.cond = threading.Condition()
+        self.waiting = deque()
+        self.active = deque()
+        self.owner = {}  # model -> (llm, request whose tokens are in its KV)
+        self.formatters = {}  # model -> chat formatter
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, req):
+        with self.cond:
+            if len(self.waiting) + len(self.active) >= self.max_pending:
+                raise SchedulerFull()
+            self.waiting.append(req)
+            self.cond.notify()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+
+    def stats(self):
+        with self.cond:
+            return {"active": len(self.active), "waiting": len(self.waiting),
+                    "snapshot_mb": round(sum(state_size(r.state) for r in self.active if r.state) / 1024**2, 1)}
+
+    def _room(self):
+        """Whether one more active request (one more paused snapshot) fits the budget"""
+        if len(self.active) >= self.max_active:
+            return False
+        if not self.active or not self.snapshot_budget or not self.snapshot_size:
+            return True
+        return len(self.active) * self.snapshot_size <= self.snapshot_budget
+
+    # --- Worker ---
+    def _next(self):
+        with self.cond:
+            while self.running:
+                while self.waiting and self._room():
+                    self.active.append(self.waiting.popleft())
+                # Skip (but keep) requests whose client isn't reading
+                for _ in range(len(self.active)):
+                    req = self.active[0]
+                    self.active.rotate(-1)
+                    if req.cancelled.is_set() or req.undelivered < OUT_HIGH_WATER:
+                        return req
+                self.cond.wait(timeout=None if not self.active else 0.05)
+            return None
+
+    def _finish(self, req, kind, value):
+        with self.cond:
+            if req in self.active:
+                self.active.remove(req)
+        for model, (llm, owner) in list(self.owner.items()):
+            if owner is req:
+                del self.owner[model]
+        req.state = None
+        req.emit(kind, value)
+
+    def _run(self):
+        while True:
+            req = self._next()
+            if req is None:
+                return
+            if req.cancelled.is_set():
+                self._finish(req, "cancelled", None)
+                continue
+            try:
+                with self.pool.lease(req.model) as llm:
+                    finish = self._turn(req, llm)
+                if finish == "cancelled":
+                    self._finish(req, "cancelled", None)  # not an OpenAI finish_reason
+                elif finish:
+                    self._finish(req, "done", finish)
+            except Exception as e:
+                print(f"Server Error: {e}")
+                self._finish(req, "error", str(e))
+
+    def _turn(self, req, llm):
+        """Generates up to one quantum for `req`; returns a finish reason once it is done"""
+        if req.tokens is None:
+            req.tokens = self._prompt_tokens(req, llm)
+            req.prompt_len = len(req.tokens)
+            room = llm.n_ctx() - req.prompt_len
+            if room <= 0:
+                raise ValueError(f"prompt is {req.prompt_len} tokens, the context holds {llm.n_ctx()}")
+            req.max_tokens = min(req.max_tokens or room, room)
+
+        # Swap KV snapshots if another request used this model last. generate()
+        # always gets the full token list, so a lost snapshot only costs a re-eval
+        last_llm, owner = self.owner.get(req.model, (None, None))
+        if owner is not req or last_llm is not llm:
+            if owner is not None and last_llm is llm:
+                owner.state = llm.save_state()
+                self.snapshot_size = max(self.snapshot_size, state_size(owner.state))
+            if req.state is not None:
+                llm.load_state(req.state)
+                req.state = None
+            self.owner[req.model] = (llm, req)
+
+        eos = llm.token_eos()
+        gen = llm.generate(req.tokens, temp=req.temperature, top_p=req.top_p, reset=True)
+        try:
+            for _ in range(self.quantum):
+                if req.cancelled.is_set():
+                    return "cancelled"
+                token = next(gen)
+                if token == eos:
+                    self._flush(req, final=True)
+                    return "stop"
+                req.tokens.append(token)
+                req.generated += 1
+                if self._decode(req, llm, token):
+                    return "stop"
+                if req.generated >= req.max_tokens:
+                    self._flush(req, final=True)
+                    return "length"
+        finally:
+            gen.close()
+        return None
+
+    def _prompt_tokens(self, req, llm):
+        formatter = self.formatters.get(req.model)
+        if formatter is None:
+            formatter = self.formatters[req.model] = make_formatter(llm)
+        result = formatter(messages=req.messages)
+        if result.stop:
+            req.stop += [result.stop] if isinstance(result.stop, str) else list(result.stop)
+        return prompt_tokens(llm, result)
+
+    def _decode(self, req, llm, token):
+        """Appends the token's text; returns True if a stop string was produced"""
+        data = req.pending + llm.detokenize([token], prev_tokens=req.tokens[:-1])
+        try:
+            req.text += data.decode("utf-8")
+            req.pending = b""
+        except UnicodeDecodeError:
+            if len(data) < 4:
+                req.pending = data  # wait for the rest of the character
+                return False
+            req.text += data.decode("utf-8", errors="replace")
+            req.pending = b""
+
+        for stop in req.stop:
+            cut = req.text.find(stop)
+            if cut != -1:
+                req.text = req.text[:cut]
+                self._flush(req, final=True)
+                return True
+        self._flush(req)
+        return False
+
+    def _flush(self, req, final=False):
+        # Hold back anything that could still turn out to be the start of a stop string
+        keep = 0
+        if not final:
+            for stop in req.stop:
+                for n in range(min(len(stop) - 1, len(req.text)), 0, -1):
+                    if req.text.endswith(stop[:n]):
+                        keep = max(keep, n)
+                        break
+        send = req.text[:len(req.text) - keep]
+        if send:
+            req.emit("delta", send)
+            req.text = req.text[len(send):]
+
+
+# --- HTTP ---
+class NeptuniumServer:
+    """Minimal OpenAI-compatible HTTP/1.1 server on asyncio streams.
+
+    POST /v1/chat/completions (stream or not), GET /v1/models, GET /health.
+    """
+
+    def __init__(self, scheduler, models, default_model):
+        self.scheduler = scheduler
+        self.models = models
+        self.default_model = default_model
+
+    async def handle(self, reader, writer):
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+            lines = head.decode("latin-1").split("\r\n")
+            method, path, _ = lines[0].split(" ", 2)
+            headers = {}
+            for line in lines[1:]:
+                if ":" in line:
+                    key, value = line.split(":", 1)
+                    headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+            path = path.split("?", 1)[0]
+
+            if method == "GET" and path == "/health":
+                await self.send_json(writer, 200, dict(self.scheduler.stats(), status="ok"))
+            elif method == "GET" and path == "/v1/models":
+                data = [{"id": m, "object": "model", "owned_by": "neptunium"} for m in self.models]
+                await self.send_json(writer, 200, {"object": "list", "data": data})
+            elif method == "POST" and path == "/v1/chat/completions":
+                await self.chat(reader, writer, json.loads(body or b"{}"))
+            else:
+                await self.send_error(writer, 404, f"No route for {method} {path}")
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except (ValueError, KeyError) as e:
+            await self.send_error(writer, 400, f"Bad request: {e}")
+        finally:
+            writer.close()
+
+    async def chat(self, reader, writer, body):
+        model = body.get("model") or self.default_model
+        if model not in self.models:
+            model = self.default_model  # clients often send an OpenAI model name
+        req = ChatRequest(
+            model=model,
+            messages=body["messages"],
+            loop=asyncio.get_running_loop(),
+            max_tokens=body.get("max_tokens") or body.get("max_completion_tokens"),
+            temperature=float(body.get("temperature", 0.8)),
+            top_p=float(body.get("top_p", 0.95)),
+            stop=body.get("stop"),
+        )
+        try:
+            self.scheduler.submit(req)
+        except SchedulerFull:
+            await self.send_error(writer, 503, "Server busy, retry later", {"Retry-After": "2"})
+            return
+
+        # The client hanging up cancels the request
+        watcher = asyncio.create_task(reader.read(1))
+        watcher.add_done_callback(lambda _: req.cancel())
+        try:
+            if body.get("stream"):
+                await self.stream_chat(writer, req)
+            else:
+                await self.complete_chat(writer, req)
+        except ConnectionError:
+            pass
+        finally:
+            req.cancel()
+            watcher.cancel()
+
+    async def next_event(self, req):
+        kind, value = await req.out.get()
+        with req.lock:
+            req.undelivered -= 1
+        return kind, value
+
+    async def stream_chat(self, writer, req):
+        kind, value = await self.next_event(req)
+        if kind == "error":
+            await self.send_error(writer, 500, value)
+            return
+        if kind == "cancelled":
+            return
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+            b"Cache-Control: no-cache\r\nConnection: close\r\n\r\n"
+        )
+        created = int(time.time())
+
+        def chunk(delta, finish=None):
+            data = {
+                "id": req.id, "object": "chat.completion.chunk", "created": created, "model": req.model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish}],
+            }
+            return f"data: {json.dumps(data)}\n\n".encode("utf-8")
+
+        writer.write(chunk({"role": "assistant"}))
+        while True:
+            if kind == "delta":
+                writer.write(chunk({"content": value}))
+            elif kind == "done":
+                writer.write(chunk({}, value))
+                break
+            elif kind == "cancelled":
+                return  # the client is gone: close without a final chunk
+            else:
+                writer.write(f"data: {json.dumps({'error': {'message': value}})}\n\n".encode("utf-8"))
+                break
+            await writer.drain()  # waits (and stops reading tokens) while the client is slow
+            kind, value = await self.next_event(req)
+        writer.write(b"data: [DONE]\n\n")
+        await writer.drain()
+
+    async def complete_chat(self, writer, req):
+        parts = []
+        while True:
+            kind, value = await self.next_event(req)
+            if kind == "delta":
+                parts.append(value)
+            elif kind == "error":
+                await self.send_error(writer, 500, value)
+                return
+            elif kind == "cancelled":
+                return
+            else:
+                break
+        await self.send_json(writer, 200, {
+            "id": req.id, "object": "chat.completion", "created": int(time.time()), "model": req.model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(parts)}, "finish_reason": value}],
+            "usage": {
+                "prompt_tokens": req.prompt_len,
+                "completion_tokens": req.generated,
+                "total_tokens": req.prompt_len + req.generated,
+            },
+        })
+
+    async def send_json(self, writer, status, payload, extra=None):
+        body = json.dumps(payload).encode("utf-8")
+        reason = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error", 503: "Service Unavailable"}
+        head = f"HTTP/1.1 {status} {reason.get(status, '')}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\nConnection: close\r\n"
+        for key, value in (extra or {}).items():
+            head += f"{key}: {value}\r\n"
+        writer.write(head.encode("latin-1") + b"\r\n" + body)
+        await writer.drain()
+
+    async def send_error(self, writer, status, message, extra=None):
+        await self.send_json(writer, status, {"error": {"message": message, "code": status}}, extra)
+
+
+async def serve(host, port, scheduler, models, default_model):
+    app = NeptuniumServer(scheduler, models, default_model)
+    server = await asyncio.start_server(app.handle, host, port)
+    print(f"Neptunium server on http://{host}:{port}/v1 ({default_model})")
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless OpenAI-compatible Neptunium server")
+    parser.add_argument("--model", help="default .gguf (first one found if omitted)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--quantum", type=int, default=QUANTUM)
+    parser.add_argument("--max-active", type=int, default=MAX_ACTIVE)
+    parser.add_argument("--max-pending", type=int, default=MAX_PENDING)
+    parser.add_argument("--snapshot-mb", type=int, help="RAM for paused requests' KV snapshots (default: the state cache share)")
+    args = parser.parse_args(argv)
+
+    models = find_models()
+    if args.model and args.model not in models:
+        models.append(args.model)
+    if not models:
+        print("No .gguf models found")
+        sys.exit(1)
+    default_model = args.model or models[0]
+
+    specs = HardwareEngine.get_specs()
+
+    def create_engine(path):
+        # Same settings as the desktop apps (calibrated profile when there is one)
+        return Llama(model_path=path, verbose=False, **HardwareEngine.engine_params(path, specs))
+
+    pool = ModelPool(create_engine, specs["model_pool"], specs["ctx"])
+    pool.get(default_model)
+    snapshot_budget = args.snapshot_mb * 1024**2 if args.snapshot_mb else specs["state_cache"]
+    scheduler = Scheduler(pool, args.quantum, args.max_active, args.max_pending, snapshot_budget)
+    try:
+        asyncio.run(serve(args.host, args.port, scheduler, models, default_model))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        scheduler.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import os
+import json
+from catalog import get_catalog
+
+SETTINGS_PATH = os.path.join(".neptunium_cache", "speculative.json")
+LOOKUP_TOKENS = 10  # proposals per step from prompt lookup
+LOOKUP_NGRAM = 3
+
+OFF = "off"
+LOOKUP = "lookup"
+DRAFT_PREFIX = "draft:"
+
+
+# --- Per-model setting ---
+def load_settings():
+    try:
+        with open(SETTINGS_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def get_mode(model_path):
+    """"off", "lookup" or "draft:<file.gguf>" for this model"""
+    return load_settings().get(os.path.basename(model_path), OFF)
+
+
+def set_mode(model_path, mode):
+    settings = load_settings()
+    settings[os.path.basename(model_path)] = mode
+    os.makedirs(os.path.dirname(SETTINGS_PATH), exist_ok=True)
+    with open(SETTINGS_PATH, "w", encoding="utf-8") as f:
+        json.dump(settings, f, indent=2)
+
+
+def draft_candidates(model_path):
+    """Smaller models with the same vocabulary - e.g. Llama-3.2-1B for Llama-3.2-3B.
+    Sizes and vocabularies come from the GGUF headers, so nothing is loaded."""
+    catalog = get_catalog()
+    target = catalog.entry(model_path)
+    if not target:
+        return []
+    found = []
+    for entry in catalog.scan():
+        if entry["path"] == model_path or entry["size"] >= target["size"]:
+            continue
+        if entry["vocab_size"] and target["vocab_size"] and entry["vocab_size"] != target["vocab_size"]:
+            continue
+        found.append(entry["path"])
+    return found
+
+
+def mode_choices(model_path):
+    from vision import find_projector
+    if find_projector(model_path):
+        return [OFF]  # image positions have no tokens for a draft to predict
+    return [OFF, LOOKUP] + [DRAFT_PREFIX + f for f in draft_candidates(model_path)]
+
+
+def build_draft(mode, target_llm, draft_factory):
+    """CountingDraft for `mode`, or None. draft_factory(path) loads a draft Llama.
+
+    A draft whose vocabulary differs from the target's can't be verified against
+    it, so that falls back to prompt lookup.
+    """
+    # llama_cpp (and numpy) load with the first model, not with the window
+    from llama_cpp.llama_speculative import LlamaPromptLookupDecoding
+    from drafts import DraftModel, CountingDraft
+    if mode == LOOKUP:
+        return CountingDraft(LlamaPromptLookupDecoding(LOOKUP_NGRAM, LOOKUP_TOKENS), LOOKUP)
+    if mode.startswith(DRAFT_PREFIX):
+        path = mode[len(DRAFT_PREFIX):]
+        if os.path.exists(path):
+            draft = draft_factory(path)
+            if draft.n_vocab() == target_llm.n_vocab():
+                return CountingDraft(DraftModel(draft), mode)
+            print(f"Speculative Error: {os.path.basename(path)} has a different vocabulary, using prompt lookup")
+            return CountingDraft(LlamaPromptLookupDecoding(LOOKUP_NGRAM, LOOKUP_TOKENS), LOOKUP)
+        print(f"Speculative Error: draft model {path} not found")
+    return None
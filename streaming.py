@@ -0,0 +1,79 @@
+import time
+import threading
+
+# Upper bound on how often a streaming bubble is repainted, whatever the decode speed
+MAX_REFRESH_HZ = 30
+
+
+class StreamBuffer:
+    """Hands tokens from the decoder thread to the UI thread in per-frame batches.
+
+    The decoder only appends under a lock; the UI polls drain() on its own timer
+    and gets everything produced since the last frame as one string. Code
+    without a UI loop iterates instead: `for text in stream` blocks between
+    batches, `async for text in stream` sleeps a frame between them.
+    """
+
+    def __init__(self, max_refresh_hz=MAX_REFRESH_HZ):
+        self.interval_ms = max(int(1000 / max_refresh_hz), 1)
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.pending = []
+        self.text_parts = []
+        self.tokens = 0
+        self.pending_since = 0.0
+        self.lag = 0.0  # how long the oldest token of the last drained batch waited
+        self.closed = False
+        self.error = None
+        self.stopped = None  # "stopped", "preempted" or "timeout" if cut short
+
+    def push(self, token):
+        with self.lock:
+            if not self.pending:
+                self.pending_since = time.perf_counter()
+            self.pending.append(token)
+            self.tokens += 1
+            self.changed.notify_all()
+
+    def close(self, error=None, stopped=None):
+        with self.lock:
+            self.closed = True
+            self.error = error
+            self.stopped = stopped
+            self.changed.notify_all()
+
+    def drain(self):
+        """Returns (new_text, finished). new_text is '' when nothing arrived this frame"""
+        with self.lock:
+            tail = "".join(self.pending)
+            self.pending = []
+            if tail:
+                self.text_parts.append(tail)
+                self.lag = time.perf_counter() - self.pending_since
+            return tail, self.closed
+
+    def __iter__(self):
+        while True:
+            with self.lock:
+                self.changed.wait_for(lambda: self.pending or self.closed)
+            tail, finished = self.drain()
+            if tail:
+                yield tail
+            if finished:
+                return
+
+    async def __aiter__(self):
+        import asyncio
+        while True:
+            tail, finished = self.drain()
+            if tail:
+                yield tail
+            if finished:
+                return
+            await asyncio.sleep(self.interval_ms / 1000)
+
+    @property
+    def text(self):
+        with self.lock:
+            # Include anything not yet drained so callers always see the full reply
+            return "".join(self.text_parts) + "".join(self.pending)
@@ -0,0 +1,199 @@
+import os
+import json
+import time
+import threading
+import psutil
+
+LOG_MAX_BYTES = 5 * 1024**2
+LOG_BACKUPS = 3
+
+_process = psutil.Process()
+
+
+def process_snapshot(process=_process):
+    """CPU % since the previous call on `process` and current RSS for this process.
+    Each psutil.Process keeps its own interval, so a caller timing its own
+    window (GenerationMetrics) passes one nobody else uses."""
+    return {
+        "cpu_percent": process.cpu_percent(None),
+        "rss_mb": round(process.memory_info().rss / 1024**2, 1),
+    }
+
+
+def process_uptime():
+    """Seconds since this process started (interpreter start-up included)"""
+    return time.time() - _process.create_time()
+
+
+class MetricsLog:
+    """Appends one JSON object per line; rotates to .1 .. .N at `max_bytes`"""
+
+    def __init__(self, path, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def write(self, event, **fields):
+        record = {"ts": round(time.time(), 3), "event": event}
+        record.update(fields)
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            try:
+                if os.path.exists(self.path) and os.path.getsize(self.path) + len(line) > self.max_bytes:
+                    self._rotate()
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line)
+            except OSError as e:
+                print(f"Metrics log Error: {e}")
+
+    def _rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+
+class GenerationMetrics:
+    """Timings for one reply, filled in from the decoder thread and the UI pump.
+
+    prompt_eval_s is the time to the first token: with the KV cache that is the
+    evaluation of whatever part of the prompt was not already cached.
+    """
+
+    LIVE_INTERVAL = 0.25  # seconds between status bar refreshes
+
+    def __init__(self, model):
+        self.model = os.path.basename(model or "")
+        self.started = time.perf_counter()
+        self.prompt_tokens = 0
+        self.request_at = None
+        self.first_token_at = None
+        self.last_token_at = None
+        self.tokens = 0
+        self.render_lag_max = 0.0
+        self.render_lag_total = 0.0
+        self.frames = 0
+        self.shown_at = 0.0
+        self.draft = None
+        self.draft_start = None
+        self.baseline_tps = None  # decode speed without speculation, for the speedup
+        self.cache = None  # "hit" / "miss" while the response cache is on
+        self.cache_hit_rate = None
+        self.prefilled = 0  # prompt tokens a background prefill had already evaluated
+        self.process = psutil.Process()
+        self.process.cpu_percent(None)  # starts this reply's CPU % interval
+
+    def speculative(self, draft, baseline_tps=None):
+        """Call before decoding when the model has a (CountingDraft) draft model"""
+        self.draft = draft
+        self.draft_start = draft.snapshot()
+        self.baseline_tps = baseline_tps
+
+    def cache_lookup(self, hit, hit_rate):
+        self.cache = "hit" if hit else "miss"
+        self.cache_hit_rate = hit_rate
+
+    # --- Decoder thread ---
+    def prompt_ready(self, prompt_tokens):
+        self.prompt_tokens = prompt_tokens
+        self.request_at = time.perf_counter()
+
+    def token(self):
+        now = time.perf_counter()
+        if self.first_token_at is None:
+            self.first_token_at = now
+        self.last_token_at = now
+        self.tokens += 1
+
+    # --- UI thread ---
+    def frame(self, lag):
+        """`lag`: how long the oldest token in this frame waited to be painted"""
+        self.frames += 1
+        self.render_lag_total += lag
+        self.render_lag_max = max(self.render_lag_max, lag)
+
+    @property
+    def ttft(self):
+        if self.first_token_at is None or self.request_at is None:
+            return None
+        return self.first_token_at - self.request_at
+
+    @property
+    def decode_tps(self):
+        if self.tokens < 2:
+            return 0.0
+        return (self.tokens - 1) / max(self.last_token_at - self.first_token_at, 1e-9)
+
+    def live(self):
+        """Status bar text, or None if it was refreshed less than LIVE_INTERVAL ago"""
+        now = time.perf_counter()
+        if now - self.shown_at < self.LIVE_INTERVAL:
+            return None
+        self.shown_at = now
+        if self.ttft is None:
+            return f"● Reading prompt ({self.prompt_tokens} tok)..."
+        return f"● {self.decode_tps:.1f} tok/s | TTFT {self.ttft:.2f}s"
+
+    def draft_stats(self):
+        if not self.draft:
+            return None
+        now = self.draft.snapshot()
+        proposed = now["proposed"] - self.draft_start["proposed"]
+        accepted = now["accepted"] - self.draft_start["accepted"]
+        stats = {
+            "mode": self.draft.kind,
+            "proposed": proposed,
+            "accepted": accepted,
+            "acceptance": round(accepted / proposed, 3) if proposed else 0.0,
+        }
+        if self.baseline_tps:
+            stats["speedup"] = round(self.decode_tps / self.baseline_tps, 2)
+        return stats
+
+    def summary(self):
+        rss = _process.memory_info().rss / 1024**3
+        if self.cache == "hit":
+            return f"● Ready | cached reply | cache hit rate {self.cache_hit_rate:.0%}"
+        if self.ttft is None:
+            return "● Ready"
+        text = f"● Ready | {self.decode_tps:.1f} tok/s | TTFT {self.ttft:.2f}s | {self.prompt_tokens} ctx tok | {rss:.1f} GB"
+        draft = self.draft_stats()
+        if draft:
+            text += f" | draft {draft['acceptance']:.0%} accepted"
+            if "speedup" in draft:
+                text += f", {draft['speedup']:.2f}x"
+        if self.cache:
+            text += f" | cache hit rate {self.cache_hit_rate:.0%}"
+        return text
+
+    def record(self, error=None):
+        """The JSONL entry for this reply"""
+        ttft = self.ttft
+        record = {
+            "model": self.model,
+            "prompt_tokens": self.prompt_tokens,
+            "prompt_eval_s": round(ttft, 4) if ttft is not None else None,
+            "prompt_tps": round(self.prompt_tokens / ttft, 1) if ttft else None,
+            "ttft_s": round(ttft, 4) if ttft is not None else None,
+            "queue_s": round((self.request_at or self.started) - self.started, 4),
+            "decode_tokens": self.tokens,
+            "decode_tps": round(self.decode_tps, 2),
+            "total_s": round(time.perf_counter() - self.started, 3),
+            "render_lag_max_ms": round(self.render_lag_max * 1000, 1),
+            "render_lag_avg_ms": round(self.render_lag_total / self.frames * 1000, 1) if self.frames else None,
+            "frames": self.frames,
+        }
+        if self.draft:
+            record["speculative"] = self.draft_stats()
+        if self.cache:
+            record["cache"] = self.cache
+            record["cache_hit_rate"] = self.cache_hit_rate
+        if self.prefilled:
+            record["prefilled_tokens"] = self.prefilled
+        if error:
+            record["error"] = str(error)
+        record.update(process_snapshot(self.process))
+        return record
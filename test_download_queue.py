@@ -0,0 +1,106 @@
+"""Resume after dropped connections, no-range fallback and hash mismatch, against a
+local stand-in server (python -m pytest test_download_queue.py, or run it directly)"""
+import os
+import re
+import hashlib
+import tempfile
+import threading
+import http.server
+from pathlib import Path
+from download_queue import Download, DownloadQueue, CHUNK
+
+
+def stand_in_server(directory, drop_after=None, ranges=True):
+    """HTTP server for `directory` on a free localhost port, started on a thread.
+
+    Serves Range requests (unless ranges=False) and, with drop_after, cuts each
+    response after that many bytes, the way a flaky connection does.
+    """
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_HEAD(self):
+            self._send(body=False)
+
+        def do_GET(self):
+            self._send(body=True)
+
+        def _send(self, body):
+            path = os.path.join(directory, os.path.basename(self.path))
+            if not os.path.isfile(path):
+                self.send_error(404)
+                return
+            size = os.path.getsize(path)
+            start, end = 0, size - 1
+            match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+            if ranges and match:
+                start = int(match.group(1))
+                end = min(int(match.group(2) or end), end)
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            else:
+                self.send_response(200)
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("Accept-Ranges", "bytes" if ranges else "none")
+            self.end_headers()
+            if not body:
+                return
+            length = end - start + 1
+            if drop_after:
+                length = min(length, drop_after)
+            with open(path, "rb") as f:
+                f.seek(start)
+                try:
+                    self.wfile.write(f.read(length))
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # the client only wanted the headers (range probe)
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_downloads(tmp):
+    """Serves one random file through each stand-in and downloads it; returns (data, jobs)"""
+    src = os.path.join(tmp, "src")
+    os.makedirs(src)
+    data = os.urandom(3 * CHUNK + 12345)
+    with open(os.path.join(src, "model.gguf"), "wb") as f:
+        f.write(data)
+    sha = hashlib.sha256(data).hexdigest()
+
+    flaky = stand_in_server(src, drop_after=CHUNK // 3)
+    plain = stand_in_server(src, ranges=False)
+    try:
+        queue = DownloadQueue(max_active=2, rate=32 * CHUNK)
+        jobs = {
+            "resume": Download("resume", os.path.join(tmp, "a.gguf"), f"http://127.0.0.1:{flaky.server_port}/model.gguf", sha256=sha),
+            "no_ranges": Download("no_ranges", os.path.join(tmp, "b.gguf"), f"http://127.0.0.1:{plain.server_port}/model.gguf", sha256=sha),
+            "bad_hash": Download("bad_hash", os.path.join(tmp, "c.gguf"), f"http://127.0.0.1:{plain.server_port}/model.gguf", sha256="0" * 64),
+        }
+        for job in jobs.values():
+            queue.add(job)
+        queue.wait()
+    finally:
+        flaky.shutdown()
+        plain.shutdown()
+    return data, jobs
+
+
+def test_downloads(tmp_path):
+    data, jobs = run_downloads(str(tmp_path))
+    for name in ("resume", "no_ranges"):
+        job = jobs[name]
+        assert job.status == "done", job.error
+        with open(job.dest, "rb") as f:
+            assert f.read() == data
+    assert jobs["bad_hash"].status == "error"
+    assert not os.path.exists(jobs["bad_hash"].part)
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmp:
+        test_downloads(Path(tmp))
+    print("ok")
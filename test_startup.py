@@ -0,0 +1,64 @@
+"""Start-up regression test: each front-end must import within STARTUP_TARGET_MS
+without pulling in llama_cpp / numpy / fitz (python -m pytest test_startup.py).
+
+A GUI toolkit that isn't installed is replaced by a stand-in module, so the
+check still covers Neptunium's own imports in CI without a display stack.
+"""
+import os
+import tempfile
+import importlib.util
+import pytest
+from pathlib import Path
+from bench import FRONTENDS, TOOLKITS, probe_startup, startup_failures
+
+# Any attribute is a class; instances accept any call, and used as a decorator
+# (@Slot()) hand the function back
+STAND_IN = '''
+class _StandIn:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __call__(self, *args, **kwargs):
+        return args[0] if len(args) == 1 and callable(args[0]) else _StandIn()
+
+    def __getattr__(self, name):
+        return _StandIn()
+
+
+def __getattr__(name):
+    return type(name, (_StandIn,), {})
+'''
+STAND_IN_MODULES = {
+    "tk": ["customtkinter.py", "tkinter/__init__.py", "tkinter/filedialog.py"],
+    "qt": ["PySide6/__init__.py", "PySide6/QtWidgets.py", "PySide6/QtCore.py", "PySide6/QtGui.py"],
+}
+
+
+def stand_in_toolkit(name, directory):
+    """Writes stand-ins for the toolkit's missing top-level modules; returns the path or None"""
+    written = False
+    for module in STAND_IN_MODULES[name]:
+        top = module.split("/")[0].removesuffix(".py")
+        if importlib.util.find_spec(top) is not None:
+            continue
+        path = os.path.join(directory, module)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(STAND_IN)
+        written = True
+    return str(directory) if written else None
+
+
+@pytest.mark.parametrize("name", sorted(FRONTENDS))
+def test_startup(name, tmp_path):
+    result = probe_startup(name, runs=3, pythonpath=stand_in_toolkit(name, tmp_path))
+    assert result is not None, f"{TOOLKITS[name][0]} missing despite the stand-in"
+    assert not startup_failures({"results": {f"startup_{name}": result}})
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in sorted(FRONTENDS):
+            os.makedirs(os.path.join(tmp, name))
+            test_startup(name, Path(tmp, name))
+    print("ok")
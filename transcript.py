@@ -0,0 +1,74 @@
+from array import array
+from bisect import bisect_right
+
+ROLES = ["user", "assistant", "file"]
+
+
+class Transcript:
+    """Backing store for a chat view: text + role + pixel offsets for every message.
+
+    Widgets only exist for the handful of rows on screen; everything else lives here.
+    `measure(role, text)` returns a row's height in pixels (bubble + spacing) and is
+    supplied by the front-end so the numbers match what it actually draws.
+    With `remeasure_chars`, streamed appends only re-measure once that many
+    characters (or a newline) arrived since the last measurement, for front-ends
+    whose measure lays out the whole text.
+    """
+
+    def __init__(self, measure, remeasure_chars=0):
+        self.measure = measure
+        self.remeasure_chars = remeasure_chars
+        self.unmeasured = {}  # row index -> characters appended since its height was measured
+        self.texts = []
+        self.roles = array("B")
+        self.heights = array("l")
+        self.offsets = array("l")  # top y of each row
+        self.total_height = 0
+
+    def __len__(self):
+        return len(self.texts)
+
+    def role(self, index):
+        return ROLES[self.roles[index]]
+
+    def add(self, role, text):
+        height = self.measure(role, text)
+        self.texts.append(text)
+        self.roles.append(ROLES.index(role))
+        self.heights.append(height)
+        self.offsets.append(self.total_height)
+        self.total_height += height
+        return len(self.texts) - 1
+
+    def set_text(self, index, text):
+        """Returns True if the row height changed (rows below it moved)"""
+        self.texts[index] = text
+        self.unmeasured.pop(index, None)
+        return self._set_height(index, self.measure(self.role(index), text))
+
+    def append(self, index, tail):
+        grown = self.unmeasured.get(index, 0) + len(tail)
+        if grown < self.remeasure_chars and "\n" not in tail:
+            self.texts[index] += tail
+            self.unmeasured[index] = grown
+            return False
+        return self.set_text(index, self.texts[index] + tail)
+
+    def _set_height(self, index, height):
+        delta = height - self.heights[index]
+        if not delta:
+            return False
+        self.heights[index] = height
+        # Streaming only ever grows the last row, so this loop is usually empty
+        for j in range(index + 1, len(self.offsets)):
+            self.offsets[j] += delta
+        self.total_height += delta
+        return True
+
+    def visible_range(self, top, viewport_height, overscan=3):
+        """Row indices to materialize for a viewport starting at `top` (end exclusive)"""
+        if not self.texts:
+            return 0, 0
+        first = max(bisect_right(self.offsets, top) - 1, 0)
+        last = bisect_right(self.offsets, top + viewport_height)
+        return max(first - overscan, 0), min(last + overscan, len(self.texts))
@@ -0,0 +1,291 @@
+import os
+import re
+import base64
+import ctypes
+import hashlib
+import threading
+from collections import OrderedDict
+from catalog import get_catalog, is_projector
+from ingest import file_digest
+
+IMAGE_TYPES = "*.png *.jpg *.jpeg *.bmp *.gif"  # what the projector's image loader reads
+MAX_IMAGES = 2  # per question; each one costs hundreds of context tokens
+RAM_BYTES = 256 * 1024**2
+DISK_BYTES = 1024**3
+PAGE_MARKER_RE = re.compile(r"\[(.+?): image\]")
+
+
+def is_image(path):
+    return os.path.splitext(path)[1].lower() in {t[1:] for t in IMAGE_TYPES.split()}
+
+
+# --- Model pairing ---
+def find_projector(model_path):
+    """The mmproj file that goes with a model: same folder, a shared name prefix
+    (moondream2-text-model-f16 / moondream2-mmproj-f16) and, when both headers
+    say, the projector's output width matching the model's embedding width"""
+    catalog = get_catalog()
+    model = catalog.entry(model_path)
+    if not model or is_projector(model):
+        return None
+    folder = os.path.dirname(os.path.abspath(model_path))
+    stem = os.path.basename(model_path).lower()
+    width = model["metadata"].get(f"{model['architecture']}.embedding_length")
+    best, best_len = None, 4  # at least a few characters of the name in common
+    for name in sorted(os.listdir(folder)):
+        path = os.path.join(folder, name)
+        if not name.endswith(".gguf") or os.path.samefile(path, model_path):
+            continue
+        entry = catalog.entry(path)
+        if not entry or not is_projector(entry):
+            continue
+        dim = entry["metadata"].get("clip.vision.projection_dim")
+        if dim and width and dim != width:
+            continue
+        n = len(os.path.commonprefix([stem, name.lower()]))
+        if n > best_len:
+            best, best_len = path, n
+    return best
+
+
+def make_handler(model_path, projector, cache):
+    """Chat handler that runs images through `projector`, with embeddings cached.
+    A llama_cpp without the mtmd API (before 0.3.26) gets its stock handler, uncached"""
+    from llama_cpp import llama_chat_format
+    entry = get_catalog().entry(model_path) or {}
+    if "moondream" in os.path.basename(model_path).lower():
+        cls = llama_chat_format.MoondreamChatHandler
+    elif entry.get("chat_template") and hasattr(llama_chat_format, "MTMDChatHandler"):
+        cls = llama_chat_format.MTMDChatHandler  # formats with the model's own template
+    else:
+        cls = llama_chat_format.Llava15ChatHandler
+    handler = cls(clip_model_path=projector, verbose=False)
+    if hasattr(handler, "_mtmd_cpp"):
+        key = f"{os.path.basename(projector)}|{os.path.getsize(projector)}"
+        handler._mtmd_cpp = CachingMtmd(handler._mtmd_cpp, cache, key)
+    return handler
+
+
+def has_vision(llm):
+    """True for a model built with make_handler() on the mtmd API (images cached and prefilled)"""
+    handler = getattr(llm, "chat_handler", None)
+    return isinstance(getattr(handler, "_mtmd_cpp", None), CachingMtmd)
+
+
+# --- Attachments ---
+class ImageAttachment:
+    """An attached picture; quacks like DocumentIndex so the attach/ask path is shared"""
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.digest = file_digest(path)
+        self.chunks = []
+        self.images = [(self.name, path)]
+        self.vectors = None
+        self.embedder = None
+        self.ready = threading.Event()
+        self.ready.set()
+        self.cancelled = False
+
+    def build(self, progress=None):
+        pass
+
+    def context_for(self, query, k=4):
+        return f"\n[{self.name}: image]\n"
+
+
+def pick_images(images, excerpts, k=MAX_IMAGES):
+    """Up to k image paths, those whose "[label: image]" marker made it into the excerpts first"""
+    shown = set(PAGE_MARKER_RE.findall(excerpts))
+    ranked = [p for label, p in images if label in shown] + [p for label, p in images if label not in shown]
+    return ranked[:k]
+
+
+def user_content(text, image_paths):
+    """Message content with the images in front of the text (OpenAI image_url parts)"""
+    if not image_paths:
+        return text
+    parts = []
+    for path in image_paths:
+        with open(path, "rb") as f:
+            data = base64.b64encode(f.read()).decode("ascii")
+        kind = os.path.splitext(path)[1][1:].lower() or "png"
+        parts.append({"type": "image_url", "image_url": {"url": f"data:image/{kind};base64,{data}"}})
+    parts.append({"type": "text", "text": text})
+    return parts
+
+
+# --- Embedding cache ---
+class ImageEmbeddingCache:
+    """Projector outputs by (projector, image hash): RAM LRU in front of .npy files.
+
+    Encoding an image is the slow part of a vision prompt (the projector runs a
+    ViT over it); decoding the cached embeddings into the KV is a normal batch.
+    """
+
+    def __init__(self, directory, ram_bytes=RAM_BYTES, disk_bytes=DISK_BYTES):
+        self.directory = directory
+        self.ram_bytes = ram_bytes
+        self.disk_bytes = disk_bytes
+        self.lock = threading.Lock()
+        self.ram = OrderedDict()  # key -> array, least recently used first
+        self.ram_used = 0
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _file(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + ".npy")
+
+    def get(self, key):
+        import numpy as np
+        with self.lock:
+            if key in self.ram:
+                self.ram.move_to_end(key)
+                self.hits += 1
+                return self.ram[key]
+        try:
+            embd = np.load(self._file(key))
+        except (OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+            self._put_ram(key, embd)
+        return embd
+
+    def put(self, key, embd):
+        import numpy as np
+        try:
+            np.save(self._file(key), embd)
+        except OSError as e:
+            print(f"Image cache Error: {e}")
+        with self.lock:
+            self._put_ram(key, embd)
+        self._trim_disk()
+
+    def _put_ram(self, key, embd):
+        if key in self.ram:
+            self.ram_used -= self.ram.pop(key).nbytes
+        self.ram[key] = embd
+        self.ram_used += embd.nbytes
+        while self.ram_used > self.ram_bytes and len(self.ram) > 1:
+            self.ram_used -= self.ram.popitem(last=False)[1].nbytes
+
+    def _trim_disk(self):
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".npy"):
+                st = os.stat(os.path.join(self.directory, name))
+                files.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if total <= self.disk_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+                total -= size
+            except OSError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "ram_entries": len(self.ram),
+                    "ram_mb": round(self.ram_used / 1024**2, 1)}
+
+
+class CachingMtmd:
+    """Stands in for llama_cpp.mtmd_cpp inside a chat handler.
+
+    Bitmaps are tagged with the image's SHA256, and image chunks are decoded
+    from cached projector embeddings, so a follow-up question about the same
+    picture skips the encoder. Everything else goes straight to mtmd_cpp.
+    """
+
+    def __init__(self, mtmd, cache, projector_key):
+        self.mtmd = mtmd
+        self.cache = cache
+        self.projector_key = projector_key
+
+    def __getattr__(self, name):
+        return getattr(self.mtmd, name)
+
+    def mtmd_helper_bitmap_init_from_buf(self, ctx, buf, length, *args):
+        bitmap = self.mtmd.mtmd_helper_bitmap_init_from_buf(ctx, buf, length, *args)
+        if bitmap is not None:
+            self.mtmd.mtmd_bitmap_set_id(bitmap, hashlib.sha256(bytes(buf)).hexdigest().encode())
+        return bitmap
+
+    def mtmd_helper_eval_chunk_single(self, ctx, lctx, chunk, n_past, seq_id, n_batch, logits_last, new_n_past):
+        m = self.mtmd
+        embd = None
+        if m.mtmd_input_chunk_get_type(chunk) == m.MTMD_INPUT_CHUNK_TYPE_IMAGE:
+            embd = self.embeddings(ctx, lctx, chunk)
+        if embd is None:
+            return m.mtmd_helper_eval_chunk_single(ctx, lctx, chunk, n_past, seq_id, n_batch, logits_last, new_n_past)
+        return m.mtmd_helper_decode_image_chunk(
+            ctx, lctx, chunk, embd.ctypes.data_as(ctypes.POINTER(ctypes.c_float)),
+            n_past, seq_id, n_batch, new_n_past, None, None
+        )
+
+    def embeddings(self, ctx, lctx, chunk, stats=None):
+        """Cached projector output for an image chunk, encoding it on a miss"""
+        import numpy as np
+        import llama_cpp
+        m = self.mtmd
+        image_id = m.mtmd_input_chunk_get_id(chunk)
+        if not image_id:
+            return None  # not tagged by us: let mtmd encode it
+        n_tokens = m.mtmd_input_chunk_get_n_tokens(chunk)
+        key = f"{self.projector_key}|{image_id.decode()}|{n_tokens}"
+        embd = self.cache.get(key)
+        if embd is not None:
+            if stats is not None:
+                stats["reused"] += 1
+            return embd
+        if m.mtmd_encode_chunk(ctx, chunk) != 0:
+            raise ValueError("Failed to encode image")
+        n_embd = llama_cpp.llama_model_n_embd_inp(llama_cpp.llama_get_model(lctx))
+        embd = np.ctypeslib.as_array(m.mtmd_get_output_embd(ctx), shape=(n_tokens * n_embd,)).copy()
+        self.cache.put(key, embd)
+        if stats is not None:
+            stats["encoded"] += 1
+        return embd
+
+
+def encode_images(llm, paths, check=None):
+    """Runs the projector over images ahead of the question (inference worker, model
+    lock held). Returns {"encoded": n, "reused": n}; check() is called between images"""
+    handler = llm.chat_handler
+    handler._init_mtmd_context(llm)
+    m = handler._mtmd_cpp
+    stats = {"encoded": 0, "reused": 0}
+    marker = m.mtmd_default_marker()
+    for path in paths:
+        if check:
+            check()
+        with open(path, "rb") as f:
+            data = f.read()
+        bitmap = m.mtmd_helper_bitmap_init_from_buf(
+            handler.mtmd_ctx, (ctypes.c_uint8 * len(data)).from_buffer(bytearray(data)), len(data), False
+        )
+        if bitmap is None:
+            raise ValueError(f"Unreadable image: {os.path.basename(path)}")
+        chunks = m.mtmd_input_chunks_init()
+        try:
+            text = m.mtmd_input_text()
+            text.text, text.text_len = marker, len(marker)
+            text.add_special, text.parse_special = False, True
+            bitmaps = (m.mtmd_bitmap_p_ctypes * 1)(bitmap)
+            if m.mtmd_tokenize(handler.mtmd_ctx, chunks, ctypes.byref(text), bitmaps, 1) != 0:
+                raise ValueError(f"Failed to tokenize image: {os.path.basename(path)}")
+            for i in range(m.mtmd_input_chunks_size(chunks)):
+                chunk = m.mtmd_input_chunks_get(chunks, i)
+                if chunk is not None and m.mtmd_input_chunk_get_type(chunk) == m.MTMD_INPUT_CHUNK_TYPE_IMAGE:
+                    m.embeddings(handler.mtmd_ctx, llm._ctx.ctx, chunk, stats)
+        finally:
+            m.mtmd_input_chunks_free(chunks)
+            m.mtmd_bitmap_free(bitmap)
+    return stats